@@ -1,4 +1,5 @@
 import logging.config
+import multiprocessing
 import os
 import signal
 import sys
@@ -100,6 +101,10 @@ def start_tribler_core(base_path, api_port, api_key, root_state_dir):
 
 
 if __name__ == "__main__":
+    # The Core uses a process pool for processing channels. In frozen builds, the pool workers are started
+    # through this very script, so they must exit here instead of starting another Tribler instance.
+    multiprocessing.freeze_support()
+
     # Get root state directory (e.g. from environment variable or from system default)
     root_state_dir = get_root_state_directory()
 
@@ -243,6 +243,14 @@ class TestTriblerConfig(TriblerCoreTest):
         self.tribler_config.set_chant_channels_dir('test')
         self.assertEqual(self.tribler_config.get_chant_channels_dir(),
                          self.tribler_config.get_state_dir() / 'test')
+        self.tribler_config.set_chant_processing_workers(4)
+        self.assertEqual(self.tribler_config.get_chant_processing_workers(), 4)
+        self.tribler_config.set_chant_search_cache_size(32)
+        self.assertEqual(self.tribler_config.get_chant_search_cache_size(), 32)
+        self.tribler_config.set_chant_search_cache_ttl(10)
+        self.assertEqual(self.tribler_config.get_chant_search_cache_ttl(), 10)
+        self.tribler_config.set_chant_db_reader_threads(2)
+        self.assertEqual(self.tribler_config.get_chant_db_reader_threads(), 2)
 
     def test_get_set_is_matchmaker(self):
         """
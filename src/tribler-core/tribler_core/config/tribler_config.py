@@ -131,6 +131,30 @@ class TriblerConfig(object):
     def get_chant_channels_dir(self):
         return self.abspath(self.config['chant']['channels_dir'])
 
+    def set_chant_processing_workers(self, value):
+        self.config['chant']['processing_workers'] = value
+
+    def get_chant_processing_workers(self):
+        return self.config['chant']['processing_workers']
+
+    def set_chant_search_cache_size(self, value):
+        self.config['chant']['search_cache_size'] = value
+
+    def get_chant_search_cache_size(self):
+        return self.config['chant']['search_cache_size']
+
+    def set_chant_search_cache_ttl(self, value):
+        self.config['chant']['search_cache_ttl'] = value
+
+    def get_chant_search_cache_ttl(self):
+        return self.config['chant']['search_cache_ttl']
+
+    def set_chant_db_reader_threads(self, value):
+        self.config['chant']['db_reader_threads'] = value
+
+    def get_chant_db_reader_threads(self):
+        return self.config['chant']['db_reader_threads']
+
     def get_state_dir(self):
         return self._state_dir
 
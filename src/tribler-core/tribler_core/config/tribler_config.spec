@@ -39,6 +39,10 @@ enabled = boolean(default=True)
 manager_enabled = boolean(default=True)
 channel_edit = boolean(default=False)
 channels_dir = string(default='channels')
+processing_workers = integer(min=0, default=2)
+search_cache_size = integer(min=0, default=256)
+search_cache_ttl = float(min=0, default=60)
+db_reader_threads = integer(min=1, default=4)
 
 [torrent_checking]
 enabled = boolean(default=True)
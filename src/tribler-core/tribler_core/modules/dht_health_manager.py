@@ -1,7 +1,7 @@
 import math
 from asyncio import Future
+from bisect import bisect_left, insort
 
-from ipv8.dht.routing import distance, id_to_binary_string
 from ipv8.taskmanager import TaskManager
 
 import libtorrent as lt
@@ -23,6 +23,8 @@ class DHTHealthManager(TaskManager):
         self.lookup_futures = {}    # Map from binary infohash to future
         self.bf_seeders = {}        # Map from infohash to (final) seeders bloomfilter
         self.bf_peers = {}          # Map from infohash to (final) peers bloomfilter
+        self.lookup_index = []      # Sorted list with the pending infohashes, as integers
+        self.lookup_transactions = {}  # Map from DHT transaction ID to the infohash of the lookup
         self.lt_session = lt_session
 
     def get_health(self, infohash, timeout=15):
@@ -39,6 +41,7 @@ class DHTHealthManager(TaskManager):
         self.lookup_futures[infohash] = lookup_future
         self.bf_seeders[infohash] = bytearray(256)
         self.bf_peers[infohash] = bytearray(256)
+        insort(self.lookup_index, int.from_bytes(infohash, 'big'))
 
         # Perform a get_peers request. This should result in get_peers responses with the BEP33 bloom filters.
         self.lt_session.dht_get_peers(lt.sha1_hash(bytes(infohash)))
@@ -71,19 +74,67 @@ class DHTHealthManager(TaskManager):
 
         self.lookup_futures.pop(infohash, None)
 
+        infohash_int = int.from_bytes(infohash, 'big')
+        index = bisect_left(self.lookup_index, infohash_int)
+        if index < len(self.lookup_index) and self.lookup_index[index] == infohash_int:
+            del self.lookup_index[index]
+        self.lookup_transactions = {transaction_id: lookup_infohash for transaction_id, lookup_infohash
+                                    in self.lookup_transactions.items() if lookup_infohash != infohash}
+
+    def sent_get_peers(self, transaction_id, infohash):
+        """
+        A get_peers query has been sent by the libtorrent DHT. Remember to which lookup the transaction belongs.
+        :param transaction_id: The transaction ID of the query.
+        :param infohash: The infohash in the query.
+        """
+        if infohash in self.lookup_futures:
+            self.lookup_transactions[transaction_id] = infohash
+
+    def get_closest_lookup(self, node_id):
+        """
+        Find the pending lookup with the infohash that is the closest (by XOR distance) to the given node ID.
+        We descend the sorted index bit by bit, as if it were a binary trie, so only the pending infohashes
+        that share the longest prefix with the node ID are considered.
+        :param node_id: The ID of the node that sent us a get_peers response.
+        :return: The infohash of the closest lookup, or None if there are no pending lookups.
+        """
+        lo, hi = 0, len(self.lookup_index)
+        if lo == hi:
+            return None
+
+        node_id_int = int.from_bytes(node_id, 'big')
+        prefix = 0
+        for bit in reversed(range(len(node_id) * 8)):
+            if hi - lo == 1:
+                break
+            # The infohashes in [lo, split) have this bit unset, the ones in [split, hi) have it set
+            split = bisect_left(self.lookup_index, prefix | (1 << bit), lo, hi)
+            if (node_id_int >> bit) & 1:
+                if split < hi:
+                    lo = split
+                    prefix |= 1 << bit
+                else:
+                    hi = split
+            elif split > lo:
+                hi = split
+            else:
+                prefix |= 1 << bit
+
+        return self.lookup_index[lo].to_bytes(len(node_id), 'big')
+
     @staticmethod
-    def combine_bloomfilters(bf1, bf2):
+    def combine_bloomfilters(*bloomfilters):
         """
-        Combine two given bloom filters by ORing the bits.
-        :param bf1: The first bloom filter to combine.
-        :param bf2: The second bloom filter to combine.
-        :return: A bytearray with the combined bloomfilter.
+        Combine the given bloom filters by ORing the bits.
+        The filters are ORed as (big) integers, instead of byte by byte.
+        :param bloomfilters: The bloom filters to combine.
+        :return: A bytearray with the combined bloomfilter, as long as the shortest of the given ones.
         """
-        final_bf_len = min(len(bf1), len(bf2))
-        final_bf = bytearray(final_bf_len)
-        for bf_index in range(final_bf_len):
-            final_bf[bf_index] = bf1[bf_index] | bf2[bf_index]
-        return final_bf
+        final_bf_len = min(len(bf) for bf in bloomfilters)
+        final_bf = 0
+        for bf in bloomfilters:
+            final_bf |= int.from_bytes(memoryview(bf)[:final_bf_len], 'big')
+        return bytearray(final_bf.to_bytes(final_bf_len, 'big'))
 
     @staticmethod
     def get_size_from_bloomfilter(bf):
@@ -92,21 +143,8 @@ class DHTHealthManager(TaskManager):
         :param bf: The bloom filter of which we estimate the size.
         :return: A rounded integer, approximating the number of items in the filter.
         """
-        def tobits(s):
-            result = []
-            for c in s:
-                num = ord(c) if isinstance(c, str) else c
-                bits = bin(num)[2:]
-                bits = '00000000'[len(bits):] + bits
-                result.extend([int(b) for b in bits])
-            return result
-
-        bits_array = tobits(bytes(bf))
-        total_zeros = 0
-        for bit in bits_array:
-            if bit == 0:
-                total_zeros += 1
-
+        # Count the set bits of the filter as a whole, instead of bit by bit
+        total_zeros = len(bf) * 8 - bin(int.from_bytes(bf, 'big')).count('1')
         if total_zeros == 0:
             return 6000  # The maximum capacity of the bloom filter used in BEP33
 
@@ -114,31 +152,24 @@ class DHTHealthManager(TaskManager):
         c = min(m - 1, total_zeros)
         return int(math.log(c / float(m)) / (2 * math.log(1 - 1 / float(m))))
 
-    def received_bloomfilters(self, node_id, bf_seeds=bytearray(256), bf_peers=bytearray(256)):
+    def received_bloomfilters(self, node_id, bf_seeds=bytearray(256), bf_peers=bytearray(256), transaction_id=None):
         """
         We have received bloom filters from the libtorrent DHT. Register the bloom filters and process them.
         :param node_id: The ID of the node that sent the bloom filter.
         :param bf_seeds: The bloom filter indicating the IP addresses of the seeders.
         :param bf_peers: The bloom filter indicating the IP addresses of the peers (leechers).
+        :param transaction_id: The transaction ID of the get_peers response, if known.
         """
-        min_distance = -1
-        closest_infohash = None
-
-        # We do not know to which infohash the received get_peers response belongs so we have to manually go through
-        # the infohashes and find the infohash that is the closest to the node id that sent us the message.
-        for infohash in self.lookup_futures:
-            infohash_bin = id_to_binary_string(infohash)
-            node_id_bin = id_to_binary_string(node_id)
-            ih_distance = distance(infohash_bin, node_id_bin)
-            if ih_distance < min_distance or min_distance == -1:
-                min_distance = ih_distance
-                closest_infohash = infohash
+        # The get_peers response does not include the infohash. If we have seen the query that belongs to this
+        # response, we use its infohash. Otherwise, we assume the response is for the lookup with the infohash that
+        # is the closest to the node id that sent us the message.
+        infohash = self.lookup_transactions.pop(transaction_id, None)
+        if infohash not in self.lookup_futures:
+            infohash = self.get_closest_lookup(node_id)
 
-        if not closest_infohash:
+        if not infohash:
             self._logger.info("Could not find lookup infohash for incoming BEP33 bloomfilters")
             return
 
-        self.bf_seeders[closest_infohash] = DHTHealthManager.combine_bloomfilters(
-            self.bf_seeders[closest_infohash], bf_seeds)
-        self.bf_peers[closest_infohash] = DHTHealthManager.combine_bloomfilters(
-            self.bf_peers[closest_infohash], bf_peers)
+        self.bf_seeders[infohash] = DHTHealthManager.combine_bloomfilters(self.bf_seeders[infohash], bf_seeds)
+        self.bf_peers[infohash] = DHTHealthManager.combine_bloomfilters(self.bf_peers[infohash], bf_peers)
@@ -32,6 +32,7 @@ from tribler_core.version import version_id
 
 LTSTATE_FILENAME = "lt.state"
 METAINFO_CACHE_PERIOD = 5 * 60
+DHT_PKT_OUTGOING = 1  # The value of libtorrent's dht_pkt_alert::outgoing direction
 DEFAULT_DHT_ROUTERS = [
     ("dht.libtorrent.org", 25401),
     ("router.bittorrent.com", 6881),
@@ -53,6 +54,17 @@ def encode_atp(atp):
     return atp
 
 
+def is_outgoing_dht_packet(alert):
+    """
+    Check whether a dht_pkt_alert is about a packet that we sent. Not all versions of the libtorrent bindings expose
+    the direction of the packet, in which case we fall back to the direction marker at the start of the message.
+    """
+    direction = getattr(alert, 'direction', None)
+    if direction is not None:
+        return int(direction) == DHT_PKT_OUTGOING
+    return alert.message().startswith('==>')
+
+
 class DownloadManager(TaskManager):
 
     def __init__(self, tribler_session):
@@ -351,11 +363,17 @@ class DownloadManager(TaskManager):
         elif alert_type == "dht_pkt_alert":
             # We received a raw DHT message - decode it and check whether it is a BEP33 message.
             decoded = bdecode_compat(alert.pkt_buf)
-            if decoded and 'r' in decoded:
+            if decoded and 'a' in decoded and 'info_hash' in decoded['a'] and 't' in decoded:
+                # Remember the transaction ID of our own get_peers queries, so we can match the responses with their
+                # lookup. The queries that other nodes send to us carry transaction IDs of their own choosing.
+                if is_outgoing_dht_packet(alert):
+                    self.dht_health_manager.sent_get_peers(decoded['t'], decoded['a']['info_hash'])
+            elif decoded and 'r' in decoded:
                 if 'BFsd' in decoded['r'] and 'BFpe' in decoded['r']:
                     self.dht_health_manager.received_bloomfilters(decoded['r']['id'],
                                                                   bytearray(decoded['r']['BFsd']),
-                                                                  bytearray(decoded['r']['BFpe']))
+                                                                  bytearray(decoded['r']['BFpe']),
+                                                                  transaction_id=decoded.get('t'))
 
     def update_ip_filter(self, lt_session, ip_addresses):
         self._logger.debug('Updating IP filter %s', ip_addresses)
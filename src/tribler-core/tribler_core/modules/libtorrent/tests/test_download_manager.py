@@ -1,6 +1,6 @@
 import shutil
 from asyncio import Future, ensure_future, gather, get_event_loop, sleep
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from libtorrent import bencode
 
@@ -381,6 +381,25 @@ class TestDownloadManager(AbstractServer):
         self.dlmgr._task_process_alerts()
         self.dlmgr.tribler_session.payout_manager.do_payout.is_called_with(b'a' * 20)
 
+    def test_dht_pkt_get_peers_outgoing(self):
+        """
+        Test whether only the transaction IDs of the get_peers queries that we send are passed on to the DHT health
+        manager, and not those of the queries that other nodes send to us
+        """
+        self.dlmgr.initialize()
+        self.dlmgr.dht_health_manager.sent_get_peers = Mock()
+        query = {'t': b'aa', 'y': b'q', 'q': b'get_peers', 'a': {'id': b'a' * 20, 'info_hash': b'b' * 20}}
+
+        def dht_pkt_alert(message):
+            return type('dht_pkt_alert', (object,), dict(pkt_buf=b'', message=lambda _: message))()
+
+        with patch('tribler_core.modules.libtorrent.download_manager.bdecode_compat', lambda _: query):
+            self.dlmgr.process_alert(dht_pkt_alert("<== [1.2.3.4:6881] get_peers"))
+            self.dlmgr.dht_health_manager.sent_get_peers.assert_not_called()
+
+            self.dlmgr.process_alert(dht_pkt_alert("==> [1.2.3.4:6881] get_peers"))
+            self.dlmgr.dht_health_manager.sent_get_peers.assert_called_once_with(b'aa', b'b' * 20)
+
     async def test_post_session_stats(self):
         """
         Test whether post_session_stats actually updates the state of libtorrent readiness for clean shutdown.
@@ -1,4 +1,3 @@
-from asyncio import get_event_loop
 from binascii import unhexlify
 from random import sample
 
@@ -117,10 +116,9 @@ class GigaChannelCommunity(Community):
             )
             md_list = channel_l + list(channel_l[0].get_random_contents(max_entries - 1)) if channel_l else None
             self.gossip_blob = entries_to_chunk(md_list, maximum_payload_size)[0] if md_list else None
-        self.metadata_store.disconnect_thread()
 
     async def prepare_gossip_blob_cache(self):
-        await get_event_loop().run_in_executor(None, self._prepare_gossip_blob_cache)
+        await self.metadata_store.run_read(self._prepare_gossip_blob_cache)
 
     def send_random_to(self, peer):
         """
@@ -144,20 +142,18 @@ class GigaChannelCommunity(Community):
         if self.gossip_blob:
             self.endpoint.send(peer.address, self.ezr_pack(self.NEWS_PUSH_MESSAGE, RawBlobPayload(self.gossip_blob)))
 
-    def _update_db_with_blob(self, raw_blob):
+    def _update_db_with_payloads(self, payloads):
         result = None
         try:
             with db_session:
                 try:
-                    result = self.metadata_store.process_compressed_mdblob(raw_blob)
+                    result = self.metadata_store.process_payloads_stream(payloads)
                 except (TransactionIntegrityError, CacheIndexError) as err:
                     self._logger.error("DB transaction error when tried to process payload: %s", str(err))
         # Unfortunately, we have to catch the exception twice, because Pony can raise them both on the exit from
         # db_session, and on calling the line of code
         except (TransactionIntegrityError, CacheIndexError) as err:
             self._logger.error("DB transaction error when tried to process payload: %s", str(err))
-        finally:
-            self.metadata_store.disconnect_thread()
         return result
 
     @lazy_wrapper(RawBlobPayload)
@@ -169,10 +165,14 @@ class GigaChannelCommunity(Community):
         :param blob: payload raw data
         """
 
+        # The blob is parsed and checked before it goes to the DB writer, so a malformed blob never delays the writes
+        payloads = await self.metadata_store.read_compressed_mdblob_threaded(blob.raw_blob)
+        if not payloads:
+            return
+
         def _process_received_blob():
-            md_results = self._update_db_with_blob(blob.raw_blob)
+            md_results = self._update_db_with_payloads(payloads)
             if not md_results:
-                self.metadata_store.disconnect_thread()
                 return None, None
             # Update votes counters
             with db_session:
@@ -186,16 +186,23 @@ class GigaChannelCommunity(Community):
 
             with db_session:
                 # Get the list of new channels for notifying the GUI
-                new_channels = [
-                    md.to_simple_dict()
-                    for md, result in md_results
-                    if md and md.metadata_type == CHANNEL_TORRENT and result == UNKNOWN_CHANNEL and md.origin_id == 0
-                ]
-            result = gen_have_newer_results_blob(md_results), new_channels
-            self.metadata_store.disconnect_thread()
-            return result
+                new_channels = self.metadata_store.get_entries_json_by_rowids(
+                    [
+                        md.rowid
+                        for md, result in md_results
+                        if md
+                        and md.metadata_type == CHANNEL_TORRENT
+                        and result == UNKNOWN_CHANNEL
+                        and md.origin_id == 0
+                    ]
+                )
+            return gen_have_newer_results_blob(md_results), new_channels
 
-        reply_blob, new_channels = await get_event_loop().run_in_executor(None, _process_received_blob)
+        try:
+            reply_blob, new_channels = await self.metadata_store.run_write(_process_received_blob, coalesce=True)
+        except (TransactionIntegrityError, CacheIndexError) as err:
+            self._logger.error("DB transaction error when tried to process payload: %s", str(err))
+            return
 
         # Notify the discovered torrents and channels to the GUI
         if self.notifier and new_channels:
@@ -278,14 +285,17 @@ class GigaChannelCommunity(Community):
             "channel_pk": channel_pk,
         }
 
+        def _search():
+            db_results = self.metadata_store.MetadataNode.get_entries(**request_dict)
+            return entries_to_chunk(db_results[:max_entries], maximum_payload_size)[0] if db_results else b""
+
         def _get_search_results():
             with db_session:
-                db_results = self.metadata_store.MetadataNode.get_entries(**request_dict)
-                result = entries_to_chunk(db_results[:max_entries], maximum_payload_size)[0] if db_results else None
-            self.metadata_store.disconnect_thread()
-            return result
+                return self.metadata_store.search_with_cache(
+                    "remote", dict(request_dict, maximum_payload_size=maximum_payload_size), _search
+                )
 
-        result_blob = await get_event_loop().run_in_executor(None, _get_search_results)
+        result_blob = await self.metadata_store.run_read(_get_search_results)
 
         if result_blob:
             self.endpoint.send(
@@ -298,29 +308,38 @@ class GigaChannelCommunity(Community):
         if not search_request_cache or not search_request_cache.process_peer_response(peer):
             return
 
+        payloads = await self.metadata_store.read_compressed_mdblob_threaded(response.raw_blob)
+        if not payloads:
+            return
+
         def _process_received_blob():
-            md_results = self._update_db_with_blob(response.raw_blob)
+            md_results = self._update_db_with_payloads(payloads)
             if not md_results:
-                self.metadata_store.disconnect_thread()
                 return None, None
 
             with db_session:
                 result = (
-                    [
-                        md.to_simple_dict()
-                        for (md, action) in md_results
-                        if (
-                            md
-                            and (md.metadata_type in [CHANNEL_TORRENT, REGULAR_TORRENT])
-                            and action in [UNKNOWN_CHANNEL, UNKNOWN_TORRENT, UPDATED_OUR_VERSION, UNKNOWN_COLLECTION]
-                        )
-                    ],
+                    self.metadata_store.get_entries_json_by_rowids(
+                        [
+                            md.rowid
+                            for (md, action) in md_results
+                            if (
+                                md
+                                and (md.metadata_type in [CHANNEL_TORRENT, REGULAR_TORRENT])
+                                and action
+                                in [UNKNOWN_CHANNEL, UNKNOWN_TORRENT, UPDATED_OUR_VERSION, UNKNOWN_COLLECTION]
+                            )
+                        ]
+                    ),
                     gen_have_newer_results_blob(md_results),
                 )
-            self.metadata_store.disconnect_thread()
             return result
 
-        search_results, reply_blob = await get_event_loop().run_in_executor(None, _process_received_blob)
+        try:
+            search_results, reply_blob = await self.metadata_store.run_write(_process_received_blob, coalesce=True)
+        except (TransactionIntegrityError, CacheIndexError) as err:
+            self._logger.error("DB transaction error when tried to process payload: %s", str(err))
+            return
 
         if self.notifier and search_results:
             self.notifier.notify(
@@ -117,7 +117,11 @@ class RemoteQueryCommunity(Community):
     @lazy_wrapper(RemoteSelectPayload)
     async def on_remote_select(self, peer, request):
         request_sanitized = sanitize_query(json.loads(request.json), self.settings.max_response_size)
-        db_results = await self.mds.MetadataNode.get_entries_threaded(**request_sanitized)
+
+        def _get_entries():
+            return self.mds.MetadataNode.get_entries(**request_sanitized)
+
+        db_results = await self.mds.run_read(_get_entries)
         if not db_results:
             return
 
@@ -145,11 +149,13 @@ class RemoteQueryCommunity(Community):
         result = await self.mds.process_compressed_mdblob_threaded(response.raw_blob, peer_vote_for_channels=peer_vote)
         # Maybe move this callback to MetadataStore side?
         if self.notifier:
-            new_channels = [
-                md.to_simple_dict()
-                for md, result in result
-                if md and md.metadata_type == CHANNEL_TORRENT and result == UNKNOWN_CHANNEL and md.origin_id == 0
-            ]
+            new_channels = self.mds.get_entries_json_by_rowids(
+                [
+                    md.rowid
+                    for md, result in result
+                    if md and md.metadata_type == CHANNEL_TORRENT and result == UNKNOWN_CHANNEL and md.origin_id == 0
+                ]
+            )
             if new_channels:
                 self.notifier.notify(
                     NTFY.CHANNEL_DISCOVERED, {"results": new_channels, "uuid": str(CHANNELS_VIEW_UUID)}
@@ -0,0 +1,164 @@
+import heapq
+import re
+import sqlite3
+import threading
+from bisect import bisect_left, insort
+
+# Must be the same as the tokenizer of FtsIndex, so the index terms are the same as FtsIndex terms
+FTS_TOKENIZE = 'porter unicode61 remove_diacritics 1'
+
+# Approximation of the unicode61 tokenizer, used to find the words of a title by their FtsIndex offsets
+WORD_RE = re.compile(r'[^\W_]+')
+
+# Each query reads the generation counter along with the data, so both come from the same snapshot of the database
+sql_select_vocabulary = (
+    "SELECT g.value AS generation, IFNULL((SELECT MAX(rowid) FROM ChannelNode), 0) AS last_rowid, v.term, v.doc "
+    "FROM ChannelNodeGeneration g LEFT JOIN FtsVocab v"
+)
+
+# The entries changed during a bulk import are not in FtsIndex yet (see MetadataStore.deferred_fts_indexing)
+sql_select_pending_titles = (
+    "SELECT title FROM ChannelNode WHERE rowid IN (SELECT rowid FROM FtsPendingRows) AND rowid <= $last_rowid"
+)
+
+sql_select_new_titles = (
+    "SELECT g.value AS generation, cn.rowid, cn.title "
+    "FROM ChannelNodeGeneration g LEFT JOIN ChannelNode cn ON cn.rowid > $last_rowid"
+)
+
+sql_select_term_instance = "SELECT doc, offset FROM FtsVocabInstance WHERE term = $term LIMIT 1"
+
+
+class CompletionIndex(object):
+    """
+    In-memory index of the FtsIndex vocabulary, for completing search queries as they are typed.
+
+    The terms are kept in a sorted array, together with the number of entries containing each of them, so the
+    completions of a prefix are a contiguous slice of the array and are ranked by their popularity. The index is
+    built from the FtsIndex vocabulary (fts5vocab) on first use. After that, it is updated incrementally with the
+    terms of the entries added since the last update. Every insert bumps the generation counter of the entries once,
+    so if the counter moved by more than the number of the added entries, some entries were deleted or changed
+    (or a bulk import got indexed), and the index is built from the vocabulary again.
+
+    The FtsIndex terms are stemmed (e.g. "movies" is indexed as "movi"), so the typed words are stemmed the same way
+    before the lookup, and the completions are shown as they are written in one of the titles containing them.
+    Both are done with a private in-memory FTS5 table using the same tokenizer as FtsIndex.
+    """
+
+    def __init__(self, db, tokenize=FTS_TOKENIZE):
+        """
+        :param db: the Pony database of the MetadataStore
+        :param tokenize: the tokenizer of FtsIndex
+        """
+        self._db = db
+        self._terms = []
+        self._counts = {}
+        self._words = {}
+        self._last_rowid = None
+        self._generation = None
+        self._lock = threading.RLock()
+
+        self._tokenizer = sqlite3.connect(':memory:', check_same_thread=False)
+        self._tokenizer.execute("CREATE VIRTUAL TABLE Terms USING fts5(title, detail=none, tokenize='%s')" % tokenize)
+        self._tokenizer.execute("CREATE VIRTUAL TABLE TermsVocab USING fts5vocab(Terms, 'row')")
+
+    def _tokenize(self, titles):
+        """
+        Get the FtsIndex terms of the given titles.
+        :return: dict mapping each term to the number of titles containing it
+        """
+        with self._lock, self._tokenizer:
+            self._tokenizer.executemany("INSERT INTO Terms(title) VALUES (?)", ((title,) for title in titles))
+            terms = dict(self._tokenizer.execute("SELECT term, doc FROM TermsVocab"))
+            self._tokenizer.execute("DELETE FROM Terms")
+        return terms
+
+    def _add_terms(self, terms):
+        for term, count in terms.items():
+            if term in self._counts:
+                self._counts[term] += count
+            else:
+                self._counts[term] = count
+                insort(self._terms, term)
+
+    def _build(self):
+        """
+        Build the index from the FtsIndex vocabulary and the entries waiting to be added to FtsIndex.
+        """
+        rows = self._db.select(sql_select_vocabulary)
+        self._generation, self._last_rowid = rows[0].generation, rows[0].last_rowid
+        self._counts = {row.term: row.doc for row in rows if row.term is not None}
+        self._terms = sorted(self._counts)
+        self._words = {}
+        pending = self._db.select(sql_select_pending_titles, globals(), {"last_rowid": self._last_rowid})
+        self._add_terms(self._tokenize(title for title in pending if title))
+
+    def update(self, generation):
+        """
+        Bring the index up to date with the database.
+        Must be called from within a db_session.
+        :param generation: the current generation counter of the entries
+        """
+        with self._lock:
+            if generation == self._generation:
+                return
+            if self._last_rowid is None:
+                self._build()
+                return
+            rows = self._db.select(sql_select_new_titles, globals(), {"last_rowid": self._last_rowid})
+            new_rows = [row for row in rows if row.rowid is not None]
+            if rows[0].generation - self._generation != len(new_rows):
+                self._build()
+                return
+            if new_rows:
+                self._last_rowid = max(row.rowid for row in new_rows)
+                self._add_terms(self._tokenize(row.title for row in new_rows if row.title))
+            self._generation = rows[0].generation
+
+    def _get_word(self, term):
+        """
+        Get the word for the given term, as it is written in one of the titles containing it.
+        """
+        word = self._words.get(term)
+        if word is not None:
+            return word
+        instance = self._db.select(sql_select_term_instance, globals(), {"term": term})
+        if instance:
+            title = self._db.select(
+                "SELECT title FROM ChannelNode WHERE rowid = $rowid", globals(), {"rowid": instance[0].doc}
+            )
+            words = WORD_RE.findall(title[0] or "") if title else []
+            if instance[0].offset < len(words):
+                word = words[instance[0].offset].lower()
+                self._words[term] = word
+                return word
+        # The entry is not in FtsIndex yet (or the title could not be tokenized), so fall back to the term itself
+        return term
+
+    def complete(self, keyword, max_terms):
+        """
+        Get the completions of the last word of the given keyword, ranked by the number of entries containing them.
+        Must be called from within a db_session.
+        :param keyword: the lowercase query, as typed so far
+        :param max_terms: the maximum number of completions to return
+        :return: list of the completed queries
+        """
+        words = WORD_RE.findall(keyword)
+        if not words:
+            return []
+        prefix_terms = list(self._tokenize([words[-1]]))
+        if not prefix_terms:
+            return []
+        prefix = prefix_terms[0]
+        query_start = keyword[: keyword.rfind(words[-1])]
+
+        with self._lock:
+            start = bisect_left(self._terms, prefix)
+            end = bisect_left(self._terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+            candidates = heapq.nlargest(max_terms + 1, self._terms[start:end], key=self._counts.__getitem__)
+            completions = []
+            for term in candidates:
+                completion = query_start + self._get_word(term)
+                if completion != keyword and completion not in completions and len(completions) < max_terms:
+                    completions.append(completion)
+        return completions
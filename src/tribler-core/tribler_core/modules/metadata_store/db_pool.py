@@ -0,0 +1,305 @@
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.thread import ThreadPoolExecutor
+from queue import Empty, Queue
+
+from pony.orm import db_session
+from pony.orm.core import OrmError
+from pony.orm.dbapiprovider import DBException
+
+_thread_state = threading.local()
+
+# Marks the absence of a task taken from the queue of the DBWriter (None is the shutdown signal)
+_NO_TASK = object()
+
+# The errors that are caused by the DB itself, rather than by a single task writing to it
+DB_ERRORS = (OrmError, DBException)
+
+
+def is_read_only_thread():
+    """
+    Check if the current thread belongs to a read-only DBThreadPool.
+    """
+    return getattr(_thread_state, "read_only", False)
+
+
+class DBThreadPool(ThreadPoolExecutor):
+    """
+    Thread pool for running DB jobs off the reactor thread.
+
+    Pony keeps a separate DB connection for each thread, so the threads of the pool keep their connections
+    between the jobs, instead of opening a new connection for every job and disconnecting after it. The connections
+    are closed on shutdown, by running a disconnect job on every thread of the pool.
+    The connections of a read-only pool are opened in query_only mode (see MetadataStore), so any attempt to write
+    from a read-only job fails instead of fighting the writer for the DB lock.
+    """
+
+    def __init__(self, db, max_workers, thread_name_prefix='', read_only=False):
+        """
+        :param db: the Pony database the jobs are working with
+        :param max_workers: the number of threads (and DB connections) of the pool
+        :param thread_name_prefix: the prefix of the names of the threads
+        :param read_only: True if the jobs are only allowed to read from the DB
+        """
+        super(DBThreadPool, self).__init__(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix, initializer=self._initialize_thread
+        )
+        self.db = db
+        self.read_only = read_only
+        self.num_threads = max_workers
+        self._closed = False
+
+    def _initialize_thread(self):
+        _thread_state.read_only = self.read_only
+
+    def shutdown(self, wait=True):
+        if self._closed:
+            return
+        self._closed = True
+        # Every disconnect job waits for all the others to start, so each of them runs on a different thread
+        barrier = threading.Barrier(self.num_threads)
+
+        def disconnect():
+            try:
+                barrier.wait(timeout=10)
+            except threading.BrokenBarrierError:
+                pass
+            self.db.disconnect()
+
+        for _ in range(self.num_threads):
+            self.submit(disconnect)
+        super(DBThreadPool, self).shutdown(wait=wait)
+
+
+class WriteTask(object):
+    __slots__ = ('func', 'args', 'coalesce', 'future', 'submit_time')
+
+    def __init__(self, func, args, coalesce):
+        self.func = func
+        self.args = args
+        self.coalesce = coalesce
+        self.future = Future()
+        self.submit_time = time.monotonic()
+
+
+class _CoalescedTaskError(Exception):
+    """
+    A coalesced task failed with an error of its own, so the transaction it shares with other tasks is rolled back.
+    """
+
+    def __init__(self, task, error):
+        super(_CoalescedTaskError, self).__init__(task, error)
+        self.task = task
+        self.error = error
+
+
+class DBWriter(object):
+    """
+    The single thread executing the DB writes of the MetadataStore.
+
+    The writes are submitted as tasks and executed one after another, so they never fight each other for the DB
+    lock. Small writes can be submitted as coalesced tasks: the writer groups the coalesced tasks that are queued
+    together into a single transaction, waiting at most coalesce_time for more of them to arrive. This way, a burst
+    of small writes (e.g. gossip) costs a single commit (and fsync) instead of one commit per write.
+
+    Coalesced tasks share a transaction. If a task fails with an error of its own (i.e. not a DB error), the task
+    gets its error and the others are re-run without it, again in a single transaction. If the transaction fails
+    because of a DB error, the tasks are re-run one by one, each in its own transaction, so a failing task does not
+    take the others down with it. Hence, coalesced tasks must only change the DB, and any expensive preparation
+    (e.g. parsing and checking the signatures of a blob) must be done before submitting them.
+    Note that the db_sessions opened by coalesced tasks are nested in the one of the writer, so the errors Pony raises
+    on commit (e.g. TransactionIntegrityError) can't be caught by the tasks themselves: they go to their callers.
+    Non-coalesced tasks are run on their own and must open their own db_sessions, e.g. to process a channel
+    in several transactions.
+    """
+
+    def __init__(self, db, coalesce_time=0.02, max_coalesced_tasks=100, name="MetadataWriter"):
+        """
+        :param db: the Pony database the tasks are working with
+        :param coalesce_time: the maximum number of seconds to wait for more tasks to coalesce with a queued one
+        :param max_coalesced_tasks: the maximum number of tasks to execute in a single transaction
+        :param name: the name of the writer thread
+        """
+        self.db = db
+        self.coalesce_time = coalesce_time
+        self.max_coalesced_tasks = max_coalesced_tasks
+        self.name = name
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Statistics
+        self.max_queue_depth = 0
+        self.tasks = 0
+        self.batches = 0
+        self.coalesced_tasks = 0
+        self.last_commit_latency = 0.0
+        self.max_commit_latency = 0.0
+        self.total_commit_latency = 0.0
+        self.total_task_latency = 0.0
+
+    def submit(self, func, *args, coalesce=False):
+        """
+        Submit a task to the writer thread.
+        :param func: the function to call
+        :param args: the arguments of the function
+        :param coalesce: True if the task can be executed in the same transaction as other coalesced tasks
+        :return: concurrent.futures.Future with the result of the task
+        """
+        task = WriteTask(func, args, coalesce)
+        if not self._enqueue(task):
+            raise RuntimeError("cannot submit writes after the DB writer was shut down")
+        return task.future
+
+    def drain(self):
+        """
+        Get a future that is done once the tasks submitted so far are executed.
+        The shutdown executes all the queued tasks, so after it the future is done right away.
+        :return: concurrent.futures.Future
+        """
+        task = WriteTask(lambda: None, (), False)
+        if not self._enqueue(task):
+            task.future.set_result(None)
+        return task.future
+
+    def _enqueue(self, task):
+        """
+        Queue a task for the writer thread, starting the thread if needed.
+        :return: False if the writer was shut down, so the task was not queued
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._queue.put(task)
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return True
+
+    def shutdown(self):
+        """
+        Execute the queued tasks, stop the writer thread and close its DB connection.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        next_task = self._queue.get()
+        while next_task is not None:
+            batch = [next_task]
+            next_task = _NO_TASK
+            if batch[0].coalesce:
+                deadline = time.monotonic() + self.coalesce_time
+                while len(batch) < self.max_coalesced_tasks:
+                    try:
+                        task = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except Empty:
+                        break
+                    if task is None or not task.coalesce:
+                        next_task = task
+                        break
+                    batch.append(task)
+            self._execute(batch)
+            if next_task is _NO_TASK:
+                next_task = self._queue.get()
+        self.db.disconnect()
+
+    def _execute(self, batch):
+        batch = [task for task in batch if task.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        start_time = time.monotonic()
+        if len(batch) == 1:
+            outcomes = [self._execute_task(batch[0], in_transaction=batch[0].coalesce)]
+        else:
+            outcomes = self._execute_coalesced(batch)
+            self.coalesced_tasks += len(batch)
+        end_time = time.monotonic()
+
+        self.tasks += len(batch)
+        self.batches += 1
+        self.last_commit_latency = end_time - start_time
+        self.max_commit_latency = max(self.max_commit_latency, self.last_commit_latency)
+        self.total_commit_latency += self.last_commit_latency
+        self.total_task_latency += sum(end_time - task.submit_time for task in batch)
+
+        # The results are only reported after the statistics are updated, so they are consistent with the results
+        for task, (result, exception) in zip(batch, outcomes):
+            if exception is not None:
+                task.future.set_exception(exception)
+            else:
+                task.future.set_result(result)
+
+    def _execute_coalesced(self, batch):
+        """
+        Execute coalesced tasks in a single transaction (see the class description for the error handling).
+        :return: list of (result, exception) tuples, in the order of the tasks
+        """
+        outcomes = {}
+        remaining = batch
+        while remaining:
+            try:
+                with db_session:
+                    results = [self._run_coalesced_task(task) for task in remaining]
+            except _CoalescedTaskError as e:
+                # Leaving the db_session with an error rolled back the changes of all the tasks
+                outcomes[e.task] = (None, e.error)
+                remaining = [task for task in remaining if task is not e.task]
+                continue
+            except Exception:  # pylint: disable=broad-except
+                for task in remaining:
+                    outcomes[task] = self._execute_task(task, in_transaction=True)
+                break
+            outcomes.update((task, (result, None)) for task, result in zip(remaining, results))
+            break
+        return [outcomes[task] for task in batch]
+
+    @staticmethod
+    def _run_coalesced_task(task):
+        try:
+            return task.func(*task.args)
+        except DB_ERRORS:
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            raise _CoalescedTaskError(task, e) from e
+
+    @staticmethod
+    def _execute_task(task, in_transaction):
+        """
+        Execute a single task.
+        :return: (result, exception) tuple
+        """
+        try:
+            if in_transaction:
+                with db_session:
+                    return task.func(*task.args), None
+            return task.func(*task.args), None
+        except Exception as e:  # pylint: disable=broad-except
+            return None, e
+
+    def get_stats(self):
+        """
+        Get the statistics of the writer, e.g. for debugging. The latencies are in seconds. The commit latency
+        is the time it takes to execute and commit a batch of tasks, and the task latency includes the queueing time.
+        """
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "tasks": self.tasks,
+            "coalesced_tasks": self.coalesced_tasks,
+            "batches": self.batches,
+            "last_commit_latency": self.last_commit_latency,
+            "max_commit_latency": self.max_commit_latency,
+            "avg_commit_latency": self.total_commit_latency / self.batches if self.batches else 0.0,
+            "avg_task_latency": self.total_task_latency / self.tasks if self.tasks else 0.0,
+        }
@@ -1,4 +1,5 @@
-from asyncio import get_event_loop
+from asyncio import CancelledError, Queue, ensure_future, gather, get_event_loop
+from concurrent.futures import ProcessPoolExecutor
 
 from ipv8.database import database_blob
 from ipv8.taskmanager import TaskManager, task
@@ -9,7 +10,9 @@ from tribler_common.simpledefs import DLSTATUS_SEEDING, NTFY
 
 from tribler_core.modules.libtorrent.download_config import DownloadConfig
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef, TorrentDefNoMetainfo
+from tribler_core.exceptions import InvalidSignatureException
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import COMMITTED
+from tribler_core.modules.metadata_store.store import get_channel_dir_blobs, read_verified_mdblob_file
 from tribler_core.utilities.unicode import hexlify
 
 PROCESS_CHANNEL_DIR = 1
@@ -32,6 +35,13 @@ class GigaChannelManager(TaskManager):
         self.channels_processing_queue = {}
         self.processing = False
 
+        # When enabled, the blobs of several channels are checked in parallel by a process pool,
+        # while the writer thread of the MetadataStore writes their contents to the database
+        self.blob_processing_pool = None
+        self.max_parallel_channels = 4
+        self.max_queued_blobs = 4  # number of blobs per channel that are read ahead of the DB writer
+        self._shutting_down = False
+
     def start(self):
         """
         The Metadata Store checks the database at regular intervals to see if new channels are available for preview
@@ -70,6 +80,12 @@ class GigaChannelManager(TaskManager):
         except Exception:
             self._logger.exception("Error when tried to resume personal channel seeding on GigaChannel Manager startup")
 
+        processing_workers = self.session.config.get_chant_processing_workers()
+        if processing_workers:
+            self.blob_processing_pool = ProcessPoolExecutor(max_workers=processing_workers)
+            # Personal channel commits serialize their entries on the same pool
+            self.session.mds.ChannelMetadata._commit_executor = self.blob_processing_pool
+
         channels_check_interval = 5.0  # seconds
         self.register_task(
             "Process channels download queue and remove cruft", self.service_channels, interval=channels_check_interval
@@ -79,7 +95,13 @@ class GigaChannelManager(TaskManager):
         """
         Stop the gigachannel manager.
         """
+        self._shutting_down = True
         await self.shutdown_task_manager()
+        if self.blob_processing_pool:
+            self.session.mds.ChannelMetadata._commit_executor = None
+            self.blob_processing_pool.shutdown(wait=False)
+        # Wait for the DB writer to finish its current batch, so it does not race with the MetadataStore shutdown
+        await self.session.mds.drain_writes()
 
     def remove_cruft_channels(self):
         """
@@ -133,7 +155,16 @@ class GigaChannelManager(TaskManager):
             infohash, (action, data) = next(iter(self.channels_processing_queue.items()))
             self.channels_processing_queue.pop(infohash)
             if action == PROCESS_CHANNEL_DIR:
-                await self.process_channel_dir_threaded(data)  # data is a channel object (used read-only!)
+                # data is a channel object (used read-only!)
+                channels = [data]
+                if self.blob_processing_pool:
+                    # Process the channels that are queued next to each other in parallel
+                    for queued_infohash, (queued_action, queued_data) in list(self.channels_processing_queue.items()):
+                        if queued_action != PROCESS_CHANNEL_DIR or len(channels) >= self.max_parallel_channels:
+                            break
+                        self.channels_processing_queue.pop(queued_infohash)
+                        channels.append(queued_data)
+                await gather(*[self.process_channel_dir_threaded(channel) for channel in channels])
             elif action == REMOVE_CHANNEL_DOWNLOAD:
                 await self.remove_channel_download(data)  # data is a tuple (download, remove_content bool)
             elif action == CLEANUP_UNSUBSCRIBED_CHANNEL:
@@ -255,24 +286,75 @@ class GigaChannelManager(TaskManager):
         return download
 
     async def process_channel_dir_threaded(self, channel):
-        def _process_download():
-            try:
-                channel_dirname = self.session.mds.channels_dir / channel.dirname
-                self.session.mds.process_channel_dir(
-                    channel_dirname, channel.public_key, channel.id_, external_thread=True
-                )
-                self.session.mds._db.disconnect()
-            except Exception as e:
-                self._logger.error("Error when processing channel dir download: %s", e)
-                return
-
-        await get_event_loop().run_in_executor(None, _process_download)
+        await self.process_channel_dir_pipelined(channel)
+        self.notify_channel_updated(channel)
 
+    def notify_channel_updated(self, channel):
         with db_session:
             channel_upd = self.session.mds.ChannelMetadata.get(public_key=channel.public_key, id_=channel.id_)
+            if not channel_upd:
+                return
             channel_upd_dict = channel_upd.to_simple_dict()
         self.session.notifier.notify(NTFY.CHANNEL_ENTITY_UPDATED, channel_upd_dict)
 
+    async def process_channel_dir_pipelined(self, channel):
+        """
+        Process the blobs of a downloaded channel in two stages. The blobs are read, decompressed and checked
+        for valid signatures in the process pool (or in a thread, if there is no pool), up to max_queued_blobs ahead
+        of the DB writer. The DB writer thread then processes the verified blobs in order, in small batches, advancing
+        the local version of the channel after each blob (see process_channel_blob_threaded). The blobs are never
+        read from disk again, so the DB only gets the payloads that were checked.
+        FtsIndex maintenance is deferred until the whole channel is processed (see deferred_fts_indexing).
+        :param channel: the channel object (used read-only!)
+        """
+        mds = self.session.mds
+        loop = get_event_loop()
+        queue = Queue(maxsize=self.max_queued_blobs)
+
+        async def read_blobs():
+            for blob_sequence_number, full_filename in get_channel_dir_blobs(mds.channels_dir / channel.dirname):
+                # Skip the blobs that were already processed according to our (possibly outdated) copy of the channel.
+                # The DB writer checks this again against the actual state of the channel.
+                if not channel.start_timestamp < blob_sequence_number <= channel.timestamp:
+                    continue
+                if blob_sequence_number <= channel.local_version:
+                    continue
+                future = loop.run_in_executor(self.blob_processing_pool, read_verified_mdblob_file, full_filename)
+                await queue.put((blob_sequence_number, full_filename, future))
+            await queue.put(None)
+
+        reader = ensure_future(read_blobs())
+        try:
+            async with mds.deferred_fts_indexing_threaded():
+                while True:
+                    item = await queue.get()
+                    if item is None or self._shutting_down:
+                        break
+                    blob_sequence_number, full_filename, future = item
+                    try:
+                        chunk_data = await future
+                    except InvalidSignatureException:
+                        self._logger.error("Not processing metadata located at %s: invalid signature", full_filename)
+                        continue
+                    except RuntimeError:
+                        self._logger.warning("Unable to decompress mdblob %s", full_filename)
+                        # Nothing to process, but the blob still counts as processed
+                        chunk_data = None
+                    if not await mds.process_channel_blob_threaded(
+                        channel.public_key, channel.id_, blob_sequence_number, chunk_data
+                    ):
+                        break
+        except CancelledError:
+            raise
+        except Exception as e:
+            self._logger.error("Error when processing channel dir download: %s", e)
+        finally:
+            reader.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[2].cancel()
+
     def updated_my_channel(self, tdef):
         """
         Notify the core that we updated our channel.
@@ -1,10 +1,12 @@
 import os
+from collections import deque
 from datetime import datetime
+from hashlib import sha1
 from pathlib import Path
 
 from ipv8.database import database_blob
 
-from libtorrent import add_files, bencode, create_torrent, file_storage, set_piece_hashes, torrent_info
+from libtorrent import bdecode, bencode, create_torrent, file_storage, set_piece_hashes, torrent_info
 
 import lz4.frame
 
@@ -31,6 +33,12 @@ CHANNEL_DIR_NAME_ID_LENGTH = 16  # Zero-padded long int in hex form
 CHANNEL_DIR_NAME_LENGTH = CHANNEL_DIR_NAME_PK_LENGTH + CHANNEL_DIR_NAME_ID_LENGTH
 BLOB_EXTENSION = '.mdblob'
 LZ4_END_MARK_SIZE = 4  # in bytes, from original specification. We don't use CRC
+PIECE_HASHES_CACHE_FILENAME = '.piece_hashes'  # Stored in the channel dir, but never added to the channel torrent
+SHA1_DIGEST_SIZE = 20
+
+# Maximum number of parameters we put into a single SQL "IN (...)" clause.
+# Older SQLite versions do not accept more than 999 parameters per query.
+SQL_IN_CHUNK_SIZE = 500
 
 
 def chunks(l, n):
@@ -39,13 +47,133 @@ def chunks(l, n):
         yield l[i : i + n]
 
 
+def create_piece_aligned_torrent(fs):
+    """
+    Create a v1 torrent where every file starts at a piece boundary, so the pieces of a file never depend on its
+    neighbours in the torrent.
+    :param fs: the file_storage describing the files of the torrent
+    :return: libtorrent create_torrent object
+    """
+    # libtorrent 2.0 creates hybrid v1/v2 torrents by default, and only pads the files in the canonical mode
+    if hasattr(create_torrent, 'v1_only'):
+        return create_torrent(fs, 0, create_torrent.v1_only | create_torrent.canonical_files)
+    # Older versions put the pad files according to the pad file size limit
+    return create_torrent(fs, 0, 0)
+
+
+def get_file_piece_hashes(file_path, piece_length):
+    """
+    Calculate the SHA1 hashes of the pieces of a file that starts at a piece boundary. The last piece is hashed
+    as if it was padded with zeroes up to the full piece length, just like the torrent's pad files do.
+    :param file_path: the path to the file to hash
+    :param piece_length: the piece length of the torrent
+    :return: the list of the pieces' hashes
+    """
+    hashes = []
+    with open(file_path, 'rb') as f:
+        piece = f.read(piece_length)
+        while piece:
+            hashes.append(sha1(piece.ljust(piece_length, b'\x00')).digest())
+            piece = f.read(piece_length)
+    return hashes
+
+
+def load_piece_hashes_cache(cache_path, piece_length):
+    """
+    Load the cached piece hashes of the files in a channel dir.
+    :param cache_path: the path to the cache file
+    :param piece_length: the piece length the hashes should be calculated for
+    :return: a dict of {filename: (size, mtime_ns, hashes)}. Empty if the cache is missing, broken or outdated.
+    """
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = bdecode(f.read())
+    except IOError:
+        return {}
+    if not isinstance(cache, dict) or cache.get(b'piece length') != piece_length:
+        return {}
+    result = {}
+    for filename, (size, mtime_ns, hashes) in cache.get(b'files', {}).items():
+        result[filename.decode('utf-8')] = (
+            size,
+            mtime_ns,
+            [hashes[i : i + SHA1_DIGEST_SIZE] for i in range(0, len(hashes), SHA1_DIGEST_SIZE)],
+        )
+    return result
+
+
+def save_piece_hashes_cache(cache_path, piece_length, files_hashes):
+    """
+    Save the piece hashes of the files in a channel dir to the cache file.
+    :param cache_path: the path to the cache file
+    :param piece_length: the piece length the hashes were calculated for
+    :param files_hashes: a dict of {filename: (size, mtime_ns, hashes)}
+    """
+    cache = {
+        b'piece length': piece_length,
+        b'files': {
+            filename.encode('utf-8'): [size, mtime_ns, b''.join(hashes)]
+            for filename, (size, mtime_ns, hashes) in files_hashes.items()
+        },
+    }
+    with open(cache_path, 'wb') as f:
+        f.write(bencode(cache))
+
+
 def create_torrent_from_dir(directory, torrent_filename):
+    """
+    Create a torrent from the contents of a channel dir. Channel dirs are append-only, and the files in
+    the torrent are aligned to the piece boundaries, so the piece hashes of a file never change.
+    The hashes are cached in the channel dir, keyed by the file's name, size and modification time,
+    and only the newly added files are actually hashed.
+    :param directory: the channel dir
+    :param torrent_filename: the path to write the resulting torrent file to
+    :return: (torrent, infohash) tuple, where torrent is the generated torrent dict
+    """
+    files = []
+    for filename in sorted(os.listdir(directory)):
+        if filename != PIECE_HASHES_CACHE_FILENAME and os.path.isfile(directory / filename):
+            file_stat = os.stat(directory / filename)
+            files.append((filename, file_stat.st_size, file_stat.st_mtime_ns))
+
     fs = file_storage()
-    add_files(fs, str(directory))
-    t = create_torrent(fs)
-    # t = create_torrent(fs, flags=17) # piece alignment
+    for filename, size, _ in files:
+        fs.add_file(os.path.join(directory.name, filename), size)
+    t = create_piece_aligned_torrent(fs)
     t.set_priv(False)
-    set_piece_hashes(t, str(directory.parent))
+
+    piece_length = t.piece_length()
+    torrent_files = t.files()
+    aligned = all(
+        torrent_files.file_offset(i) % piece_length == 0
+        for i in range(torrent_files.num_files())
+        if not torrent_files.file_flags(i) & file_storage.flag_pad_file and torrent_files.file_size(i)
+    )
+    if aligned:
+        cache_path = directory / PIECE_HASHES_CACHE_FILENAME
+        cached_hashes = load_piece_hashes_cache(cache_path, piece_length)
+        files_hashes = {}
+        piece_index = 0
+        for filename, size, mtime_ns in files:
+            cached = cached_hashes.get(filename)
+            if cached and cached[:2] == (size, mtime_ns):
+                hashes = cached[2]
+            else:
+                hashes = get_file_piece_hashes(directory / filename, piece_length)
+            files_hashes[filename] = (size, mtime_ns, hashes)
+            for piece_hash in hashes:
+                t.set_hash(piece_index, piece_hash)
+                piece_index += 1
+        # Without tail padding, the very last piece of the torrent is shorter than the rest, so it is hashed as is
+        if piece_index and t.piece_size(piece_index - 1) != piece_length:
+            last_filename = [filename for filename, size, _ in files if size][-1]
+            with open(directory / last_filename, 'rb') as f:
+                f.seek(-t.piece_size(piece_index - 1), os.SEEK_END)
+                t.set_hash(piece_index - 1, sha1(f.read()).digest())
+        save_piece_hashes_cache(cache_path, piece_length, files_hashes)
+    else:
+        set_piece_hashes(t, str(directory.parent))
+
     torrent = t.generate()
     with open(torrent_filename, 'wb') as f:
         f.write(bencode(torrent))
@@ -88,6 +216,69 @@ def entries_to_chunk(metadata_list, chunk_size, start_index=0):
     return chunk, last_entry_index + 1
 
 
+def serialize_entries(entries):
+    """
+    Serialize a batch of metadata entries that were detached from the database. The function only deals with
+    plain data, so it can be run on a process pool.
+    :param entries: the list of entries to serialize. Each entry is either a (payload_class, payload_kwargs) tuple,
+        or an already serialized entry.
+    :return: the list of serialized entries, in the same order
+    """
+    return [
+        entry if isinstance(entry, bytes) else b''.join(entry[0](**entry[1])._serialized()) for entry in entries
+    ]
+
+
+def serialized_entries_to_chunks(serialized_entries, chunk_size):
+    """
+    Squash a stream of serialized entries into a sequence of LZ4-compressed chunks. Chunk boundaries are determined
+    by the compressed size of the entries, exactly in the same way as entries_to_chunk does it.
+    :param serialized_entries: iterable of serialized entries
+    :param chunk_size: the desired chunk size limit, in bytes. The produced chunk's size will never exceed this value.
+    :return: generator of (chunk, entries_count) tuples, where entries_count is the number of entries in the chunk
+    """
+    compressor = out_list = None
+    offset = 0
+    for serialized in serialized_entries:
+        while True:
+            if compressor is None:
+                compressor = lz4.frame.LZ4FrameCompressor(auto_flush=True)
+                header = compressor.begin()
+                offset = len(header)
+                out_list = [header]
+            blob = compressor.compress(serialized)
+            if offset + len(blob) <= chunk_size - LZ4_END_MARK_SIZE:
+                offset += len(blob)
+                out_list.append(blob)
+                break
+            if len(out_list) == 1:
+                raise Exception('Serialized entry size > blob size limit!')
+            # The entry does not fit into the current chunk, so we finalize it and put the entry into the next one
+            out_list.append(compressor.flush())
+            yield b''.join(out_list), len(out_list) - 2
+            compressor = None
+    if compressor is not None:
+        out_list.append(compressor.flush())
+        yield b''.join(out_list), len(out_list) - 2
+
+
+def get_channel_state(is_personal, status, local_version, timestamp, subscribed):
+    """
+    Get the text-based state of a channel from the values of its columns.
+    """
+    if is_personal:
+        return "Personal"
+    if status == LEGACY_ENTRY:
+        return "Legacy"
+    if local_version == timestamp:
+        return "Complete"
+    if local_version > 0:
+        return "Updating"
+    if subscribed:
+        return "Downloading"
+    return "Preview"
+
+
 def define_binding(db):
     class ChannelMetadata(db.TorrentMetadata, db.CollectionNode):
         """
@@ -116,6 +307,10 @@ def define_binding(db):
         _channels_dir = None
         _category_filter = None
         _CHUNK_SIZE_LIMIT = 1 * 1024 * 1024  # We use 1MB chunks as a workaround for Python's lack of string pointers
+        # Optional concurrent.futures executor (e.g. a process pool) to serialize the committed entries on
+        _commit_executor = None
+        _SERIALIZATION_BATCH_SIZE = 1000
+        _MAX_PENDING_SERIALIZATION_BATCHES = 8
         payload_arguments = _payload_class.__init__.__code__.co_varnames[
             : _payload_class.__init__.__code__.co_argcount
         ][1:]
@@ -212,9 +407,10 @@ def define_binding(db):
                 os.makedirs(str_path(channel_dir))
 
             index = 0
-            while index < len(metadata_list):
-                # Squash several serialized and signed metadata entries into a single file
-                data, index = entries_to_chunk(metadata_list, self._CHUNK_SIZE_LIMIT, start_index=index)
+            serialized_entries = self.serialize_commit_entries(metadata_list, executor=self._commit_executor)
+            # Squash several serialized and signed metadata entries into a single file
+            for data, entries_count in serialized_entries_to_chunks(serialized_entries, self._CHUNK_SIZE_LIMIT):
+                index += entries_count
                 # The final file in the sequence should get the same (new) timestamp as the channel entry itself.
                 # Otherwise, the local channel version will never become equal to its timestamp.
                 blob_timestamp = metadata_list[index - 1].timestamp if index < len(metadata_list) else final_timestamp
@@ -230,6 +426,37 @@ def define_binding(db):
 
             return {"infohash": infohash, "timestamp": final_timestamp, "torrent_date": torrent_date}, torrent
 
+        @classmethod
+        def serialize_commit_entries(cls, metadata_list, executor=None):
+            """
+            Serialize the entries of a channel commit, in order.
+            If an executor is given, the entries are detached from the database in batches, and the batches are
+            serialized on the executor, while the caller compresses the already serialized ones. The serialized
+            form of an entry does not depend on where it was produced, so the resulting blobs are always the same.
+            :param metadata_list: the list of metadata entries to serialize
+            :param executor: optional concurrent.futures executor to serialize the entries on
+            :return: generator of serialized entries
+            """
+            if executor is None:
+                for metadata in metadata_list:
+                    yield metadata.serialized_delete() if metadata.status == TODELETE else metadata.serialized()
+                return
+
+            pending = deque()
+            for batch in chunks(metadata_list, cls._SERIALIZATION_BATCH_SIZE):
+                entries = [
+                    # Delete entries are signed on the spot, so these are serialized here, with our own key
+                    metadata.serialized_delete()
+                    if metadata.status == TODELETE
+                    else (metadata._payload_class, dict(metadata.to_dict(), unsigned=metadata.signature is None))
+                    for metadata in batch
+                ]
+                pending.append(executor.submit(serialize_entries, entries))
+                if len(pending) >= cls._MAX_PENDING_SERIALIZATION_BATCHES:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
         def commit_channel_torrent(self, new_start_timestamp=None, commit_list=None):
             """
             Collect new/uncommitted and marked for deletion metadata entries, commit them to a channel torrent and
@@ -372,17 +599,7 @@ def define_binding(db):
             :return: Text-based status
             """
             # TODO: optimize this by stopping doing blob comparisons on each call, and instead remember rowid?
-            if self.is_personal:
-                return "Personal"
-            if self.status == LEGACY_ENTRY:
-                return "Legacy"
-            if self.local_version == self.timestamp:
-                return "Complete"
-            if self.local_version > 0:
-                return "Updating"
-            if self.subscribed:
-                return "Downloading"
-            return "Preview"
+            return get_channel_state(self.is_personal, self.status, self.local_version, self.timestamp, self.subscribed)
 
         def to_simple_dict(self, **kwargs):
             """
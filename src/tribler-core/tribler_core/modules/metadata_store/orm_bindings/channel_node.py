@@ -11,6 +11,8 @@ from tribler_core.exceptions import InvalidChannelNodeException, InvalidSignatur
 from tribler_core.modules.metadata_store.discrete_clock import clock
 from tribler_core.modules.metadata_store.serialization import (
     CHANNEL_NODE,
+    CHANNEL_TORRENT,
+    COLLECTION_NODE,
     ChannelNodePayload,
     DELETED,
     DeletedMetadataPayload,
@@ -273,14 +275,37 @@ def define_binding(db, logger=None, key=None):
             return self
 
         def get_parents_ids(self, max_recursion_depth=15):
+            """
+            Get the path from the root of the channels tree to this node's parent.
+            :param max_recursion_depth: the maximum number of ancestors to look up
+            :return: tuple of ids of the ancestors, starting with 0 (root) if the root was reached
+            """
             if not max_recursion_depth:
                 return tuple()
             if self.origin_id == 0:
                 return (0,)
-            parent = db.CollectionNode.get(public_key=self.public_key, id_=self.origin_id)
-            if parent:
-                result = parent.get_parents_ids(max_recursion_depth=max_recursion_depth - 1)
-            return result + (parent.id_,)
+            orm.flush()
+            public_key = database_blob(self.public_key)
+            origin_id = self.origin_id
+            # Walk the parent pointers up in a single query, instead of fetching the ancestors one by one
+            ancestors = db.execute(
+                """
+                WITH RECURSIVE ancestors(id_, origin_id, depth) AS (
+                    SELECT id_, origin_id, 1 FROM ChannelNode
+                    WHERE public_key = $public_key AND id_ = $origin_id AND metadata_type IN (%i, %i)
+                    UNION ALL
+                    SELECT node.id_, node.origin_id, ancestors.depth + 1 FROM ChannelNode node, ancestors
+                    WHERE node.public_key = $public_key AND node.id_ = ancestors.origin_id
+                    AND node.metadata_type IN (%i, %i) AND ancestors.depth < $max_recursion_depth
+                )
+                SELECT id_, origin_id, depth FROM ancestors ORDER BY depth DESC
+                """
+                % ((COLLECTION_NODE, CHANNEL_TORRENT) * 2)
+            ).fetchall()
+            result = tuple(id_ for id_, _, _ in ancestors)
+            if ancestors and ancestors[0][1] == 0 and ancestors[0][2] < max_recursion_depth:
+                result = (0,) + result
+            return result
 
         def make_copy(self, tgt_parent_id, attributes_override=None):
             dst_dict = attributes_override or {}
@@ -9,7 +9,7 @@ from pony.orm import db_session, select
 from tribler_core.exceptions import DuplicateTorrentFileError
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef
 from tribler_core.modules.metadata_store.discrete_clock import clock
-from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import chunks
+from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import SQL_IN_CHUNK_SIZE, chunks
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import (
     COMMITTED,
     DIRTY_STATUSES,
@@ -18,7 +18,11 @@ from tribler_core.modules.metadata_store.orm_bindings.channel_node import (
     UPDATED,
 )
 from tribler_core.modules.metadata_store.orm_bindings.torrent_metadata import tdef_to_metadata_dict
-from tribler_core.modules.metadata_store.serialization import COLLECTION_NODE, CollectionNodePayload
+from tribler_core.modules.metadata_store.serialization import (
+    CHANNEL_TORRENT,
+    COLLECTION_NODE,
+    CollectionNodePayload,
+)
 from tribler_core.utilities.random_utils import random_infohash
 
 
@@ -234,48 +238,55 @@ def define_binding(db):
 
             return committed_channels
 
+        @staticmethod
+        def get_dirty_subtrees_rowids():
+            """
+            Get the rowids of our dirty nodes and all of their ancestors, i.e. the nodes affected by the changes.
+            The dirty nodes come from the DirtyNodes table, and the ancestors are resolved with a single
+            recursive query, so the cost is proportional to the number of changes, not to the size of the channels.
+            :return: list of (rowid, origin_id) tuples. origin_ids that are not in the list point to missing parents.
+            """
+            orm.flush()
+            public_key = database_blob(db.ChannelNode._my_key.pub().key_to_bin()[10:])
+            return db.execute(
+                """
+                WITH RECURSIVE affected(rowid, id_, origin_id) AS (
+                    SELECT node.rowid, node.id_, node.origin_id FROM DirtyNodes, ChannelNode node
+                    WHERE node.rowid = DirtyNodes.rowid AND node.public_key = $public_key
+                    UNION
+                    SELECT node.rowid, node.id_, node.origin_id FROM ChannelNode node, affected
+                    WHERE node.public_key = $public_key AND node.id_ = affected.origin_id
+                    AND node.metadata_type IN (%i, %i)
+                )
+                SELECT rowid, id_, origin_id FROM affected
+                """
+                % (COLLECTION_NODE, CHANNEL_TORRENT)
+            ).fetchall()
+
         @staticmethod
         @db_session
         def get_children_dict_to_commit():
             db.CollectionNode.collapse_deleted_subtrees()
-            upd_dict = {}
-            children = {}
-            # TODO: optimize me by rewriting in pure SQL with recursive CTEs
+            affected = db.CollectionNode.get_dirty_subtrees_rowids()
 
-            def update_node_info(n):
-                # Add the node to its parent's set of children
-                if n.origin_id not in children:
-                    children[n.origin_id] = {n}
-                else:
-                    children[n.origin_id].add(n)
-                upd_dict[n.id_] = n
-
-            dead_parents = set()
-            # First we traverse the tree upwards from changed leaves to find all nodes affected by changes
-            for node in db.ChannelNode.select(
-                lambda g: g.public_key == db.ChannelNode._my_key.pub().key_to_bin()[10:] and g.status in DIRTY_STATUSES
-            ):
-                update_node_info(node)
-                # This process resolves the parents completely.
-                # Therefore, if a parent is already in the dict, its path has already been resolved.
-                while node and (node.origin_id not in upd_dict):
-                    # Add the node to its parent's set of children
-                    update_node_info(node)
-                    # Get parent node
-                    parent = db.CollectionNode.get(public_key=node.public_key, id_=node.origin_id)
-                    if not parent:
-                        dead_parents.add(node.origin_id)
-                    node = parent
-
-            # Normally, dead_parents should consist only of 0 node, which is root. Otherwise, we got some orphans.
-            if 0 in dead_parents:
-                dead_parents.remove(0)
+            # Normally, the only parent that is not affected itself should be 0, which is root.
+            # Otherwise, we got some orphans.
+            affected_ids = {id_ for _, id_, _ in affected}
+            dead_parents = {origin_id for _, _, origin_id in affected if origin_id not in affected_ids} - {0}
             # Delete orphans
-            db.ChannelNode.select(
-                lambda g: database_blob(db.ChannelNode._my_key.pub().key_to_bin()[10:]) == g.public_key
-                and g.origin_id in dead_parents
-            ).delete()
+            for dead_parents_chunk in chunks(list(dead_parents), SQL_IN_CHUNK_SIZE):
+                db.ChannelNode.select(
+                    lambda g: database_blob(db.ChannelNode._my_key.pub().key_to_bin()[10:]) == g.public_key
+                    and g.origin_id in dead_parents_chunk
+                ).delete()
             orm.flush()  # Just in case...
+
+            children = {}
+            alive_rowids = [rowid for rowid, _, origin_id in affected if origin_id not in dead_parents]
+            for rowids_chunk in chunks(alive_rowids, SQL_IN_CHUNK_SIZE):
+                for node in db.ChannelNode.select(lambda g: g.rowid in rowids_chunk):
+                    # Add the node to its parent's set of children
+                    children.setdefault(node.origin_id, set()).add(node)
             if not children or 0 not in children:
                 return {}
             return children
@@ -355,31 +366,51 @@ def define_binding(db):
             This procedure scans personal channels for collection nodes marked TODELETE and recursively removes
             their contents. The top-level nodes themselves are left intact so soft delete entries can be generated
             in the future.
+            The whole subtree of each such node is removed, at any depth, just like deleting its direct contents
+            with the recursive CollectionNode.delete would do. The nodes are found with a single recursive query
+            and deleted in bulk, instead of walking the tree node by node.
             This procedure should be always run _before_ committing personal channels.
             """
-            # TODO: optimize with SQL recursive CTEs
-
-            def get_highest_deleted_parent(node, highest_deleted_parent=None):
-                if node.origin_id == 0:
-                    return highest_deleted_parent
-                parent = db.CollectionNode.get(public_key=node.public_key, id_=node.origin_id)
-                if not parent:
-                    return highest_deleted_parent
-                if parent.status == TODELETE:
-                    highest_deleted_parent = parent
-                return get_highest_deleted_parent(parent, highest_deleted_parent)
-
-            deletion_set = {
-                get_highest_deleted_parent(node, highest_deleted_parent=node).rowid
-                for node in db.CollectionNode.select(
-                    lambda g: g.public_key == db.CollectionNode._my_key.pub().key_to_bin()[10:] and g.status == TODELETE
+            orm.flush()
+            public_key = database_blob(db.CollectionNode._my_key.pub().key_to_bin()[10:])
+            # First, we find the deleted collections that do not have deleted ancestors.
+            # Then, we get all the nodes in the subtrees rooted in these collections.
+            subnodes_rowids = db.execute(
+                """
+                WITH RECURSIVE deleted(rowid, id_, origin_id, top_rowid) AS (
+                    SELECT node.rowid, node.id_, node.origin_id, node.rowid FROM DirtyNodes, ChannelNode node
+                    WHERE node.rowid = DirtyNodes.rowid AND node.public_key = $public_key
+                    AND node.status = %i AND node.metadata_type IN (%i, %i)
+                ),
+                ancestors(rowid, origin_id, top_rowid) AS (
+                    SELECT rowid, origin_id, top_rowid FROM deleted
+                    UNION
+                    SELECT node.rowid, node.origin_id, ancestors.top_rowid FROM ChannelNode node, ancestors
+                    WHERE node.public_key = $public_key AND node.id_ = ancestors.origin_id
+                    AND node.metadata_type IN (%i, %i)
+                ),
+                highest_deleted(rowid, id_) AS (
+                    SELECT rowid, id_ FROM deleted WHERE NOT EXISTS (
+                        SELECT 1 FROM ancestors, ChannelNode node
+                        WHERE ancestors.top_rowid = deleted.rowid AND ancestors.rowid != deleted.rowid
+                        AND node.rowid = ancestors.rowid AND node.status = %i
+                    )
+                ),
+                subnodes(rowid, id_) AS (
+                    SELECT node.rowid, node.id_ FROM ChannelNode node, highest_deleted
+                    WHERE node.public_key = $public_key AND node.origin_id = highest_deleted.id_
+                    AND node.rowid != highest_deleted.rowid
+                    UNION
+                    SELECT node.rowid, node.id_ FROM ChannelNode node, subnodes
+                    WHERE node.public_key = $public_key AND node.origin_id = subnodes.id_
                 )
-                if node
-            }
+                SELECT rowid FROM subnodes
+                """
+                % ((TODELETE,) + (COLLECTION_NODE, CHANNEL_TORRENT) * 2 + (TODELETE,))
+            ).fetchall()
 
-            for node in [db.CollectionNode[rowid] for rowid in deletion_set]:
-                for subnode in node.contents:
-                    subnode.delete()
+            for rowids_chunk in chunks([rowid for (rowid,) in subnodes_rowids], SQL_IN_CHUNK_SIZE):
+                db.ChannelNode.select(lambda g: g.rowid in rowids_chunk).delete()
 
         @db_session
         def get_contents_to_commit(self):
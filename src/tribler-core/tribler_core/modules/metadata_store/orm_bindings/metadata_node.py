@@ -1,14 +1,149 @@
-import threading
-from asyncio import get_event_loop
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from functools import lru_cache
 
 from pony import orm
-from pony.orm import db_session, desc, raw_sql, select
+from pony.orm import db_session, desc, raw_sql, select  # noqa: F401, desc is referenced from the sort expressions
+from pony.orm.ormtypes import RawSQL
 
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import LEGACY_ENTRY, TODELETE
 from tribler_core.modules.metadata_store.orm_bindings.torrent_metadata import NULL_KEY_SUBST
-from tribler_core.modules.metadata_store.serialization import METADATA_NODE, MetadataNodePayload
+from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT, METADATA_NODE, MetadataNodePayload
 from tribler_core.utilities.unicode import hexlify
 
+# Boosts of the search rank of the healthy torrents and of the entries from popular channels.
+# Each boost multiplies the bm25 relevance by a factor between 1 and 1 + weight, so it can reorder the results of
+# similar relevance, but a popular entry does not outrank a much better text match.
+SEARCH_SEEDERS_WEIGHT = 0.5
+SEARCH_SEEDERS_HALF_BOOST = 10  # The number of seeders at which a torrent gets a half of the seeders boost
+SEARCH_VOTES_WEIGHT = 0.5
+
+# The number of the best text matches that a search considers. The filters, the deduplication and the popularity
+# boosts are only applied to these, so the cost of a search is bounded even for the terms that match most of the
+# entries (e.g. "video"). The filtered out candidates are not replaced, as in the searches of the earlier versions.
+SEARCH_MAX_CANDIDATES = 1000
+
+# The channel votes are looked up by the public key of the entry, and the channels are few, so they are collected
+# once per query. Entries without an infohash (e.g. collections) are never merged with each other.
+# SQLite refuses to compute bm25 inside of an aggregate query, so the candidates are taken, together with their bm25
+# relevance, from a subquery. Its LIMIT also prevents SQLite from flattening it into the outer query.
+sql_search_ranked = """
+    WITH ChannelVotes(public_key, votes) AS (
+        SELECT public_key, MAX(votes) FROM ChannelNode
+        WHERE metadata_type = $channel_type AND origin_id = 0
+        GROUP BY public_key)
+    SELECT rowid, MIN(rank) AS rank FROM (
+        SELECT cn.rowid AS rowid, cn.infohash AS infohash,
+            candidates.relevance * (1.0
+                + $seeders_weight * IFNULL(ts.seeders, 0) / (IFNULL(ts.seeders, 0) + $seeders_half_boost)
+                + $votes_weight * IFNULL(cv.votes, 0) / $votes_scaling) AS rank
+        FROM (
+            SELECT rowid, bm25(FtsIndex) AS relevance FROM FtsIndex
+            WHERE FtsIndex MATCH $txt_filter
+            ORDER BY relevance LIMIT $max_candidates) AS candidates
+        CROSS JOIN ChannelNode cn ON cn.rowid = candidates.rowid
+        LEFT JOIN TorrentState ts ON ts.rowid = cn.health
+        LEFT JOIN ChannelVotes cv ON cv.public_key = cn.public_key
+        WHERE %(conditions)s)
+    GROUP BY IFNULL(infohash, rowid)"""
+
+
+@lru_cache(maxsize=256)
+def compile_search_sql(conditions):
+    """
+    Assemble the full-text search query of MetadataNode.get_search_sql.
+    :param conditions: tuple of the filter conditions on the ChannelNode columns, aliased as "cn"
+    :return: SQL query text
+    """
+    return sql_search_ranked % {"conditions": " AND ".join(conditions)}
+
+
+@lru_cache(maxsize=256)
+def compile_entries_sql(conditions, search=False, ranked=False, keyset=None, order_by=(), columns=None):
+    """
+    Assemble the raw SQL query of MetadataNode.get_entries_sql.
+    The query text only depends on the shape of the get_entries parameters (which filters are set and how the entries
+    are sorted), but not on their values, so the result is cached per shape.
+    :param conditions: tuple of the filter conditions on the ChannelNode columns, aliased as "cn"
+    :param search: whether the entries must match a full-text search
+    :param ranked: order the entries by the search rank instead of order_by
+    :param keyset: the keyset pagination condition, or None
+    :param order_by: tuple of the SQL sort expressions
+    :param columns: the list of the columns to select, which may refer to the TorrentState of the entries aliased as
+        "ts", or None to select the ChannelNode columns
+    :return: SQL query text
+    """
+    # The keyset condition refers to the same columns as the sort expressions. Like in Pony queries, sorting by
+    # the health skips the entries that have no health
+    if any(expression.startswith("ts.") for expression in order_by) and not ranked:
+        join = " JOIN TorrentState ts ON ts.rowid = cn.health"
+    elif columns is not None:
+        join = " LEFT JOIN TorrentState ts ON ts.rowid = cn.health"
+    else:
+        join = ""
+
+    if ranked:
+        return (
+            "SELECT %s FROM (%s) AS matches CROSS JOIN ChannelNode cn ON cn.rowid = matches.rowid%s "
+            "ORDER BY matches.rank, matches.rowid LIMIT $limit OFFSET $offset"
+            % (columns or "cn.*", compile_search_sql(conditions), join)
+        )
+
+    # The search already applies the filters
+    where = ["cn.rowid IN (SELECT rowid FROM (%s))" % compile_search_sql(conditions)] if search else list(conditions)
+    if keyset is not None:
+        where.append(keyset)
+    return "SELECT %s FROM ChannelNode cn%s WHERE %s ORDER BY %s LIMIT $limit OFFSET $offset" % (
+        columns or "cn.*",
+        join,
+        " AND ".join(where),
+        ", ".join(order_by),
+    )
+
+
+def encode_cursor(values):
+    """
+    Pack the sort key values of an entry into an opaque cursor string that can be passed around in REST requests.
+    :param values: the list of sort key values (ints, floats, strings, bytes, datetimes or None)
+    :return: cursor string
+    """
+
+    def encode_value(value):
+        if isinstance(value, bytes):
+            return {"b": hexlify(value)}
+        if isinstance(value, datetime):
+            return {"d": value.isoformat()}
+        return value
+
+    return urlsafe_b64encode(json.dumps([encode_value(value) for value in values]).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """
+    Unpack a cursor string produced by encode_cursor.
+    :param cursor: cursor string
+    :return: the list of sort key values
+    :raises ValueError: if the cursor is malformed
+    """
+
+    def decode_value(value):
+        if isinstance(value, dict):
+            if "b" in value:
+                return bytes.fromhex(value["b"])
+            if "d" in value:
+                return datetime.fromisoformat(value["d"])
+            raise ValueError("Unknown cursor value type")
+        return value
+
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('utf-8')))
+    except (TypeError, UnicodeError, json.JSONDecodeError) as e:
+        raise ValueError("Malformed cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("Malformed cursor")
+    return [decode_value(value) for value in values]
+
 
 def define_binding(db):
     class MetadataNode(db.ChannelNode):
@@ -36,24 +171,151 @@ def define_binding(db):
         ][1:]
         nonpersonal_attributes = db.ChannelNode.nonpersonal_attributes + ('title', 'tags')
 
+        # QueryCache instance for the results of get_total_count. Set by the MetadataStore
+        _count_cache = None
+        # CompletionIndex instance for get_auto_complete_terms. Set by the MetadataStore
+        _completion_index = None
+
         @classmethod
-        def search_keyword(cls, query, lim=100):
-            # Requires FTS5 table "FtsIndex" to be generated and populated.
-            # FTS table is maintained automatically by SQL triggers.
-            # BM25 ranking is embedded in FTS5.
+        def get_sql_conditions(
+            cls,
+            alias="",
+            metadata_type=None,
+            channel_pk=None,
+            exclude_deleted=False,
+            hide_xxx=False,
+            exclude_legacy=False,
+            origin_id=None,
+            subscribed=None,
+            category=None,
+            attribute_ranges=None,
+            id_=None,
+        ):
+            """
+            Compile the get_entries filters into raw SQL conditions on the ChannelNode columns.
+            All the values are passed as parameters, so the text of the query only depends on the set of the filters
+            used, and SQLite can reuse the prepared statement.
+            :param alias: the prefix of the column names, e.g. "cn."
+            :return: (conditions, params) tuple, where conditions is the list of SQL expressions and params is the dict
+                of the values they refer to
+            """
+            metadata_types = cls.get_metadata_types(metadata_type)
 
+            # Only integers are put into the query text
+            conditions = ["%smetadata_type IN (%s)" % (alias, ", ".join(str(int(t)) for t in sorted(metadata_types)))]
+            params = {}
+            if channel_pk is not None:
+                conditions.append(alias + "public_key = $public_key")
+                params["public_key"] = b"" if channel_pk == NULL_KEY_SUBST else channel_pk
+            if origin_id is not None:
+                conditions.append(alias + "origin_id = $origin_id")
+                params["origin_id"] = origin_id
+            if id_ is not None:
+                conditions.append(alias + "id_ = $id_")
+                params["id_"] = id_
+            if subscribed is not None:
+                conditions.append(alias + "subscribed != 0")
+            if category:
+                conditions.append(alias + "tags = $category")
+                params["category"] = category
+            if exclude_deleted:
+                conditions.append("%sstatus != %i" % (alias, TODELETE))
+            if hide_xxx:
+                conditions.append(alias + "xxx = 0")
+            if exclude_legacy:
+                conditions.append("%sstatus != %i" % (alias, LEGACY_ENTRY))
+            for index, (attr, left, right) in enumerate(attribute_ranges or []):
+                column = cls.get_attribute(attr).column
+                if left is not None:
+                    conditions.append('%s"%s" >= $range_left_%i' % (alias, column, index))
+                    params["range_left_%i" % index] = left
+                if right is not None:
+                    conditions.append('%s"%s" < $range_right_%i' % (alias, column, index))
+                    params["range_right_%i" % index] = right
+            return conditions, params
+
+        @classmethod
+        def get_metadata_types(cls, metadata_type=None):
+            """
+            Get the set of the metadata types of the entries that get_entries selects.
+            :param metadata_type: the metadata_type filter of get_entries, either a single type or a list of them
+            """
+            metadata_types = {cls._discriminator_} | {subclass._discriminator_ for subclass in cls._subclasses_}
+            if metadata_type is not None:
+                try:
+                    metadata_types &= set(metadata_type)
+                except TypeError:
+                    metadata_types &= {metadata_type}
+            return metadata_types
+
+        @classmethod
+        def get_search_sql(cls, txt_filter, **kwargs):
+            """
+            Compile a full-text search, together with the get_entries filters, into a single SQL query.
+            FtsIndex is the driving table of the query, so only the SEARCH_MAX_CANDIDATES best text matches are
+            looked up and checked against the filters. The matches are then deduplicated by infohash, keeping the best
+            ranked entry of each torrent.
+            The rank is the bm25 relevance of the title, boosted by the number of seeders of the torrent and by the
+            votes of its channel. As bm25 is negative, the lower the rank, the better the match.
+            :return: (sql, params) tuple, where sql is the query selecting the (rowid, rank) pairs of the matches
+            """
+            conditions, params = cls.get_sql_conditions(alias="cn.", **kwargs)
+            params.update(cls.get_search_params(txt_filter))
+            return compile_search_sql(tuple(conditions)), params
+
+        @staticmethod
+        def get_search_params(txt_filter):
+            """
+            Get the values of the parameters of the search query, except for the filters.
+            """
+            return {
+                "txt_filter": txt_filter,
+                "max_candidates": SEARCH_MAX_CANDIDATES,
+                "channel_type": CHANNEL_TORRENT,
+                "seeders_weight": SEARCH_SEEDERS_WEIGHT,
+                "seeders_half_boost": SEARCH_SEEDERS_HALF_BOOST,
+                "votes_weight": SEARCH_VOTES_WEIGHT,
+                "votes_scaling": db.ChannelMetadata.votes_scaling or 1.0,
+            }
+
+        @classmethod
+        def search_keyword(cls, query, lim=100, **kwargs):
+            """
+            Full-text search for entries.
+            Requires FTS5 table "FtsIndex" to be generated and populated.
+            FTS table is maintained automatically by SQL triggers.
+            :param query: FTS5 query string
+            :param lim: the maximum number of the best ranked matches to select, or None to select all of them (still at
+                most SEARCH_MAX_CANDIDATES)
+            :param kwargs: additional get_entries filters to apply before deduplicating the matches
+            :return: PonyORM query object selecting the matches
+            """
             # Sanitize FTS query
             if not query or query == "*":
                 return []
 
-            # !!! FIXME !!! Fix GROUP BY for entries without infohash !!!
-            # TODO: optimize this query by removing unnecessary select nests (including Pony-manages selects)
-            fts_ids = raw_sql(
-                """SELECT rowid FROM ChannelNode WHERE rowid IN (SELECT rowid FROM FtsIndex WHERE FtsIndex MATCH $query
-                ORDER BY bm25(FtsIndex) LIMIT $lim) GROUP BY infohash"""
-            )
+            sql, params = cls.get_search_sql(query, **kwargs)
+            if lim is not None:
+                sql = "SELECT rowid FROM (%s ORDER BY rank LIMIT $lim)" % sql
+                params["lim"] = lim
+            else:
+                sql = "SELECT rowid FROM (%s)" % sql
+            fts_ids = RawSQL(sql, globals(), params)
             return cls.select(lambda g: g.rowid in fts_ids)
 
+        @classmethod
+        def search_ranked(cls, txt_filter, first=1, last=None, **kwargs):
+            """
+            Full-text search for entries, ordered by the rank of get_search_sql. The whole search, including the
+            filters, the deduplication, the ranking and the paging, runs as a single SQL query.
+            :return: list of the matching entries
+            """
+            if not txt_filter or txt_filter == "*":
+                return []
+
+            sql, params = cls.get_entries_sql(first=first, last=last, txt_filter=txt_filter, **kwargs)
+            return cls.select_by_sql(sql, globals(), params)
+
         @classmethod
         @db_session
         def get_entries_query(
@@ -79,7 +341,24 @@ def define_binding(db):
             """
             # Warning! For Pony magic to work, iteration variable name (e.g. 'g') should be the same everywhere!
 
-            pony_query = cls.search_keyword(txt_filter, lim=1000) if txt_filter else select(g for g in cls)
+            if txt_filter:
+                # The filters must be applied before deduplicating the matches, so they are passed to the search too
+                pony_query = cls.search_keyword(
+                    txt_filter,
+                    lim=None,
+                    metadata_type=metadata_type,
+                    channel_pk=channel_pk,
+                    exclude_deleted=exclude_deleted,
+                    hide_xxx=hide_xxx,
+                    exclude_legacy=exclude_legacy,
+                    origin_id=origin_id,
+                    subscribed=subscribed,
+                    category=category,
+                    attribute_ranges=attribute_ranges,
+                    id_=id_,
+                )
+            else:
+                pony_query = select(g for g in cls)
 
             if metadata_type is not None:
                 try:
@@ -110,83 +389,400 @@ def define_binding(db):
             pony_query = pony_query.where(lambda g: g.xxx == 0) if hide_xxx else pony_query
             pony_query = pony_query.where(lambda g: g.status != LEGACY_ENTRY) if exclude_legacy else pony_query
 
-            # Sort the query
-            if sort_by == "HEALTH":
-                pony_query = (
-                    pony_query.sort_by("(desc(g.health.seeders), desc(g.health.leechers))")
-                    if sort_desc
-                    else pony_query.sort_by("(g.health.seeders, g.health.leechers)")
-                )
+            # Sort the query. The rowid is always added as the last sort key, so the order is strict and
+            # the results can be paged with cursors
+            sort_expression = ", ".join(
+                ("desc(%s)" % key) if key_desc else key
+                for key, key_desc in cls.get_sort_keys(sort_by, sort_desc, txt_filter)
+            )
+            pony_query = pony_query.sort_by(sort_expression)
+
+            return pony_query
+
+        @classmethod
+        def get_sort_keys(cls, sort_by=None, sort_desc=True, txt_filter=None):
+            """
+            Get the list of the sort key expressions that the results are ordered by.
+            :param txt_filter: the search query of get_entries, if any
+            :return: list of (sort_key, descending) tuples
+            """
+            if not sort_by:
+                sort_keys = []
+            elif sort_by == "HEALTH":
+                sort_keys = ["g.health.seeders", "g.health.leechers"]
             elif sort_by == "size" and not issubclass(cls, db.ChannelMetadata):
                 # TODO: optimize this check to skip cases where size field does not matter
                 # When querying for mixed channels / torrents lists, channels should have priority over torrents
-                sort_expression = "desc(g.num_entries), desc(g.size)" if sort_desc else "g.num_entries, g.size"
-                pony_query = pony_query.sort_by(sort_expression)
-            elif sort_by:
-                sort_expression = "g." + sort_by
-                sort_expression = desc(sort_expression) if sort_desc else sort_expression
-                pony_query = pony_query.sort_by(sort_expression)
+                sort_keys = ["g.num_entries", "g.size"]
+            else:
+                sort_keys = ["g." + sort_by]
+            result = [(key, bool(sort_desc)) for key in sort_keys]
+            # Ties are broken in the table order. Listings are read from the (..., rowid) indexes of the entries, so
+            # the rowid goes in the same direction as the other keys. Search results are picked from FtsIndex and
+            # sorted anyway, so they keep the ascending table order, i.e. the older entries come first
+            if "g.rowid" not in sort_keys:
+                result.append(("g.rowid", bool(sort_desc) if sort_keys and not txt_filter else False))
+            return result
 
-            return pony_query
+        @classmethod
+        def get_entry_cursor(cls, entry, sort_by=None, sort_desc=True, txt_filter=None, **kwargs):
+            """
+            Get the cursor pointing at the position of the given entry in the results of get_entries.
+            :param entry: the entry, usually the last one of the results page
+            :return: cursor string
+            """
+            values = []
+            for key, _ in cls.get_sort_keys(sort_by, sort_desc, txt_filter):
+                value = entry
+                for attr in key.split(".")[1:]:
+                    # Entries of different types are stored in the same table, so some of them can lack the attribute
+                    value = getattr(value, attr, None)
+                values.append(value)
+            return encode_cursor(values)
 
         @classmethod
-        async def get_entries_threaded(cls, **kwargs):
-            def _get_results():
-                result = cls.get_entries(**kwargs)
-                if not isinstance(threading.current_thread(), threading._MainThread):
-                    db.disconnect()
-                return result
+        def get_keyset_condition(
+            cls, cursor, sort_by=None, sort_desc=True, sql=False, metadata_type=None, txt_filter=None
+        ):
+            """
+            Build the condition selecting the entries that come after the cursor position in the sort order.
+            SQLite puts NULLs first in the ascending order and last in the descending one, so these are handled
+            explicitly.
+            In raw SQL, the trailing sort keys are compared as a single row value, e.g. (size, rowid) < (?, ?), which
+            SQLite turns into a range scan of the matching (origin_id, ..., rowid) index. This is only done where
+            no entries can be skipped: the NULLs are already behind the cursor in the ascending order, and
+            in the descending order the sort column must be set for all the entries of the selected types.
+            :param sql: build a raw SQL condition for get_entries_sql instead of a Pony expression
+            :param metadata_type: the metadata_type filter of get_entries
+            :param txt_filter: the search query of get_entries, if any
+            :return: (condition, params) tuple, where condition is a Pony expression string (or raw SQL) and params is
+                the dict of the values it refers to
+            """
+            sort_keys = cls.get_sort_keys(sort_by, sort_desc, txt_filter)
+            values = decode_cursor(cursor)
+            if len(values) != len(sort_keys):
+                raise ValueError("Cursor does not match the sort order")
 
-            return await get_event_loop().run_in_executor(None, _get_results)
+            metadata_types = cls.get_metadata_types(metadata_type)
+            params = {}
+            condition = None
+            # The trailing sort keys compared as a row value. They all must be sorted in the same direction
+            row_columns, row_params, row_operator = [], [], None
+            for index in reversed(range(len(sort_keys))):
+                (key, key_desc), value, param = sort_keys[index], values[index], "cursor_value_%i" % index
+                params[param] = value
+                operator = "<" if key_desc else ">"
+                if sql:
+                    column = cls.get_sort_key_column(key)
+                    if value is not None:
+                        # The values must be compared in the same form as they are stored, e.g. datetime strings
+                        params[param] = cls.get_sort_key_attribute(key)[1].converters[0].py2sql(value)
+                    if row_columns is not None:
+                        if (
+                            value is not None
+                            and operator == (row_operator or operator)
+                            and (not key_desc or cls.is_sort_key_set(key, metadata_types))
+                        ):
+                            row_columns.insert(0, column)
+                            row_params.insert(0, "$" + param)
+                            row_operator = operator
+                            continue
+                        if row_columns:
+                            condition = cls.get_row_value_condition(row_columns, row_params, row_operator)
+                        row_columns = None
+                    beyond = "%s %s $%s" % (column, operator, param)
+                    is_null, is_not_null = "%s IS NULL" % column, "%s IS NOT NULL" % column
+                    equals = "%s = $%s" % (column, param)
+                    and_, or_ = "AND", "OR"
+                else:
+                    # Pony refuses to compare blobs, so the binary columns (e.g. infohash) are compared in raw SQL
+                    if isinstance(value, bytes):
+                        beyond = "raw_sql('\"g\".\"%s\" %s $%s')" % (key.split(".")[-1], operator, param)
+                    else:
+                        beyond = "%s %s %s" % (key, operator, param)
+                    is_null, is_not_null, equals = "%s is None" % key, "%s is not None" % key, "%s == %s" % (key, param)
+                    and_, or_ = "and", "or"
+                if condition is None:
+                    # The rowid is never NULL
+                    condition = beyond
+                elif value is None:
+                    condition = (
+                        "(%s %s %s)" % (is_null, and_, condition)
+                        if key_desc
+                        else "(%s %s (%s %s %s))" % (is_not_null, or_, is_null, and_, condition)
+                    )
+                else:
+                    condition = (
+                        "(%s %s %s %s (%s %s %s))" % (beyond, or_, is_null, or_, equals, and_, condition)
+                        if key_desc
+                        else "(%s %s (%s %s %s))" % (beyond, or_, equals, and_, condition)
+                    )
+            if row_columns:
+                condition = cls.get_row_value_condition(row_columns, row_params, row_operator)
+            return condition, params
+
+        @staticmethod
+        def get_row_value_condition(columns, params, operator):
+            """
+            Compare the columns to the parameters as a single row value, e.g. (size, rowid) < ($p1, $p2).
+            """
+            if len(columns) == 1:
+                return "%s %s %s" % (columns[0], operator, params[0])
+            return "(%s) %s (%s)" % (", ".join(columns), operator, ", ".join(params))
+
+        @classmethod
+        def is_sort_key_set(cls, key, metadata_types):
+            """
+            Check if the sort key is set (i.e. not NULL) for all the entries of the given metadata types. The entries
+            of the different types are stored in the same table, so the attributes of a subclass are NULL for the
+            entries of the other ones. The health attributes are always set, as sorting by health skips the entries
+            that have no health.
+            """
+            alias, attr = cls.get_sort_key_attribute(key)
+            if alias == "ts":
+                return True
+            entity = attr.entity
+            return metadata_types <= {entity._discriminator_} | {sub._discriminator_ for sub in entity._subclasses_}
+
+        @classmethod
+        def get_sort_key_column(cls, key):
+            """
+            Translate a sort key expression of get_sort_keys into the raw SQL column it refers to. The ChannelNode
+            table is aliased as "cn", and the TorrentState table as "ts".
+            """
+            alias, attr = cls.get_sort_key_attribute(key)
+            return '%s."%s"' % (alias, attr.column)
+
+        @classmethod
+        def get_sort_key_attribute(cls, key):
+            """
+            Get the Pony attribute that a sort key expression of get_sort_keys refers to.
+            :return: (table_alias, attribute) tuple
+            """
+            path = key.split(".")[1:]
+            if path[0] == "health":
+                return "ts", cls.get_attribute(path[1], entity=db.TorrentState)
+            return "cn", cls.get_attribute(path[0])
+
+        @classmethod
+        def get_attribute(cls, attr, entity=None):
+            """
+            Get the Pony attribute by its name. Like in Pony queries, the attributes of the subclasses can be used too.
+            :param entity: the entity to look the attribute up in, instead of this class
+            :raises AttributeError: if there is no such attribute. This also checks the name against code injection.
+            """
+            entity = entity or cls
+            for subclass in [entity] + list(entity._subclasses_):
+                if attr in subclass._adict_:
+                    return subclass._adict_[attr]
+            raise AttributeError("%s has no attribute %s" % (entity.__name__, attr))
+
+        @classmethod
+        def get_entries_sql(
+            cls, first=1, last=None, cursor=None, sort_by=None, sort_desc=True, txt_filter=None, columns=None, **kwargs
+        ):
+            """
+            Compile the get_entries query into raw SQL, bypassing the Pony query translation.
+            The query text is cached per shape of the parameters by compile_entries_sql, and the values are passed as
+            query parameters, so SQLite can reuse the prepared statements too.
+            :param columns: the list of the columns to select (see compile_entries_sql). The values of the sort keys
+                are then selected as well, as "sort_key_0", "sort_key_1", etc., so the rows can be pointed at by
+                get_row_cursor.
+            :return: (sql, params) tuple
+            """
+            conditions, params = cls.get_sql_conditions(alias="cn.", **kwargs)
+            if txt_filter:
+                params.update(cls.get_search_params(txt_filter))
+
+            keyset = None
+            first = first or 1
+            if cursor is not None:
+                keyset, cursor_params = cls.get_keyset_condition(
+                    cursor,
+                    sort_by,
+                    sort_desc,
+                    sql=True,
+                    metadata_type=kwargs.get("metadata_type"),
+                    txt_filter=txt_filter,
+                )
+                params.update(cursor_params)
+                # With a cursor, first and last only determine the page size
+                last, first = (last - first + 1 if last else None), 1
+            params.update(limit=-1 if last is None else max(last - first + 1, 0), offset=first - 1)
+
+            sort_columns = [
+                (cls.get_sort_key_column(key), key_desc)
+                for key, key_desc in cls.get_sort_keys(sort_by, sort_desc, txt_filter)
+            ]
+            if columns is not None:
+                columns = ", ".join(
+                    [columns] + ["%s AS sort_key_%i" % (column, i) for i, (column, _) in enumerate(sort_columns)]
+                )
+            sql = compile_entries_sql(
+                tuple(conditions),
+                search=bool(txt_filter),
+                ranked=cls.is_ranked_search(txt_filter=txt_filter, sort_by=sort_by, cursor=cursor),
+                keyset=keyset,
+                order_by=tuple("%s %s" % (column, "DESC" if key_desc else "ASC") for column, key_desc in sort_columns),
+                columns=columns,
+            )
+            return sql, params
+
+        @staticmethod
+        def is_ranked_search(txt_filter=None, sort_by=None, cursor=None, **_):
+            """
+            Check if get_entries returns the results in the order of the search rank, which cursors can't point into.
+            """
+            return bool(txt_filter) and not sort_by and cursor is None
+
+        @classmethod
+        def get_row_cursor(cls, row, sort_by=None, sort_desc=True, txt_filter=None, **kwargs):
+            """
+            Get the cursor pointing at the position of the given row, selected by get_entries_sql with the columns
+            argument, in the results of get_entries.
+            :return: cursor string
+            """
+            values = []
+            for index, (key, _) in enumerate(cls.get_sort_keys(sort_by, sort_desc, txt_filter)):
+                value = getattr(row, "sort_key_%i" % index)
+                if value is not None:
+                    # Convert the raw SQL values (e.g. datetime strings) into the types of the attributes
+                    value = cls.get_sort_key_attribute(key)[1].converters[0].sql2py(value)
+                values.append(value)
+            return encode_cursor(values)
 
         @classmethod
         @db_session
-        def get_entries(cls, first=1, last=None, **kwargs):
+        def get_entries(cls, first=1, last=None, cursor=None, **kwargs):
             """
             Get some torrents. Optionally sort the results by a specific field, or filter the channels based
             on a keyword/whether you are subscribed to it.
+            If a cursor is given, the page starts right after the entry the cursor points at, and first/last only
+            determine the page size. Contrary to OFFSET-based paging, this does not slow down on the deep pages.
             :return: A list of class members
             """
+            if cls.is_ranked_search(cursor=cursor, **kwargs):
+                # Search results are ordered by relevance, which the ranked search query computes on its own
+                kwargs.pop("sort_by", None)
+                kwargs.pop("sort_desc", None)
+                return cls.search_ranked(first=first or 1, last=last, **kwargs)
+
             pony_query = cls.get_entries_query(**kwargs)
-            return pony_query[(first or 1) - 1 : last]
+            if cursor is None:
+                return pony_query[(first or 1) - 1 : last]
+
+            condition, params = cls.get_keyset_condition(
+                cursor,
+                sort_by=kwargs.get("sort_by"),
+                sort_desc=kwargs.get("sort_desc", True),
+                txt_filter=kwargs.get("txt_filter"),
+            )
+            pony_query = pony_query.where(condition, globals(), params)
+            return pony_query[: last - (first or 1) + 1] if last else pony_query[:]
+
+        @classmethod
+        @db_session
+        def get_entries_rows(cls, **kwargs):
+            """
+            Light version of get_entries for read-only uses. The query runs as raw SQL compiled by get_entries_sql,
+            and the results are returned as plain rows of the ChannelNode columns instead of entity objects.
+            :return: list of row tuples, with the columns also accessible as attributes
+            """
+            if kwargs.get("txt_filter") == "*":
+                return []
+            sql, params = cls.get_entries_sql(**kwargs)
+            return db.select(sql, globals(), params)
+
+        @staticmethod
+        def get_generation():
+            """
+            Get the generation counter of the entries. It is bumped by SQL triggers on every change to the entries
+            that can affect the results of get_entries queries.
+            """
+            return db.select("value FROM ChannelNodeGeneration")[0]
 
         @classmethod
         @db_session
         def get_total_count(cls, **kwargs):
             """
             Get total count of torrents that would be returned if there would be no pagination/limits/sort
+            The result is taken from the count cache or the per-channel counts table whenever possible.
             """
-            for p in ["first", "last", "sort_by", "sort_desc"]:
+            for p in ["first", "last", "sort_by", "sort_desc", "cursor"]:
                 kwargs.pop(p, None)
-            return cls.get_entries_query(**kwargs).count()
+
+            def count_entries():
+                count = cls.get_counts_table_count(**kwargs)
+                return count if count is not None else cls.get_entries_query(**kwargs).count()
+
+            # The counts of uncommitted changes can't be attributed to a generation
+            if cls._count_cache is None or db._get_cache().modified:
+                return count_entries()
+            cache_key = (cls.__name__, tuple(sorted(kwargs.items())))
+            try:
+                hash(cache_key)
+            except TypeError:
+                return count_entries()
+
+            generation = cls.get_generation()
+            count = cls._count_cache.get(cache_key, generation)
+            if count is None:
+                count = count_entries()
+                cls._count_cache.put(cache_key, generation, count)
+            return count
+
+        @classmethod
+        def get_counts_table_count(
+            cls,
+            metadata_type=None,
+            channel_pk=None,
+            exclude_deleted=False,
+            hide_xxx=False,
+            exclude_legacy=False,
+            origin_id=None,
+            subscribed=None,
+            txt_filter=None,
+            category=None,
+            attribute_ranges=None,
+            id_=None,
+        ):
+            """
+            Count the entries using the per-channel counts table maintained by SQL triggers.
+            :return: the count, or None if the query uses filters that are not covered by the counts table
+            """
+            if txt_filter or category or attribute_ranges or id_ is not None:
+                return None
+
+            conditions, params = cls.get_sql_conditions(
+                metadata_type=metadata_type,
+                channel_pk=channel_pk,
+                exclude_deleted=exclude_deleted,
+                hide_xxx=hide_xxx,
+                exclude_legacy=exclude_legacy,
+                origin_id=origin_id,
+                subscribed=subscribed,
+            )
+            return db.select(
+                "IFNULL(SUM(count), 0) FROM ChannelNodeCounts WHERE " + " AND ".join(conditions), globals(), params
+            )[0]
 
         @classmethod
         @db_session
         def get_entries_count(cls, **kwargs):
-            for p in ["first", "last"]:
+            for p in ["first", "last", "cursor"]:
                 kwargs.pop(p, None)
             return cls.get_entries_query(**kwargs).count()
 
         @classmethod
-        def get_auto_complete_terms(cls, keyword, max_terms, limit=10):
+        @db_session
+        def get_auto_complete_terms(cls, keyword, max_terms):
+            """
+            Get the completions of the last word of the keyword, ranked by the number of entries containing them.
+            """
             if not keyword:
                 return []
-
-            with db_session:
-                result = cls.search_keyword("\"" + keyword + "\"*", lim=limit)[:]
-            titles = [g.title.lower() for g in result]
-
-            # Copy-pasted from the old DBHandler (almost) completely
-            all_terms = set()
-            for line in titles:
-                if len(all_terms) >= max_terms:
-                    break
-                i1 = line.find(keyword)
-                i2 = line.find(' ', i1 + len(keyword))
-                term = line[i1:i2] if i2 >= 0 else line[i1:]
-                if term != keyword:
-                    all_terms.add(term)
-            return list(all_terms)
+            cls._completion_index.update(cls.get_generation())
+            return cls._completion_index.complete(keyword, max_terms)
 
         def to_simple_dict(self):
             """
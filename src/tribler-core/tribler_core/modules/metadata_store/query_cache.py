@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """
+    A thread-safe LRU cache for the results of database queries.
+    Each result is stored together with the database generation it was computed at. The generation is bumped on every
+    change to the relevant tables, so a result becomes stale as soon as the database changes, and is never returned
+    after that. Optionally, the results also expire after a while, for the cases when they depend on data that does not
+    bump the generation (e.g. the torrents health).
+    """
+
+    def __init__(self, max_size=256, ttl=None):
+        """
+        :param max_size: the maximum number of results to keep. Zero disables the cache
+        :param ttl: the number of seconds after which the results expire, or None if they never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        """
+        Get the cached result for the given key.
+        :param key: the (hashable) query key
+        :param generation: the current database generation
+        :return: the cached result, or None if there is no valid result for this generation
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation or (entry[1] is not None and entry[1] < time.monotonic()):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, generation, value):
+        """
+        Store a query result computed at the given database generation.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (generation, expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Get the statistics of the cache, e.g. for debugging.
+        """
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __len__(self):
+        return len(self._entries)
@@ -15,7 +15,10 @@ from pony.orm import db_session
 
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import DIRTY_STATUSES, NEW
-from tribler_core.modules.metadata_store.restapi.metadata_endpoint_base import MetadataEndpointBase
+from tribler_core.modules.metadata_store.restapi.metadata_endpoint_base import (
+    MetadataEndpointBase,
+    NDJSON_FORMAT_PARAMETER,
+)
 from tribler_core.modules.metadata_store.restapi.metadata_schema import ChannelSchema
 from tribler_core.restapi.rest_endpoint import HTTP_BAD_REQUEST, HTTP_NOT_FOUND, RESTResponse
 from tribler_core.restapi.schema import HandledErrorSchema
@@ -54,6 +57,7 @@ class ChannelsEndpoint(ChannelsEndpointBase):
     @docs(
         tags=['Metadata'],
         summary='Get a list of all channels known to the system.',
+        parameters=[NDJSON_FORMAT_PARAMETER],
         responses={
             200: {
                 'schema': schema(GetChannelsResponse={
@@ -62,7 +66,8 @@ class ChannelsEndpoint(ChannelsEndpointBase):
                     'last': Integer(),
                     'sort_by': String(),
                     'sort_desc': Integer(),
-                    'total': Integer()
+                    'total': Integer(),
+                    'next_cursor': String()
                 })
             }
         }
@@ -73,11 +78,17 @@ class ChannelsEndpoint(ChannelsEndpointBase):
         sanitized['subscribed'] = None if 'subscribed' not in request.query else bool(int(request.query['subscribed']))
         include_total = request.query.get('include_total', '')
         sanitized.update({"origin_id": 0})
+        if self.is_stream_request(request.query):
+            return await self.stream_entries(request, sanitized, self.session.mds.ChannelMetadata)
 
         with db_session:
-            channels = self.session.mds.ChannelMetadata.get_entries(**sanitized)
+            try:
+                channels_list, next_cursor = self.session.mds.get_entries_json(
+                    self.session.mds.ChannelMetadata, **sanitized
+                )
+            except ValueError as e:
+                return RESTResponse({"error": str(e)}, status=HTTP_BAD_REQUEST)
             total = self.session.mds.ChannelMetadata.get_total_count(**sanitized) if include_total else None
-            channels_list = [channel.to_simple_dict() for channel in channels]
         response_dict = {
             "results": channels_list,
             "first": sanitized["first"],
@@ -87,11 +98,14 @@ class ChannelsEndpoint(ChannelsEndpointBase):
         }
         if total is not None:
             response_dict.update({"total": total})
+        if next_cursor is not None:
+            response_dict.update({"next_cursor": next_cursor})
         return RESTResponse(response_dict)
 
     @docs(
         tags=['Metadata'],
         summary='Get a list of the channel\'s contents (torrents/channels/etc.).',
+        parameters=[NDJSON_FORMAT_PARAMETER],
         responses={
             200: {
                 'schema': schema(GetChannelContentsResponse={
@@ -100,7 +114,8 @@ class ChannelsEndpoint(ChannelsEndpointBase):
                     'last': Integer(),
                     'sort_by': String(),
                     'sort_desc': Integer(),
-                    'total': Integer()
+                    'total': Integer(),
+                    'next_cursor': String()
                 })
             }
         }
@@ -110,9 +125,13 @@ class ChannelsEndpoint(ChannelsEndpointBase):
         include_total = request.query.get('include_total', '')
         channel_pk, channel_id = self.get_channel_from_request(request)
         sanitized.update({"channel_pk": channel_pk, "origin_id": channel_id})
+        if self.is_stream_request(request.query):
+            return await self.stream_entries(request, sanitized)
         with db_session:
-            contents = self.session.mds.MetadataNode.get_entries(**sanitized)
-            contents_list = [c.to_simple_dict() for c in contents]
+            try:
+                contents_list, next_cursor = self.session.mds.get_entries_json(**sanitized)
+            except ValueError as e:
+                return RESTResponse({"error": str(e)}, status=HTTP_BAD_REQUEST)
             total = self.session.mds.MetadataNode.get_total_count(**sanitized) if include_total else None
         response_dict = {
             "results": contents_list,
@@ -123,6 +142,8 @@ class ChannelsEndpoint(ChannelsEndpointBase):
         }
         if total is not None:
             response_dict.update({"total": total})
+        if next_cursor is not None:
+            response_dict.update({"next_cursor": next_cursor})
 
         return RESTResponse(response_dict)
 
@@ -43,6 +43,8 @@ class UpdateEntryMixin(object):
 class MetadataEndpoint(MetadataEndpointBase, UpdateEntryMixin):
     """
     This is the top-level endpoint class that serves other endpoints.
+    It only returns single entries, so there is no NDJSON streaming mode here: the listings of entries,
+    and their streaming, are served by the /channels and /search endpoints.
 
     # /metadata
     #          /channels
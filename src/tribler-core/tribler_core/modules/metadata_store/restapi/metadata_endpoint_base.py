@@ -1,5 +1,7 @@
+import json
+
 from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT, COLLECTION_NODE, REGULAR_TORRENT
-from tribler_core.restapi.rest_endpoint import RESTEndpoint
+from tribler_core.restapi.rest_endpoint import HTTP_BAD_REQUEST, RESTEndpoint, RESTResponse, RESTStreamResponse
 
 json2pony_columns = {
     'category': "tags",
@@ -26,7 +28,26 @@ metadata_type_to_search_scope = {
 }
 
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+NDJSON_FORMAT_PARAMETER = {
+    'in': 'query',
+    'name': 'format',
+    'description': 'Set to "ndjson" to stream all the results (up to "last", if given) as newline-delimited JSON, '
+                   'one entry per line',
+    'type': 'string',
+    'required': False,
+}
+
+
 class MetadataEndpointBase(RESTEndpoint):
+    @staticmethod
+    def is_stream_request(parameters):
+        """
+        Check if the client asked for the results to be streamed as NDJSON, instead of a single JSON document.
+        """
+        return parameters.get('format') == 'ndjson'
+
     @classmethod
     def sanitize_parameters(cls, parameters):
         """
@@ -42,6 +63,8 @@ class MetadataEndpointBase(RESTEndpoint):
             "category": parameters.get('category'),
             "exclude_deleted": bool(int(parameters.get('exclude_deleted', 0)) > 0),
         }
+        if 'cursor' in parameters:
+            sanitized["cursor"] = parameters['cursor']
         if 'remote_query' in parameters:
             sanitized["remote_query"] = (bool(int(parameters.get('remote_query', 0)) > 0),)
         if 'metadata_type' in parameters:
@@ -50,3 +73,33 @@ class MetadataEndpointBase(RESTEndpoint):
                 mtypes.extend(metadata_type_to_search_scope[arg])
             sanitized['metadata_type'] = frozenset(mtypes)
         return sanitized
+
+    @staticmethod
+    def _entries_to_ndjson(entries):
+        return "".join(json.dumps(entry) + "\n" for entry in entries).encode('utf-8')
+
+    async def stream_entries(self, request, sanitized, entity=None):
+        """
+        Stream the entries as NDJSON: one JSON object per line, written as soon as the chunk containing the entry
+        is fetched from the DB. Contrary to the regular responses, all the entries are streamed unless the "last"
+        parameter is given, so whole channels can be exported without keeping them in memory.
+        """
+        if 'last' not in request.query:
+            sanitized['last'] = None
+        chunks = self.session.mds.iter_entries_json(entity, **sanitized)
+        try:
+            # The first chunk is fetched before the response is started, so the errors are still reported properly
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            chunk = []
+        except ValueError as e:
+            return RESTResponse({"error": str(e)}, status=HTTP_BAD_REQUEST)
+
+        response = RESTStreamResponse(headers={'Content-Type': NDJSON_CONTENT_TYPE})
+        await response.prepare(request)
+        if chunk:
+            await response.write(self._entries_to_ndjson(chunk))
+            async for chunk in chunks:
+                await response.write(self._entries_to_ndjson(chunk))
+        await response.write_eof()
+        return response
@@ -5,6 +5,8 @@ from marshmallow.fields import Boolean, Float, Integer, List, String
 class MetadataParameters(Schema):
     first = Integer(default=1, description='Limit the range of the query')
     last = Integer(default=50, description='Limit the range of the query')
+    cursor = String(description='Return the results that follow the entry this cursor (next_cursor from the '
+                                'previous page) points at. In this case, first and last only set the page size')
     sort_by = String(description='Sorts results in forward or backward, based on column name (e.g. "id" vs "-id")')
     sort_desc = Boolean(default=True)
     txt_filter = String(description='FTS search on the chosen word* terms')
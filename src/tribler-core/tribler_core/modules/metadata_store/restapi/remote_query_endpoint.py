@@ -26,6 +26,8 @@ class RemoteQueryEndpoint(MetadataEndpointBase):
     def sanitize_parameters(self, parameters):
         sanitized = super(RemoteQueryEndpoint, self).sanitize_parameters(parameters)
         sanitized.update({'uuid': parameters['uuid'], 'channel_pk': unhexlify(parameters.get('channel_pk', ""))})
+        # Cursors only make sense for the local database
+        sanitized.pop('cursor', None)
         return sanitized
 
     @docs(
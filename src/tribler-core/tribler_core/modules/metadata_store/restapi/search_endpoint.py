@@ -1,4 +1,4 @@
-import asyncio
+from binascii import unhexlify
 
 from aiohttp import web
 
@@ -51,7 +51,8 @@ class SearchEndpoint(MetadataEndpointBase):
                             'type': String,
                         })
                     ],
-                    'chant_dirty': Boolean
+                    'chant_dirty': Boolean,
+                    'next_cursor': String
                 })
             }
         }
@@ -68,20 +69,29 @@ class SearchEndpoint(MetadataEndpointBase):
 
         include_total = request.query.get('include_total', '')
 
+        def search():
+            search_results, next_cursor = self.session.mds.get_entries_json(**sanitized)
+            total = self.session.mds.MetadataNode.get_total_count(**sanitized) if include_total else None
+            return search_results, total, next_cursor
+
         def search_db():
             with db_session:
-                pony_query = self.session.mds.MetadataNode.get_entries(**sanitized)
-                total = self.session.mds.MetadataNode.get_total_count(**sanitized) if include_total else None
-                search_results = [r.to_simple_dict() for r in pony_query]
-            self.session.mds._db.disconnect()  # DB must be disconnected explicitly if run on a thread
-            return search_results, total
+                return self.session.mds.search_with_cache(
+                    "rest", dict(sanitized, include_total=bool(include_total)), search
+                )
 
         try:
-            search_results, total = await asyncio.get_event_loop().run_in_executor(None, search_db)
+            search_results, total, next_cursor = await self.session.mds.run_read(search_db)
         except Exception as e:
             self._logger.error("Error while performing DB search: %s", e)
             return RESTResponse(status=HTTP_BAD_REQUEST)
 
+        if self.session.torrent_checker:
+            # The health of the torrents the user is looking at is checked first
+            self.session.torrent_checker.add_visible_infohashes(
+                unhexlify(entry["infohash"]) for entry in search_results if "infohash" in entry
+            )
+
         response_dict = {
             "results": search_results,
             "first": sanitized["first"],
@@ -91,6 +101,8 @@ class SearchEndpoint(MetadataEndpointBase):
         }
         if total is not None:
             response_dict.update({"total": total})
+        if next_cursor is not None:
+            response_dict.update({"next_cursor": next_cursor})
 
         return RESTResponse(response_dict)
 
@@ -120,5 +132,8 @@ class SearchEndpoint(MetadataEndpointBase):
 
         keywords = args['q'].strip().lower()
         # TODO: add XXX filtering for completion terms
-        results = self.session.mds.TorrentMetadata.get_auto_complete_terms(keywords, max_terms=5)
+        # The first call builds the completion index, so it is run on a thread
+        results = await self.session.mds.run_read(
+            self.session.mds.TorrentMetadata.get_auto_complete_terms, keywords, 5
+        )
         return RESTResponse({"completions": results})
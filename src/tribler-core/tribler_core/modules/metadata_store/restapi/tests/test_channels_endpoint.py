@@ -1,4 +1,5 @@
 import base64
+import json
 import os
 import shutil
 import sys
@@ -77,6 +78,39 @@ class TestChannelsEndpoint(BaseTestMetadataEndpoint):
         json_dict = await self.do_request('channels?sort_by=fdsafsdf')
         self.assertEqual(len(json_dict['results']), 10)
 
+    async def test_get_channels_cursor(self):
+        """
+        Test whether we can page through the channels with the cursors returned by the REST API
+        """
+        expected = (await self.do_request('channels?sort_by=title'))['results']
+        results = []
+        json_dict = await self.do_request('channels?sort_by=title&first=1&last=3')
+        while json_dict['results']:
+            results.extend(json_dict['results'])
+            json_dict = await self.do_request(
+                'channels?sort_by=title&first=1&last=3&cursor=%s' % json_dict['next_cursor']
+            )
+        self.assertNotIn('next_cursor', json_dict)
+        self.assertListEqual(expected, results)
+
+        await self.do_request('channels?sort_by=title&cursor=fdsafsdf', expected_code=400)
+
+    async def test_get_channels_ndjson(self):
+        """
+        Test whether we can stream all the channels as NDJSON with the REST API
+        """
+        expected = (await self.do_request('channels?sort_by=title'))['results']
+        response = await self.do_request('channels?sort_by=title&format=ndjson', json_response=False)
+        self.assertListEqual(expected, [json.loads(line) for line in response.decode('utf-8').splitlines()])
+
+        response = await self.do_request('channels?sort_by=title&format=ndjson&first=2&last=4', json_response=False)
+        self.assertListEqual(expected[1:4], [json.loads(line) for line in response.decode('utf-8').splitlines()])
+
+        response = await self.do_request('channels?txt_filter=nothing&format=ndjson', json_response=False)
+        self.assertEqual(b'', response)
+
+        await self.do_request('channels?sort_by=title&format=ndjson&cursor=fdsafsdf', expected_code=400)
+
     async def test_get_subscribed_channels(self):
         """
         Test whether we can successfully query channels we are subscribed to with the REST API
@@ -129,6 +163,20 @@ class TestSpecificChannelEndpoint(BaseTestMetadataEndpoint):
         self.assertEqual(len(json_dict['results']), 5)
         self.assertIn('status', json_dict['results'][0])
 
+    @timeout(10)
+    async def test_get_channel_contents_ndjson(self):
+        """
+        Test whether we can stream the contents of a channel as NDJSON
+        """
+        with db_session:
+            chan = self.session.mds.ChannelMetadata.select().first()
+        response = await self.do_request(
+            'channels/%s/123?format=ndjson' % hexlify(chan.public_key), json_response=False
+        )
+        results = [json.loads(line) for line in response.decode('utf-8').splitlines()]
+        self.assertEqual(len(results), 5)
+        self.assertIn('status', results[0])
+
     @timeout(10)
     async def test_get_channel_contents_by_type(self):
         # Test filtering channel contents by a list of data types
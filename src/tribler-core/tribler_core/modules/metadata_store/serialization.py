@@ -1,10 +1,8 @@
 import struct
 from datetime import datetime, timedelta
 
-from ipv8.database import database_blob
 from ipv8.keyvault.crypto import default_eccrypto
-from ipv8.messaging.payload import Payload
-from ipv8.messaging.serialization import default_serializer
+from ipv8.messaging.serialization import PackError
 
 from tribler_core.exceptions import InvalidSignatureException
 from tribler_core.utilities.unicode import hexlify
@@ -56,17 +54,18 @@ class UnknownBlobTypeException(Exception):
     pass
 
 
-def read_payload_with_offset(data, offset=0):
-    # First we have to determine the actual payload type
-    metadata_type = struct.unpack_from('>H', database_blob(data), offset=offset)[0]
+def read_payload_with_offset(data, offset=0, check_signature=True):
+    # First we have to determine the actual payload type.
+    # Note that data can be a memoryview, so we must never copy it as a whole here.
+    metadata_type = struct.unpack_from('>H', data, offset=offset)[0]
     if metadata_type == DELETED:
-        return DeletedMetadataPayload.from_signed_blob_with_offset(data, offset=offset)
+        return DeletedMetadataPayload.from_signed_blob_with_offset(data, check_signature=check_signature, offset=offset)
     elif metadata_type == REGULAR_TORRENT:
-        return TorrentMetadataPayload.from_signed_blob_with_offset(data, offset=offset)
+        return TorrentMetadataPayload.from_signed_blob_with_offset(data, check_signature=check_signature, offset=offset)
     elif metadata_type == COLLECTION_NODE:
-        return CollectionNodePayload.from_signed_blob_with_offset(data, offset=offset)
+        return CollectionNodePayload.from_signed_blob_with_offset(data, check_signature=check_signature, offset=offset)
     elif metadata_type == CHANNEL_TORRENT:
-        return ChannelMetadataPayload.from_signed_blob_with_offset(data, offset=offset)
+        return ChannelMetadataPayload.from_signed_blob_with_offset(data, check_signature=check_signature, offset=offset)
 
     # Unknown metadata type, raise exception
     raise UnknownBlobTypeException
@@ -76,12 +75,123 @@ def read_payload(data):
     return read_payload_with_offset(data)[0]
 
 
-class SignedPayload(Payload):
+def iter_signed_payloads(data):
+    """
+    Parse the payloads of a raw concatenated payloads blob one by one. The signatures of the payloads are NOT checked.
+    :param data: the blob, consists of one or more GigaChannel payloads concatenated together
+    :return: generator of (payload, signed_data) tuples, where signed_data is a view of the exact bytes of the blob
+        that are covered by the signature of the payload
+    :raises PackError, UnknownBlobTypeException: if the blob contains a malformed payload
+    """
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        payload, end_offset = read_payload_with_offset(data, offset, check_signature=False)
+        yield payload, data[offset : end_offset - SIGNATURE_SIZE]
+        offset = end_offset
+
+
+def check_payloads_signatures(signed_payloads):
+    """
+    Verify the signatures of a list of payloads that were read with check_signature=False.
+    Payloads are grouped by public key, so the key object is only built once per signer. This is much cheaper
+    than checking the signatures one by one on payload creation, because gossip and channel blobs typically
+    contain lots of entries signed by the same channel key.
+    The signatures are checked against the bytes the payloads were read from, so the payloads are not packed again.
+    :param signed_payloads: the list of (payload, signed_data) tuples to check, as produced by iter_signed_payloads
+    :raises InvalidSignatureException: if any of the payloads has a wrong signature
+    """
+    payloads_by_key = {}
+    for payload, signed_data in signed_payloads:
+        # Free-for-all entries are not signed, but they must go with the null signature
+        if payload.public_key == NULL_KEY:
+            if payload.signature != NULL_SIG:
+                raise InvalidSignatureException("Tried to create FFA payload with non-null signature")
+            continue
+        payloads_by_key.setdefault(payload.public_key, []).append((payload.signature, signed_data))
+
+    for public_key, signatures in payloads_by_key.items():
+        key = default_eccrypto.key_from_public_bin(b"LibNaCLPK:" + public_key)
+        for signature, signed_data in signatures:
+            if not default_eccrypto.is_valid_signature(key, bytes(signed_data), signature):
+                raise InvalidSignatureException("Tried to create payload with wrong signature")
+
+
+class PayloadCodec(object):
+    """
+    Precompiled packer for the metadata payload formats.
+    All metadata formats consist of a fixed-width header, followed by zero or more 'varlenI' (length-prefixed)
+    fields and an optional fixed-width trailer. Each fixed-width part is packed and unpacked with a single
+    precompiled struct.Struct, instead of going through the generic IPv8 serializer field by field.
+    The wire format is exactly the same as the one produced by IPv8's default_serializer for the format list.
+    """
+
+    __slots__ = ('header', 'num_header_fields', 'num_varlen_fields', 'trailer')
+
+    varlen_prefix = struct.Struct('>I')
+
+    def __init__(self, format_list):
+        header_formats = []
+        trailer_formats = []
+        self.num_varlen_fields = 0
+        for fmt in format_list:
+            if fmt == 'varlenI':
+                if trailer_formats:
+                    raise ValueError("varlenI fields must go in a single group", format_list)
+                self.num_varlen_fields += 1
+            elif self.num_varlen_fields:
+                trailer_formats.append(fmt)
+            else:
+                header_formats.append(fmt)
+        self.header = struct.Struct('>' + ''.join(header_formats))
+        self.num_header_fields = len(header_formats)
+        self.trailer = struct.Struct('>' + ''.join(trailer_formats)) if trailer_formats else None
+
+    def pack(self, values):
+        varlen_end = self.num_header_fields + self.num_varlen_fields
+        out = [self.header.pack(*values[: self.num_header_fields])]
+        for value in values[self.num_header_fields : varlen_end]:
+            out.append(self.varlen_prefix.pack(len(value)))
+            out.append(value)
+        if self.trailer:
+            out.append(self.trailer.pack(*values[varlen_end:]))
+        return b''.join(out)
+
+    def unpack_from(self, data, offset=0):
+        """
+        Unpack the values from data, starting at the given offset.
+        :return: (values, end_offset) tuple
+        :raises PackError: if the data is too short or malformed
+        """
+        try:
+            values = list(self.header.unpack_from(data, offset))
+            offset += self.header.size
+            for _ in range(self.num_varlen_fields):
+                (length,) = self.varlen_prefix.unpack_from(data, offset)
+                offset += self.varlen_prefix.size
+                if offset + length > len(data):
+                    raise struct.error("not enough data for a varlenI field of length %i" % length)
+                values.append(bytes(data[offset : offset + length]))
+                offset += length
+            if self.trailer:
+                values.extend(self.trailer.unpack_from(data, offset))
+                offset += self.trailer.size
+        except struct.error as e:
+            raise PackError("Could not unpack metadata payload: %s" % str(e)) from e
+        return values, offset
+
+
+class SignedPayload(object):
     """
     Payload for metadata.
+    These objects are kept in memory in large numbers during channel processing, so the payload classes
+    use __slots__ and precompiled codecs instead of regular IPv8 payloads.
     """
 
+    __slots__ = ('metadata_type', 'reserved_flags', 'public_key', 'signature')
+
     format_list = ['H', 'H', '64s']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key, **kwargs):
         super(SignedPayload, self).__init__()
@@ -106,13 +216,17 @@ class SignedPayload(Payload):
             else:
                 raise InvalidSignatureException("Tried to create FFA payload with non-null signature")
 
-        serialized_data = default_serializer.pack_multiple(self.to_pack_list())[0]
         if "key" in kwargs and kwargs["key"]:
             key = kwargs["key"]
             if self.public_key != key.pub().key_to_bin()[10:]:
                 raise KeysMismatchException(self.public_key, key.pub().key_to_bin()[10:])
-            self.signature = default_eccrypto.create_signature(key, serialized_data)
+            self.signature = default_eccrypto.create_signature(key, self.signed_data())
         elif "signature" in kwargs:
+            # If the payload was read from a blob, the signature is checked against the original bytes, without
+            # packing the payload again. These are not kept, so the payload does not hold on to the blob, and
+            # its serialized form always reflects its current fields.
+            signed_data = kwargs.get("signed_data", None)
+            serialized_data = bytes(signed_data) if signed_data is not None else self.signed_data()
             # This check ensures that an entry with a wrong signature will not proliferate further
             if not default_eccrypto.is_valid_signature(
                 default_eccrypto.key_from_public_bin(b"LibNaCLPK:" + self.public_key), serialized_data, self.signature
@@ -135,13 +249,18 @@ class SignedPayload(Payload):
 
     @classmethod
     def from_signed_blob_with_offset(cls, data, check_signature=True, offset=0):
-        # TODO: stop serializing/deserializing stuff twice
-        unpack_list, end_offset = default_serializer.unpack_multiple(cls.format_list, data, offset=offset)
+        # We walk the blob through a memoryview, so the blob itself is not copied. The signed part of the payload
+        # is only viewed while its signature is checked.
+        data = memoryview(data)
+        unpack_list, end_offset = cls._codec.unpack_from(data, offset=offset)
+        signature = bytes(data[end_offset : end_offset + SIGNATURE_SIZE])
+        if len(signature) != SIGNATURE_SIZE:
+            raise InvalidSignatureException("Tried to read payload with truncated signature")
         if check_signature:
-            signature = data[end_offset : end_offset + SIGNATURE_SIZE]
-            payload = cls.from_unpack_list(*unpack_list, signature=signature)
+            payload = cls.from_unpack_list(*unpack_list, signature=signature, signed_data=data[offset:end_offset])
         else:
-            payload = cls.from_unpack_list(*unpack_list, skip_key_check=True)
+            # The signature is kept, so it could be checked later, e.g. in bulk by check_payloads_signatures
+            payload = cls.from_unpack_list(*unpack_list, signature=signature, skip_key_check=True)
         return payload, end_offset + SIGNATURE_SIZE
 
     def to_dict(self):
@@ -152,9 +271,14 @@ class SignedPayload(Payload):
             "signature": self.signature,
         }
 
+    def signed_data(self):
+        """
+        Return the serialized payload data, without the signature, i.e. the data covered by the signature.
+        """
+        return self._codec.pack([value for _, value in self.to_pack_list()])
+
     def _serialized(self):
-        serialized_data = default_serializer.pack_multiple(self.to_pack_list())[0]
-        return serialized_data, self.signature
+        return self.signed_data(), self.signature
 
     def serialized(self):
         return b''.join(self._serialized())
@@ -167,7 +291,10 @@ class SignedPayload(Payload):
 
 # fmt: off
 class ChannelNodePayload(SignedPayload):
+    __slots__ = ('id_', 'origin_id', 'timestamp')
+
     format_list = SignedPayload.format_list + ['Q', 'Q', 'Q']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key,
                  id_, origin_id, timestamp,
@@ -204,8 +331,10 @@ class ChannelNodePayload(SignedPayload):
 
 
 class MetadataNodePayload(ChannelNodePayload):
+    __slots__ = ('title', 'tags')
 
     format_list = ChannelNodePayload.format_list + ['varlenI', 'varlenI']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key,
                  id_, origin_id, timestamp,
@@ -252,7 +381,10 @@ class CollectionNodePayload(MetadataNodePayload):
     Payload for metadata that stores a collection
     """
 
+    __slots__ = ('num_entries',)
+
     format_list = MetadataNodePayload.format_list + ['Q']
+    _codec = PayloadCodec(format_list)
 
     def __init__(
         self, metadata_type, reserved_flags, public_key,
@@ -301,7 +433,10 @@ class TorrentMetadataPayload(ChannelNodePayload):
     Payload for metadata that stores a torrent.
     """
 
+    __slots__ = ('infohash', 'size', 'torrent_date', 'title', 'tags', 'tracker_info')
+
     format_list = ChannelNodePayload.format_list + ['20s', 'Q', 'I', 'varlenI', 'varlenI', 'varlenI']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key,
                  id_, origin_id, timestamp,
@@ -365,7 +500,10 @@ class ChannelMetadataPayload(TorrentMetadataPayload):
     Payload for metadata that stores a channel.
     """
 
+    __slots__ = ('num_entries', 'start_timestamp')
+
     format_list = TorrentMetadataPayload.format_list + ['Q'] + ['Q']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key,
                  id_, origin_id, timestamp,
@@ -408,7 +546,10 @@ class DeletedMetadataPayload(SignedPayload):
     Payload for metadata that stores deleted metadata.
     """
 
+    __slots__ = ('delete_signature',)
+
     format_list = SignedPayload.format_list + ['64s']
+    _codec = PayloadCodec(format_list)
 
     def __init__(self, metadata_type, reserved_flags, public_key,
                  delete_signature,
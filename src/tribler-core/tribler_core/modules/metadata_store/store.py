@@ -1,8 +1,10 @@
 import logging
+import os
 import threading
-from asyncio import get_event_loop
+from asyncio import get_event_loop, wrap_future
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
-from time import sleep
+from itertools import islice
 
 from ipv8.database import database_blob
 
@@ -12,6 +14,7 @@ from pony import orm
 from pony.orm import CacheIndexError, TransactionIntegrityError, db_session
 
 from tribler_core.exceptions import InvalidSignatureException
+from tribler_core.modules.category_filter.family_filter import default_xxx_filter
 from tribler_core.modules.category_filter.l2_filter import is_forbidden
 from tribler_core.modules.metadata_store.orm_bindings import (
     channel_metadata,
@@ -26,20 +29,34 @@ from tribler_core.modules.metadata_store.orm_bindings import (
     tracker_state,
     vsids,
 )
-from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import BLOB_EXTENSION
+from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import (
+    BLOB_EXTENSION,
+    SQL_IN_CHUNK_SIZE,
+    chunks,
+    get_channel_state,
+)
+from tribler_core.modules.metadata_store.orm_bindings.channel_node import (
+    DIRTY_STATUSES,
+    generate_dict_from_pony_args,
+)
+from tribler_core.modules.metadata_store.completion_index import CompletionIndex, FTS_TOKENIZE
+from tribler_core.modules.metadata_store.db_pool import DBThreadPool, DBWriter, is_read_only_thread
+from tribler_core.modules.metadata_store.query_cache import QueryCache
 from tribler_core.modules.metadata_store.serialization import (
     CHANNEL_TORRENT,
     COLLECTION_NODE,
     DELETED,
     NULL_KEY,
     REGULAR_TORRENT,
-    read_payload_with_offset,
+    check_payloads_signatures,
+    iter_signed_payloads,
 )
 from tribler_core.utilities.path_util import str_path
+from tribler_core.utilities.tracker_utils import get_uniformed_tracker_url
 from tribler_core.utilities.unicode import hexlify
 
 BETA_DB_VERSIONS = [0, 1, 2, 3, 4, 5]
-CURRENT_DB_VERSION = 8
+CURRENT_DB_VERSION = 9
 
 NO_ACTION = 0
 UNKNOWN_CHANNEL = 1
@@ -49,13 +66,26 @@ UNKNOWN_TORRENT = 5
 DELETED_METADATA = 6
 UNKNOWN_COLLECTION = 7
 
+# Number of payloads of an mdblob file that have their signatures checked at once
+MDBLOB_SIGNATURE_CHECK_BATCH_SIZE = 1000
+
+# Number of entries fetched from the DB at once when streaming listings of entries
+ENTRIES_STREAM_CHUNK_SIZE = 500
+
 # This table should never be used from ORM directly.
 # It is created as a VIRTUAL table by raw SQL and
 # maintained by SQL triggers.
 sql_create_fts_table = """
     CREATE VIRTUAL TABLE IF NOT EXISTS FtsIndex USING FTS5
         (title, content='ChannelNode', prefix = '2 3 4 5',
-         tokenize='porter unicode61 remove_diacritics 1');"""
+         tokenize='%s');""" % FTS_TOKENIZE
+
+# The vocabulary of FtsIndex, used by the completion index
+sql_create_fts_vocab_table = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS FtsVocab USING fts5vocab(FtsIndex, 'row');"""
+
+sql_create_fts_vocab_instance_table = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS FtsVocabInstance USING fts5vocab(FtsIndex, 'instance');"""
 
 sql_add_fts_trigger_insert = """
     CREATE TRIGGER IF NOT EXISTS fts_ai AFTER INSERT ON ChannelNode
@@ -63,21 +93,298 @@ sql_add_fts_trigger_insert = """
         INSERT INTO FtsIndex(rowid, title) VALUES (new.rowid, new.title);
     END;"""
 
+# FtsIndex is an external content table, so the old terms of an entry can only be removed from it by passing
+# the old title with the 'delete' command. By the time the trigger runs, the content table already holds the new
+# title (or nothing), so a plain DELETE on FtsIndex would leave the old terms in the index and in its vocabulary.
+# The entries waiting to be indexed (see FtsPendingRows below) are not in FtsIndex, so there is nothing to remove.
 sql_add_fts_trigger_delete = """
     CREATE TRIGGER IF NOT EXISTS fts_ad AFTER DELETE ON ChannelNode
+    WHEN NOT EXISTS (SELECT 1 FROM FtsPendingRows WHERE rowid = old.rowid)
     BEGIN
-        DELETE FROM FtsIndex WHERE rowid = old.rowid;
+        INSERT INTO FtsIndex(FtsIndex, rowid, title) VALUES ('delete', old.rowid, old.title);
     END;"""
 
 sql_add_fts_trigger_update = """
     CREATE TRIGGER IF NOT EXISTS fts_au AFTER UPDATE ON ChannelNode BEGIN
-        DELETE FROM FtsIndex WHERE rowid = old.rowid;
+        INSERT INTO FtsIndex(FtsIndex, rowid, title) VALUES ('delete', old.rowid, old.title);
         INSERT INTO FtsIndex(rowid, title) VALUES (new.rowid, new.title);
     END;"""
 
+# During bulk imports the index maintenance triggers above are replaced with the lightweight ones below,
+# that only record the rowids of the changed entries. The pending rowids table is a normal table, so it is
+# updated in the same transaction as ChannelNode and the list of entries missing from FtsIndex survives crashes.
+sql_create_fts_pending_table = """
+    CREATE TABLE IF NOT EXISTS FtsPendingRows (rowid INTEGER PRIMARY KEY);"""
+
+sql_add_fts_deferred_trigger_insert = """
+    CREATE TRIGGER IF NOT EXISTS fts_ai_deferred AFTER INSERT ON ChannelNode
+    BEGIN
+        INSERT OR IGNORE INTO FtsPendingRows(rowid) VALUES (new.rowid);
+    END;"""
+
+# Entries that are already pending must not be removed from FtsIndex, because they were never added to it
+sql_add_fts_deferred_trigger_update = """
+    CREATE TRIGGER IF NOT EXISTS fts_au_deferred AFTER UPDATE ON ChannelNode
+    WHEN NOT EXISTS (SELECT 1 FROM FtsPendingRows WHERE rowid = old.rowid)
+    BEGIN
+        INSERT INTO FtsIndex(FtsIndex, rowid, title) VALUES ('delete', old.rowid, old.title);
+        INSERT OR IGNORE INTO FtsPendingRows(rowid) VALUES (new.rowid);
+    END;"""
+
+sql_index_fts_pending_rows = """
+    INSERT INTO FtsIndex(rowid, title)
+        SELECT rowid, title FROM ChannelNode WHERE rowid IN (SELECT rowid FROM FtsPendingRows);"""
+
+
+# The rowids of the entries with dirty statuses (NEW, TODELETE, UPDATED) are tracked by SQL triggers in a separate
+# table. This way, the commit routines do work proportional to the number of changes, not the size of the channels.
+sql_create_dirty_nodes_table = """
+    CREATE TABLE IF NOT EXISTS DirtyNodes (rowid INTEGER PRIMARY KEY);"""
+
+sql_populate_dirty_nodes_table = """
+    INSERT OR IGNORE INTO DirtyNodes(rowid) SELECT rowid FROM ChannelNode WHERE status IN %s;""" % (DIRTY_STATUSES,)
+
+sql_add_dirty_nodes_trigger_insert = """
+    CREATE TRIGGER IF NOT EXISTS dirty_ai AFTER INSERT ON ChannelNode
+    WHEN new.status IN %s
+    BEGIN
+        INSERT OR IGNORE INTO DirtyNodes(rowid) VALUES (new.rowid);
+    END;""" % (DIRTY_STATUSES,)
+
+sql_add_dirty_nodes_trigger_delete = """
+    CREATE TRIGGER IF NOT EXISTS dirty_ad AFTER DELETE ON ChannelNode
+    BEGIN
+        DELETE FROM DirtyNodes WHERE rowid = old.rowid;
+    END;"""
+
+sql_add_dirty_nodes_trigger_update = """
+    CREATE TRIGGER IF NOT EXISTS dirty_au AFTER UPDATE OF status ON ChannelNode
+    BEGIN
+        DELETE FROM DirtyNodes WHERE rowid = old.rowid;
+        INSERT OR IGNORE INTO DirtyNodes(rowid) SELECT new.rowid WHERE new.status IN %s;
+    END;""" % (DIRTY_STATUSES,)
+
+
+# The columns needed to build the JSON representations of the entries, the same as produced by their to_simple_dict
+# methods. The TorrentState of the entries is aliased as "ts".
+sql_json_projection_columns = (
+    "cn.rowid, cn.metadata_type, cn.id_, cn.origin_id, cn.public_key, cn.title, cn.tags, cn.status, "
+    "cn.num_entries, cn.infohash, cn.size, cn.torrent_date, cn.subscribed, cn.votes, cn.local_version, "
+    "cn.timestamp, ts.seeders AS health_seeders, ts.leechers AS health_leechers, ts.last_check AS health_last_check"
+)
+
+
+def channel_node_counts_key(row):
+    """
+    Get the SQL expressions for the ChannelNodeCounts key columns of the given ChannelNode row.
+    NULLs are replaced with values that can't be matched by the filters of get_entries queries.
+    """
+    return (
+        "{0}.public_key, IFNULL({0}.origin_id, 0), {0}.metadata_type, IFNULL({0}.status, -1), "
+        "IFNULL({0}.xxx, -1), IFNULL({0}.subscribed, 0)".format(row)
+    )
+
+
+CHANNEL_NODE_COUNTS_COLUMNS = "public_key, origin_id, metadata_type, status, xxx, subscribed"
+
+# The number of entries per channel, type, status, etc. is maintained by SQL triggers in a separate table, so the totals
+# of the typical REST queries are calculated without scanning the entries. The same triggers bump the generation
+# counter on each change that could affect the results of get_entries queries, to invalidate the cached results.
+# Unlike the FtsIndex triggers, these are not suspended during bulk imports: they only touch a few rows of small tables,
+# so their cost is lost in the noise of the ChannelNode index updates, while catching up afterwards would take
+# a GROUP BY over the whole ChannelNode table.
+sql_create_channel_node_counts_table = """
+    CREATE TABLE IF NOT EXISTS ChannelNodeCounts (
+        public_key BLOB NOT NULL,
+        origin_id INTEGER NOT NULL,
+        metadata_type INTEGER NOT NULL,
+        status INTEGER NOT NULL,
+        xxx REAL NOT NULL,
+        subscribed INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (%s));""" % CHANNEL_NODE_COUNTS_COLUMNS
+
+sql_populate_channel_node_counts_table = """
+    INSERT INTO ChannelNodeCounts(%s, count)
+        SELECT %s, COUNT(*) FROM ChannelNode GROUP BY 1, 2, 3, 4, 5, 6;""" % (
+    CHANNEL_NODE_COUNTS_COLUMNS,
+    channel_node_counts_key("ChannelNode"),
+)
+
+sql_create_generation_table = """
+    CREATE TABLE IF NOT EXISTS ChannelNodeGeneration (value INTEGER NOT NULL);"""
+
+sql_populate_generation_table = """
+    INSERT INTO ChannelNodeGeneration(value) VALUES (0);"""
+
+sql_add_counts_trigger_insert = """
+    CREATE TRIGGER IF NOT EXISTS counts_ai AFTER INSERT ON ChannelNode
+    BEGIN
+        INSERT OR IGNORE INTO ChannelNodeCounts(%(columns)s, count) VALUES (%(new)s, 0);
+        UPDATE ChannelNodeCounts SET count = count + 1 WHERE (%(columns)s) = (%(new)s);
+        UPDATE ChannelNodeGeneration SET value = value + 1;
+    END;""" % {"columns": CHANNEL_NODE_COUNTS_COLUMNS, "new": channel_node_counts_key("new")}
+
+sql_add_counts_trigger_delete = """
+    CREATE TRIGGER IF NOT EXISTS counts_ad AFTER DELETE ON ChannelNode
+    BEGIN
+        UPDATE ChannelNodeCounts SET count = count - 1 WHERE (%(columns)s) = (%(old)s);
+        UPDATE ChannelNodeGeneration SET value = value + 1;
+    END;""" % {"columns": CHANNEL_NODE_COUNTS_COLUMNS, "old": channel_node_counts_key("old")}
+
+sql_add_counts_trigger_update = """
+    CREATE TRIGGER IF NOT EXISTS counts_au AFTER UPDATE OF %(columns)s ON ChannelNode
+    BEGIN
+        UPDATE ChannelNodeCounts SET count = count - 1 WHERE (%(columns)s) = (%(old)s);
+        INSERT OR IGNORE INTO ChannelNodeCounts(%(columns)s, count) VALUES (%(new)s, 0);
+        UPDATE ChannelNodeCounts SET count = count + 1 WHERE (%(columns)s) = (%(new)s);
+        UPDATE ChannelNodeGeneration SET value = value + 1;
+    END;""" % {
+    "columns": CHANNEL_NODE_COUNTS_COLUMNS,
+    "old": channel_node_counts_key("old"),
+    "new": channel_node_counts_key("new"),
+}
+
+# These columns are not counted, but still can be filtered on
+sql_add_generation_trigger_update = """
+    CREATE TRIGGER IF NOT EXISTS generation_au AFTER UPDATE OF id_, title, tags ON ChannelNode
+    BEGIN
+        UPDATE ChannelNodeGeneration SET value = value + 1;
+    END;"""
+
+# Indexes matching the sort orders of the channel contents (see MetadataNode.get_sort_keys), so the pages of entries
+# are read in the index order, starting right at the cursor position, instead of sorting all the entries of a channel
+sql_create_sort_indexes = [
+    'CREATE INDEX IF NOT EXISTS idx_channelnode__origin_id_%s ON ChannelNode (origin_id, %s, rowid)'
+    % ("_".join(columns), ", ".join(columns))
+    for columns in [("title",), ("torrent_date",), ("num_entries",), ("num_entries", "size"), ("votes",)]
+]
+
+# The torrent checker picks the least recently checked torrents first
+sql_create_torrent_state_last_check_index = """
+    CREATE INDEX IF NOT EXISTS idx_torrentstate__last_check ON TorrentState (last_check);"""
+
+
+# The columns of the new torrent entries that are inserted in bulk by process_payloads_batch. The list is fixed,
+# so a new TorrentMetadata column with a non-NULL default must be added here as well.
+TORRENT_METADATA_INSERT_COLUMNS = (
+    "metadata_type",
+    "reserved_flags",
+    "origin_id",
+    "public_key",
+    "id_",
+    "timestamp",
+    "signature",
+    "added_on",
+    "status",
+    "title",
+    "tags",
+    "num_entries",
+    "infohash",
+    "size",
+    "torrent_date",
+    "tracker_info",
+    "xxx",
+    "health",
+)
+
+sql_insert_torrent_metadata = "INSERT INTO ChannelNode (%s) VALUES (%s)" % (
+    ", ".join(TORRENT_METADATA_INSERT_COLUMNS),
+    ", ".join("?" * len(TORRENT_METADATA_INSERT_COLUMNS)),
+)
+
+sql_insert_torrent_state = "INSERT INTO TorrentState (infohash, seeders, leechers, last_check) VALUES (?, 0, 0, 0)"
+
+
+def sql_value(value):
+    """
+    Convert a Python value to the value stored by Pony in an SQLite column.
+    Datetimes are stored as text, always with microseconds.
+    """
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return value
+
+
+def get_channel_dir_blobs(dirname):
+    """
+    List the metadata blobs in a channel directory.
+    :param dirname: The directory containing the metadata blobs.
+    :return: list of (blob_sequence_number, full_filename) tuples, sorted by the file name.
+    """
+    blobs = []
+    for full_filename in sorted(dirname.iterdir()):
+        filename = full_filename.name
+        if filename.endswith(BLOB_EXTENSION):
+            blobs.append((int(filename[: -len(BLOB_EXTENSION)]), full_filename))
+        elif filename.endswith(BLOB_EXTENSION + '.lz4'):
+            blobs.append((int(filename[: -len(BLOB_EXTENSION + '.lz4')]), full_filename))
+    return blobs
+
+
+def iter_squashed_mdblob_payloads(chunk_data):
+    """
+    Parse the payloads of a raw concatenated payloads blob one by one. The signatures of the payloads are NOT checked.
+    :param chunk_data: the blob itself, consists of one or more GigaChannel payloads concatenated together
+    :return: generator of payloads
+    :raises PackError, UnknownBlobTypeException: if the blob contains a malformed payload
+    """
+    return (payload for payload, _ in iter_signed_payloads(chunk_data))
+
+
+def read_verified_mdblob_file(filepath):
+    """
+    Read a (possibly lz4-compressed) metadata blob file and check the signatures of all its payloads.
+    The file is only read and decompressed once: the payloads to process must be parsed from the returned blob
+    (e.g. with iter_squashed_mdblob_payloads), so they are exactly the ones that were checked. The blobs are at most
+    1MB compressed (see ChannelMetadata._CHUNK_SIZE_LIMIT), so they are kept in memory as a whole, but the payloads
+    are checked in batches. This function does not touch the database, so it can be run in a separate process.
+    :param filepath: The path to the file
+    :return: the decompressed blob
+    :raises InvalidSignatureException: if any of the payloads in the blob has a wrong signature
+    :raises RuntimeError: if the blob could not be decompressed
+    :raises PackError, UnknownBlobTypeException: if the blob contains a malformed payload
+    """
+    with open(str_path(filepath), 'rb') as f:
+        chunk_data = f.read()
+    if str(filepath).endswith('.lz4'):
+        chunk_data = lz4.frame.decompress(chunk_data)
+    signed_payloads = iter_signed_payloads(chunk_data)
+    while True:
+        batch = list(islice(signed_payloads, MDBLOB_SIGNATURE_CHECK_BATCH_SIZE))
+        if not batch:
+            break
+        check_payloads_signatures(batch)
+    return chunk_data
+
+
+def read_squashed_mdblob_payloads(chunk_data):
+    """
+    Parse the payloads of a raw concatenated payloads blob and check their signatures. This function does not touch
+    the database, so it can be run off the DB writer thread.
+    :param chunk_data: the blob itself, consists of one or more GigaChannel payloads concatenated together
+    :return: list of payloads
+    :raises InvalidSignatureException: if any of the payloads in the blob has a wrong signature
+    :raises PackError, UnknownBlobTypeException: if the blob contains a malformed payload
+    """
+    signed_payloads = list(iter_signed_payloads(chunk_data))
+    # Signatures are checked in bulk, grouped by public key, before any payload gets near the database.
+    # Just like before, a single wrong signature invalidates the whole blob.
+    check_payloads_signatures(signed_payloads)
+    return [payload for payload, _ in signed_payloads]
+
+
+def read_compressed_mdblob_payloads(compressed_data):
+    """
+    Decompress an lz4-compressed metadata blob, parse its payloads and check their signatures
+    (see read_squashed_mdblob_payloads).
+    :raises RuntimeError: if the blob could not be decompressed
+    """
+    return read_squashed_mdblob_payloads(lz4.frame.decompress(compressed_data))
+
 
 class MetadataStore(object):
-    def __init__(self, db_filename, channels_dir, my_key, disable_sync=False):
+    def __init__(self, db_filename, channels_dir, my_key, disable_sync=False, reader_threads=4):
         self.db_filename = db_filename
         self.channels_dir = channels_dir
         self.my_key = my_key
@@ -86,7 +393,14 @@ class MetadataStore(object):
         self._shutting_down = False
         self.batch_size = 10  # reasonable number, a little bit more than typically fits in a single UDP packet
         self.reference_timedelta = timedelta(milliseconds=100)
-        self.sleep_on_external_thread = 0.05  # sleep this amount of seconds between batches executed on external thread
+        # Read the blobs of channel dirs incrementally, instead of loading them into memory as a whole
+        self.stream_channel_blobs = True
+        # Postpone FtsIndex maintenance until the end of channel dir processing
+        self.defer_fts_indexing = True
+        # Rebuild the whole FtsIndex instead of indexing the pending entries when there are more of them than this
+        self.fts_rebuild_threshold = 100000
+        self._fts_deferred_lock = threading.Lock()
+        self._fts_deferred_users = 0
 
         create_db = str(db_filename) == ":memory:" or not self.db_filename.is_file()
 
@@ -110,6 +424,22 @@ class MetadataStore(object):
 
             # pylint: enable=unused-variable
 
+        # In WAL mode, the readers work on a snapshot of the DB, so they are not blocked by the writer, and vice versa
+        # pylint: disable=unused-variable
+        @self._db.on_connect(provider='sqlite')
+        def sqlite_configure_connection(_, connection):
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA journal_mode = WAL")
+            if is_read_only_thread():
+                cursor.execute("PRAGMA query_only = 1")
+
+        # pylint: enable=unused-variable
+
+        # The threads running the DB jobs keep their connections between the jobs. The reads are spread over
+        # a fixed set of read-only connections, and the writes are serialized (and coalesced) on a single connection.
+        self.read_pool = DBThreadPool(self._db, reader_threads, thread_name_prefix="MetadataReader", read_only=True)
+        self.writer = DBWriter(self._db)
+
         self.MiscData = misc.define_binding(self._db)
 
         self.TrackerState = tracker_state.define_binding(self._db)
@@ -126,21 +456,32 @@ class MetadataStore(object):
         self.Vsids = vsids.define_binding(self._db)
 
         self.ChannelMetadata._channels_dir = channels_dir
+        # Recent get_total_count results, validated against the generation counter
+        self.count_cache = QueryCache(max_size=256)
+        self.MetadataNode._count_cache = self.count_cache
+        # Recent search results, shared by the REST API and the remote search responders. The TTL takes care of
+        # the changes to the ranking (e.g. the torrents health) that do not bump the generation counter
+        self.search_cache = QueryCache(max_size=256, ttl=60)
+        self.completion_index = CompletionIndex(self._db)
+        self.MetadataNode._completion_index = self.completion_index
 
         self._db.bind(provider='sqlite', filename=str(db_filename), create_db=str(create_db), timeout=120.0)
         if create_db:
             with db_session:
                 self._db.execute(sql_create_fts_table)
         self._db.generate_mapping(create_tables=create_db)  # Must be run out of session scope
-        if create_db:
-            with db_session:
-                self._db.execute(sql_add_fts_trigger_insert)
-                self._db.execute(sql_add_fts_trigger_delete)
-                self._db.execute(sql_add_fts_trigger_update)
 
         if create_db:
             with db_session:
                 self.MiscData(name="db_version", value=str(CURRENT_DB_VERSION))
+            self.create_trigger_maintained_tables()
+
+        with db_session:
+            db_version = int(self.MiscData.get(name="db_version").value)
+        # Older DBs are only opened by the upgrader, and do not have the trigger-maintained tables yet
+        if db_version == CURRENT_DB_VERSION:
+            # Index the entries left over from a bulk import that was interrupted by a crash
+            self._resume_fts_indexing()
 
         with db_session:
             default_vsids = self.Vsids.get(rowid=0)
@@ -148,6 +489,45 @@ class MetadataStore(object):
                 default_vsids = self.Vsids.create_default_vsids()
             self.ChannelMetadata.votes_scaling = default_vsids.max_val
 
+    def create_trigger_maintained_tables(self):
+        """
+        Create the tables maintained by SQL triggers next to the ORM-managed ones, with their triggers, and the indexes
+        that are not declared by the ORM bindings. The tables are filled from the existing entries, which requires
+        scanning the whole ChannelNode table, so this is done only once: on DB creation, or by the DB upgrader when
+        upgrading to DB version 9.
+        The FtsIndex maintenance triggers of the older DB versions left the old terms of the deleted and renamed
+        entries in FtsIndex, so they are replaced and FtsIndex is rebuilt from the entries as well.
+        """
+        with db_session:
+            self._db.execute(sql_create_fts_pending_table)
+            self._db.execute(sql_create_fts_vocab_table)
+            self._db.execute(sql_create_fts_vocab_instance_table)
+            for trigger in ("fts_ai", "fts_ad", "fts_au"):
+                self._db.execute("DROP TRIGGER IF EXISTS %s" % trigger)
+            self._db.execute(sql_add_fts_trigger_insert)
+            self._db.execute(sql_add_fts_trigger_delete)
+            self._db.execute(sql_add_fts_trigger_update)
+            self._db.execute("INSERT INTO FtsIndex(FtsIndex) VALUES('rebuild')")
+            if not self._db.select("name FROM sqlite_master WHERE type = 'table' AND name = 'DirtyNodes'"):
+                self._db.execute(sql_create_dirty_nodes_table)
+                self._db.execute(sql_populate_dirty_nodes_table)
+            self._db.execute(sql_add_dirty_nodes_trigger_insert)
+            self._db.execute(sql_add_dirty_nodes_trigger_delete)
+            self._db.execute(sql_add_dirty_nodes_trigger_update)
+            if not self._db.select("name FROM sqlite_master WHERE type = 'table' AND name = 'ChannelNodeCounts'"):
+                self._db.execute(sql_create_channel_node_counts_table)
+                self._db.execute(sql_populate_channel_node_counts_table)
+            if not self._db.select("name FROM sqlite_master WHERE type = 'table' AND name = 'ChannelNodeGeneration'"):
+                self._db.execute(sql_create_generation_table)
+                self._db.execute(sql_populate_generation_table)
+            self._db.execute(sql_add_counts_trigger_insert)
+            self._db.execute(sql_add_counts_trigger_delete)
+            self._db.execute(sql_add_counts_trigger_update)
+            self._db.execute(sql_add_generation_trigger_update)
+            for sql in sql_create_sort_indexes:
+                self._db.execute(sql)
+            self._db.execute(sql_create_torrent_state_last_check_index)
+
     @db_session
     def upsert_vote(self, channel, peer_pk):
         voter = self.ChannelPeer.get(public_key=peer_pk)
@@ -171,21 +551,118 @@ class MetadataStore(object):
 
     def shutdown(self):
         self._shutting_down = True
+        # Wait for the running jobs to finish and close the connections of the pool threads
+        self.writer.shutdown()
+        self.read_pool.shutdown()
         self._db.disconnect()
 
-    def disconnect_thread(self):
-        # Ugly workaround for closing threadpool connections
-        # TODO: subclass ThreadPoolExecutor to handle this automatically
-        if not isinstance(threading.current_thread(), threading._MainThread):
-            self._db.disconnect()
+    async def run_read(self, func, *args):
+        """
+        Run a read-only DB job on the reader pool.
+        The job must open its own db_session, and must not disconnect from the DB.
+        """
+        return await get_event_loop().run_in_executor(self.read_pool, func, *args)
+
+    async def run_write(self, func, *args, coalesce=False):
+        """
+        Run a DB job on the writer thread. The writes are serialized, so they never fight each other for the DB lock.
+        The job must not disconnect from the DB.
+        :param coalesce: if True, the job is a small write that can share a transaction with other such writes
+            (see DBWriter). Otherwise, the job must open its own db_session.
+        """
+        return await wrap_future(self.writer.submit(func, *args, coalesce=coalesce))
+
+    async def drain_writes(self):
+        """
+        Wait for the DB writes submitted so far to finish. Unlike run_write, this can be called after the shutdown.
+        """
+        await wrap_future(self.writer.drain())
+
+    @contextmanager
+    def deferred_fts_indexing(self):
+        """
+        Context manager that suspends the per-row FtsIndex maintenance triggers for the duration of a bulk import.
+        The changed entries are only recorded in the FtsPendingRows table and get indexed all at once on exit.
+        Nested and concurrent users are supported: the triggers are restored when the last one exits.
+        Until then, entries added or changed by other users of the database are also not searchable.
+        """
+        self._begin_deferred_fts_indexing()
+        try:
+            yield
+        finally:
+            self._end_deferred_fts_indexing()
+
+    @asynccontextmanager
+    async def deferred_fts_indexing_threaded(self):
+        """
+        Asynchronous version of deferred_fts_indexing, for bulk imports that are executed by the DB writer thread
+        in several tasks. The triggers are switched by the DB writer thread as well.
+        Does nothing if FtsIndex maintenance is not to be deferred (see defer_fts_indexing).
+        """
+        if not self.defer_fts_indexing:
+            yield
+            return
+        await self.run_write(self._begin_deferred_fts_indexing)
+        try:
+            yield
+        finally:
+            await self.run_write(self._end_deferred_fts_indexing)
+
+    def _begin_deferred_fts_indexing(self):
+        with self._fts_deferred_lock:
+            if self._fts_deferred_users == 0:
+                with db_session:
+                    self._db.execute("DROP TRIGGER IF EXISTS fts_ai")
+                    self._db.execute("DROP TRIGGER IF EXISTS fts_au")
+                    self._db.execute(sql_add_fts_deferred_trigger_insert)
+                    self._db.execute(sql_add_fts_deferred_trigger_update)
+            self._fts_deferred_users += 1
+
+    def _end_deferred_fts_indexing(self):
+        with self._fts_deferred_lock:
+            self._fts_deferred_users -= 1
+            if self._fts_deferred_users == 0:
+                self._resume_fts_indexing()
+
+    def _resume_fts_indexing(self):
+        """
+        Restore the normal FtsIndex maintenance triggers and index the entries that were changed while
+        the triggers were suspended. Both happen in the same transaction, so no entries can be missed.
+        """
+        with db_session:
+            self._db.execute("DROP TRIGGER IF EXISTS fts_ai_deferred")
+            self._db.execute("DROP TRIGGER IF EXISTS fts_au_deferred")
+            self._db.execute(sql_add_fts_trigger_insert)
+            self._db.execute(sql_add_fts_trigger_update)
+
+            pending_count = self._db.select("SELECT count(*) FROM FtsPendingRows")[0]
+            if not pending_count:
+                return
+            self._logger.info("Adding %i entries to the full text search index", pending_count)
+            if pending_count > self.fts_rebuild_threshold:
+                self._db.execute("INSERT INTO FtsIndex(FtsIndex) VALUES('rebuild')")
+            else:
+                self._db.execute(sql_index_fts_pending_rows)
+            self._db.execute("DELETE FROM FtsPendingRows")
+            # The entries were counted when they were added, but only become searchable now
+            self._db.execute("UPDATE ChannelNodeGeneration SET value = value + 1")
 
     def process_channel_dir(self, dirname, public_key, id_, **kwargs):
+        """
+        Load all metadata blobs in a given directory.
+        See _process_channel_dir for the description of the parameters.
+        """
+        if not self.defer_fts_indexing:
+            return self._process_channel_dir(dirname, public_key, id_, **kwargs)
+        with self.deferred_fts_indexing():
+            return self._process_channel_dir(dirname, public_key, id_, **kwargs)
+
+    def _process_channel_dir(self, dirname, public_key, id_, **kwargs):
         """
         Load all metadata blobs in a given directory.
         :param dirname: The directory containing the metadata blobs.
         :param skip_personal_metadata_payload: if this is set to True, personal torrent metadata payload received
                 through gossip will be ignored. The default value is True.
-        :param external_thread: indicate to lower levels that this is running on a background thread
         :param public_key: public_key of the channel.
         :param id_: id_ of the channel.
         """
@@ -203,45 +680,20 @@ class MetadataStore(object):
                 channel.timestamp,
             )
 
-        for full_filename in sorted(dirname.iterdir()):
-            filename = full_filename.name
-
-            blob_sequence_number = None
-            if filename.endswith(BLOB_EXTENSION):
-                blob_sequence_number = int(filename[: -len(BLOB_EXTENSION)])
-            elif filename.endswith(BLOB_EXTENSION + '.lz4'):
-                blob_sequence_number = int(filename[: -len(BLOB_EXTENSION + '.lz4')])
-
-            if blob_sequence_number is not None:
-                # Skip blobs containing data we already have and those that are
-                # ahead of the channel version known to us
-                # ==================|          channel data       |===
-                # ===start_timestamp|---local_version----timestamp|===
-                # local_version is essentially a cursor pointing into the current state of update process
-                with db_session:
-                    channel = self.ChannelMetadata.get(public_key=public_key, id_=id_)
-                    if not channel:
-                        return
-                    if (
-                        blob_sequence_number <= channel.start_timestamp
-                        or blob_sequence_number <= channel.local_version
-                        or blob_sequence_number > channel.timestamp
-                    ):
-                        continue
-                try:
-                    self.process_mdblob_file(str(full_filename), **kwargs)
-                    # If we stopped mdblob processing due to shutdown flag, we should stop
-                    # processing immediately, so that channel local version will not increase
-                    if self._shutting_down:
-                        return
-                    # We track the local version of the channel while reading blobs
-                    with db_session:
-                        channel = self.ChannelMetadata.get_for_update(public_key=public_key, id_=id_)
-                        if not channel:
-                            return
-                        channel.local_version = blob_sequence_number
-                except InvalidSignatureException:
-                    self._logger.error("Not processing metadata located at %s: invalid signature", full_filename)
+        for blob_sequence_number, full_filename in get_channel_dir_blobs(dirname):
+            # Skip blobs containing data we already have and those that are
+            # ahead of the channel version known to us
+            pending = self.channel_blob_is_pending(public_key, id_, blob_sequence_number)
+            if pending is None:
+                return
+            if not pending:
+                continue
+            try:
+                self.process_mdblob_file(full_filename, stream=self.stream_channel_blobs, **kwargs)
+                if not self.advance_channel_local_version(public_key, id_, blob_sequence_number):
+                    return
+            except InvalidSignatureException:
+                self._logger.error("Not processing metadata located at %s: invalid signature", full_filename)
 
         with db_session:
             channel = self.ChannelMetadata.get(public_key=public_key, id_=id_)
@@ -255,16 +707,86 @@ class MetadataStore(object):
                 channel.timestamp,
             )
 
-    def process_mdblob_file(self, filepath, **kwargs):
+    @db_session
+    def channel_blob_is_pending(self, public_key, id_, blob_sequence_number):
+        """
+        Check if the channel blob with the given sequence number still has to be processed.
+        :return: None if the channel does not exist anymore, otherwise True or False.
+        """
+        # ==================|          channel data       |===
+        # ===start_timestamp|---local_version----timestamp|===
+        # local_version is essentially a cursor pointing into the current state of update process
+        channel = self.ChannelMetadata.get(public_key=public_key, id_=id_)
+        if not channel:
+            return None
+        return not (
+            blob_sequence_number <= channel.start_timestamp
+            or blob_sequence_number <= channel.local_version
+            or blob_sequence_number > channel.timestamp
+        )
+
+    async def process_channel_blob_threaded(self, public_key, id_, blob_sequence_number, chunk_data, **kwargs):
+        """
+        Process a channel blob on the DB writer thread and advance the local version of the channel to it.
+        The payloads are parsed from the blob one batch at a time, and every batch is written by a separate writer task,
+        so the other writes (e.g. the coalesced gossip writes) do not wait for the whole blob.
+        The signatures are NOT checked, so the blob must come from read_verified_mdblob_file.
+        :param chunk_data: the decompressed blob, or None if there is nothing to process in the blob
+        :param kwargs: see process_payloads_batch
+        :return: False if the processing of the channel should be stopped, True otherwise.
+        """
+        pending = await self.run_write(self.channel_blob_is_pending, public_key, id_, blob_sequence_number)
+        if pending is None:
+            return False
+        if not pending:
+            return True
+        if chunk_data is not None:
+            payloads = iter_squashed_mdblob_payloads(chunk_data)
+
+            def process_next_batch():
+                return self.process_next_payloads_batch(payloads, **kwargs)
+
+            while not self._shutting_down and await self.run_write(process_next_batch) is not None:
+                pass
+        return await self.run_write(self.advance_channel_local_version, public_key, id_, blob_sequence_number)
+
+    def advance_channel_local_version(self, public_key, id_, blob_sequence_number):
+        """
+        Set the local version of the channel to the sequence number of the last processed blob.
+        :return: False if the processing of the channel should be stopped, True otherwise.
+        """
+        # If we stopped mdblob processing due to shutdown flag, we should stop
+        # processing immediately, so that channel local version will not increase
+        if self._shutting_down:
+            return False
+        # We track the local version of the channel while reading blobs
+        with db_session:
+            channel = self.ChannelMetadata.get_for_update(public_key=public_key, id_=id_)
+            if not channel:
+                return False
+            channel.local_version = blob_sequence_number
+        return True
+
+    def process_mdblob_file(self, filepath, stream=False, **kwargs):
         """
         Process a file with metadata in a channel directory.
         :param filepath: The path to the file
         :param skip_personal_metadata_payload: if this is set to True, personal torrent metadata payload received
                 through gossip will be ignored. The default value is True.
-        :param external_thread: indicate to the lower lever that we're running in the backround thread,
-            to possibly pace down the upload process
+        :param stream: if set to True, the signatures of the whole file are checked in batches, and then
+            the payloads are parsed and processed one batch at a time, instead of all being parsed at once
+            (see read_verified_mdblob_file).
         :return ChannelNode objects list if we can correctly load the metadata
+        :raises InvalidSignatureException: if any of the payloads in the file has a wrong signature
         """
+        if stream:
+            try:
+                chunk_data = read_verified_mdblob_file(filepath)
+            except RuntimeError:
+                self._logger.warning("Unable to decompress mdblob")
+                return []
+            return self.process_payloads_stream(iter_squashed_mdblob_payloads(chunk_data), **kwargs)
+
         with open(str_path(filepath), 'rb') as f:
             serialized_data = f.read()
 
@@ -272,24 +794,36 @@ class MetadataStore(object):
             return self.process_compressed_mdblob(serialized_data, **kwargs)
         return self.process_squashed_mdblob(serialized_data, **kwargs)
 
+    async def read_compressed_mdblob_threaded(self, compressed_data):
+        """
+        Decompress and parse a metadata blob received from the network, and check its signatures, on the reader pool.
+        This way, the DB writer only gets the DB writes, and a malformed blob never reaches it.
+        :return: list of payloads, or an empty list if the blob could not be decompressed
+        :raises InvalidSignatureException: if any of the payloads in the blob has a wrong signature
+        :raises PackError, UnknownBlobTypeException: if the blob contains a malformed payload
+        """
+        try:
+            return await get_event_loop().run_in_executor(
+                self.read_pool, read_compressed_mdblob_payloads, compressed_data
+            )
+        except RuntimeError:
+            self._logger.warning("Unable to decompress mdblob")
+            return []
+
     async def process_compressed_mdblob_threaded(self, compressed_data, **kwargs):
-        def _process_blob():
-            result = None
-            try:
-                with db_session:
-                    try:
-                        result = self.process_compressed_mdblob(compressed_data, **kwargs)
-                    except (TransactionIntegrityError, CacheIndexError) as err:
-                        self._logger.error("DB transaction error when tried to process compressed mdblob: %s", str(err))
-            # Unfortunately, we have to catch the exception twice, because Pony can raise them both on the exit from
-            # db_session, and on calling the line of code
-            except (TransactionIntegrityError, CacheIndexError) as err:
-                self._logger.error("DB transaction error when tried to process compressed mdblob: %s", str(err))
-            finally:
-                self.disconnect_thread()
-            return result
+        payloads = await self.read_compressed_mdblob_threaded(compressed_data)
+        if not payloads:
+            return []
+
+        def _process_payloads():
+            return self.process_payloads_stream(payloads, **kwargs)
 
-        return await get_event_loop().run_in_executor(None, _process_blob)
+        # The coalesced writes share a transaction, so Pony raises the integrity errors when the DB writer commits it
+        try:
+            return await self.run_write(_process_payloads, coalesce=True)
+        except (TransactionIntegrityError, CacheIndexError) as err:
+            self._logger.error("DB transaction error when tried to process compressed mdblob: %s", str(err))
+            return []
 
     def process_compressed_mdblob(self, compressed_data, **kwargs):
         try:
@@ -299,58 +833,33 @@ class MetadataStore(object):
             return []
         return self.process_squashed_mdblob(decompressed_data, **kwargs)
 
-    def process_squashed_mdblob(self, chunk_data, external_thread=False, peer_vote_for_channels=None, **kwargs):
+    def process_squashed_mdblob(self, chunk_data, **kwargs):
         """
-        Process raw concatenated payloads blob. This routine breaks the database access into smaller batches.
-        It uses a congestion-control like algorithm to determine the optimal batch size, targeting the
-        batch processing time value of self.reference_timedelta.
-
+        Process raw concatenated payloads blob.
         :param chunk_data: the blob itself, consists of one or more GigaChannel payloads concatenated together
-        :param external_thread: if this is set to True, we add some sleep between batches to allow other threads
-            to get the database lock. This is an ugly workaround for Python and asynchronous programming (locking)
-            imperfections. It only makes sense to use it when this routine runs on a non-reactor thread.
-        :peer_vote_for_channels: Channel entries found in the blob will be vote bumped for the corresponding peer
+        :param kwargs: see process_payloads_stream
         :return ChannelNode objects list if we can correctly load the metadata
+        :raises InvalidSignatureException: if any of the payloads in the blob has a wrong signature
         """
+        return self.process_payloads_stream(read_squashed_mdblob_payloads(chunk_data), **kwargs)
 
-        offset = 0
-        payload_list = []
-        while offset < len(chunk_data):
-            payload, offset = read_payload_with_offset(chunk_data, offset)
-            payload_list.append(payload)
+    def process_payloads_stream(self, payloads, peer_vote_for_channels=None, **kwargs):
+        """
+        Process a sequence of payloads. This routine breaks the database access into smaller batches
+        (see process_next_payloads_batch). The payloads are pulled from the given iterable one batch at a time,
+        so it can be a generator.
 
+        :param payloads: iterable of payloads
+        :peer_vote_for_channels: Channel entries found in the blob will be vote bumped for the corresponding peer
+        :return ChannelNode objects list if we can correctly load the metadata
+        """
+        payloads = iter(payloads)
         result = []
-        total_size = len(payload_list)
-        start = 0
-        while start < total_size:
-            end = start + self.batch_size
-            batch = payload_list[start:end]
-            batch_start_time = datetime.now()
-
-            # We separate the sessions to minimize database locking.
-            with db_session:
-                for payload in batch:
-                    result.extend(self.process_payload(payload, **kwargs))
-            if external_thread:
-                sleep(self.sleep_on_external_thread)
-
-            # Batch size adjustment
-            batch_end_time = datetime.now() - batch_start_time
-            target_coeff = batch_end_time.total_seconds() / self.reference_timedelta.total_seconds()
-            if len(batch) == self.batch_size:
-                # Adjust batch size only for full batches
-                if target_coeff < 0.8:
-                    self.batch_size += self.batch_size
-                elif target_coeff > 1.0:
-                    self.batch_size = int(float(self.batch_size) / target_coeff)
-                self.batch_size += 1  # we want to guarantee that at least something will go through
-            self._logger.debug(
-                (
-                    "Added payload batch to DB (entries, seconds): %i %f",
-                    (self.batch_size, float(batch_end_time.total_seconds())),
-                )
-            )
-            start = end
+        while True:
+            batch_result = self.process_next_payloads_batch(payloads, **kwargs)
+            if batch_result is None:
+                break
+            result.extend(batch_result)
             if self._shutting_down:
                 break
 
@@ -362,6 +871,41 @@ class MetadataStore(object):
                     self.vote_bump(c.public_key, c.id_, peer.public_key.key_to_bin()[10:])
         return result
 
+    def process_next_payloads_batch(self, payloads, **kwargs):
+        """
+        Process the next batch of payloads from an iterator in a separate db_session, to minimize database locking.
+        It uses a congestion-control like algorithm to determine the optimal batch size, targeting the
+        batch processing time value of self.reference_timedelta.
+        :param payloads: iterator of payloads
+        :param kwargs: see process_payloads_batch
+        :return: the results of process_payloads_batch for the batch, or None if there are no payloads left
+        """
+        batch = list(islice(payloads, self.batch_size))
+        if not batch:
+            return None
+        batch_start_time = datetime.now()
+
+        with db_session:
+            result = self.process_payloads_batch(batch, **kwargs)
+
+        # Batch size adjustment
+        batch_end_time = datetime.now() - batch_start_time
+        target_coeff = batch_end_time.total_seconds() / self.reference_timedelta.total_seconds()
+        if len(batch) == self.batch_size:
+            # Adjust batch size only for full batches
+            if target_coeff < 0.8:
+                self.batch_size += self.batch_size
+            elif target_coeff > 1.0:
+                self.batch_size = int(float(self.batch_size) / target_coeff)
+            self.batch_size += 1  # we want to guarantee that at least something will go through
+        self._logger.debug(
+            (
+                "Added payload batch to DB (entries, seconds): %i %f",
+                (self.batch_size, float(batch_end_time.total_seconds())),
+            )
+        )
+        return result
+
     @db_session
     def process_payload(self, payload, skip_personal_metadata_payload=True):
         """
@@ -485,6 +1029,344 @@ class MetadataStore(object):
             result.append((self.CollectionNode.from_payload(payload), UNKNOWN_COLLECTION))
         return result
 
+    @db_session
+    def process_payloads_batch(self, payloads, skip_personal_metadata_payload=True):
+        """
+        Batched version of process_payload, used for bulk ingestion of channel and gossip blobs.
+        Instead of looking up the possibly conflicting entries for each payload one by one, it fetches the keys of
+        all the candidate entries for the whole batch with a handful of "IN (...)" queries and decides what to do
+        with each payload in memory. New torrent entries, which are the vast majority of entries during a channel
+        download, are then inserted in bulk with executemany. Only inserts are done in bulk: anything more complex
+        than inserting a new signed torrent entry (updates, deletions, FFA entries, channels, collections) is passed
+        to process_payload, so the outcome is always the same as calling process_payload for each payload in order.
+        Updates and deletions change rows that may already be loaded in the Pony session cache (e.g. by the other
+        coalesced writes of the DB writer), so they must go through the ORM to keep those objects consistent.
+        :param payloads: list of payloads to work on
+        :param skip_personal_metadata_payload: see process_payload
+        :return: the same list of (<metadata or payload>, <action type>) tuples that calling process_payload
+            on each payload in turn would produce.
+        """
+        my_public_key = self.my_key.pub().key_to_bin()[10:]
+        candidates = [p for p in payloads if p.metadata_type == REGULAR_TORRENT and p.public_key != NULL_KEY]
+        known_signatures, known_infohashes, known_ids = self._fetch_batch_conflict_keys(candidates)
+
+        # The results for the entries that go into the bulk insert are filled in after the insert
+        results = []
+        pending_inserts = {}  # index in the results list -> payload
+
+        def flush_pending_inserts():
+            if pending_inserts:
+                nodes = self._insert_new_torrents(list(pending_inserts.values()))
+                for index, payload in pending_inserts.items():
+                    results[index] = [(nodes[payload.signature], UNKNOWN_TORRENT)]
+                pending_inserts.clear()
+
+        for payload in payloads:
+            if payload.metadata_type == REGULAR_TORRENT and payload.public_key != NULL_KEY:
+                if is_forbidden(payload.title + payload.tags):
+                    results.append([(None, NO_ACTION)])
+                    continue
+
+                pk_ih, pk_id = (payload.public_key, payload.infohash), (payload.public_key, payload.id_)
+                parent_local_version = known_ids.get((payload.public_key, payload.origin_id))
+                is_new_entry = not (
+                    payload.signature in known_signatures
+                    or (NULL_KEY, payload.infohash) in known_infohashes
+                    or pk_ih in known_infohashes
+                    or pk_id in known_ids
+                    or (parent_local_version is not None and parent_local_version > payload.timestamp)
+                    or (skip_personal_metadata_payload and payload.public_key == my_public_key)
+                )
+                # Later payloads in the same batch that conflict with this one will take the slow path
+                known_signatures.add(payload.signature)
+                known_infohashes.add(pk_ih)
+                known_ids.setdefault(pk_id, None)
+                if is_new_entry:
+                    pending_inserts[len(results)] = payload
+                    results.append(None)
+                    continue
+
+            # The slow path must see the database state produced by all the preceding payloads
+            flush_pending_inserts()
+            results.append(self.process_payload(payload, skip_personal_metadata_payload=skip_personal_metadata_payload))
+            if payload.metadata_type in (REGULAR_TORRENT, CHANNEL_TORRENT, COLLECTION_NODE):
+                known_signatures.add(payload.signature)
+                known_ids.setdefault((payload.public_key, payload.id_), None)
+                if payload.metadata_type != COLLECTION_NODE:
+                    known_infohashes.add((payload.public_key, payload.infohash))
+                    known_infohashes.add((NULL_KEY, payload.infohash))
+
+        flush_pending_inserts()
+        return [r for result in results for r in result]
+
+    def _fetch_batch_conflict_keys(self, payloads):
+        """
+        Fetch the keys of all the existing entries that could conflict with the given torrent payloads.
+        :return: a tuple of (signatures set, (public_key, infohash) set, dict of (public_key, id_) -> local_version).
+            Free-for-all entries are represented by NULL_KEY. local_version is None for non-channel entries.
+        """
+        orm.flush()
+        signatures, infohashes, ids = set(), set(), {}
+        if not payloads:
+            return signatures, infohashes, ids
+        ids_by_public_key = {}
+        for p in payloads:
+            ids_by_public_key.setdefault(p.public_key, set()).update((p.id_, p.origin_id))
+        cursor = self._db.get_connection().cursor()
+
+        def select_in(sql, values, *params):
+            for chunk in chunks(list(values), SQL_IN_CHUNK_SIZE):
+                cursor.execute(sql % ", ".join("?" * len(chunk)), list(params) + chunk)
+                yield from cursor.fetchall()
+
+        for (signature,) in select_in(
+            "SELECT signature FROM ChannelNode WHERE signature IN (%s)", {p.signature for p in payloads}
+        ):
+            signatures.add(bytes(signature))
+        for public_key, infohash in select_in(
+            "SELECT public_key, infohash FROM ChannelNode WHERE infohash IN (%s)", {p.infohash for p in payloads}
+        ):
+            public_key = bytes(public_key) or NULL_KEY
+            if public_key in ids_by_public_key or public_key == NULL_KEY:
+                infohashes.add((public_key, bytes(infohash)))
+        # The lookups go by public key, so they can use the (public_key, id_) index
+        for public_key, public_key_ids in ids_by_public_key.items():
+            for id_, metadata_type, local_version in select_in(
+                "SELECT id_, metadata_type, local_version FROM ChannelNode WHERE public_key = ? AND id_ IN (%s)",
+                public_key_ids,
+                database_blob(public_key),
+            ):
+                ids[(public_key, id_)] = local_version if metadata_type == CHANNEL_TORRENT else None
+        return signatures, infohashes, ids
+
+    def _insert_new_torrents(self, payloads):
+        """
+        Insert new signed torrent entries into the database in bulk, along with their TorrentState and
+        TrackerState entries, exactly as TorrentMetadata.from_payload would do.
+        The caller must make sure the entries do not conflict with the existing ones.
+        :return: dict of signature -> newly created TorrentMetadata object
+        """
+        orm.flush()
+        cursor = self._db.get_connection().cursor()
+
+        def select_rowids(table, column, values):
+            rowids = {}
+            for chunk in chunks(list(values), SQL_IN_CHUNK_SIZE):
+                placeholders = ", ".join("?" * len(chunk))
+                sql = 'SELECT "%s", rowid FROM %s WHERE "%s" IN (%s)' % (column, table, column, placeholders)
+                cursor.execute(sql, chunk)
+                rowids.update((bytes(key) if isinstance(key, bytes) else key, rowid) for key, rowid in cursor)
+            return rowids
+
+        # Existing health objects may be in the session cache with their metadata loaded,
+        # so only the new ones are inserted in bulk and the others are linked through the ORM
+        infohashes = {p.infohash for p in payloads}
+        known_health = select_rowids("TorrentState", "infohash", infohashes)
+        new_infohashes = infohashes - set(known_health)
+        cursor.executemany(sql_insert_torrent_state, [(i,) for i in new_infohashes])
+        health_rowids = select_rowids("TorrentState", "infohash", new_infohashes)
+
+        md_rows = []
+        for payload in payloads:
+            md_dict = payload.to_dict()
+            md_dict["xxx"] = default_xxx_filter.isXXXTorrentMetadataDict(md_dict)
+            md_row = generate_dict_from_pony_args(self.TorrentMetadata, skip_list=["rowid", "health"], **md_dict)
+            md_row["health"] = health_rowids.get(payload.infohash)
+            md_rows.append([sql_value(md_row[column]) for column in TORRENT_METADATA_INSERT_COLUMNS])
+        cursor.executemany(sql_insert_torrent_metadata, md_rows)
+
+        signatures = [database_blob(p.signature) for p in payloads]
+        nodes = {}
+        for chunk in chunks(signatures, SQL_IN_CHUNK_SIZE):
+            # Results are often used after the session is over, so health info must be loaded right away
+            query = self.TorrentMetadata.select(lambda g: g.signature in chunk).prefetch(self.TorrentMetadata.health)
+            nodes.update((bytes(md.signature), md) for md in query)
+
+        # The same goes for trackers, which may be cached with their torrents loaded
+        trackers = {}
+        for payload in payloads:
+            node = nodes[payload.signature]
+            if payload.infohash in known_health:
+                node.health = self.TorrentState.get(infohash=database_blob(payload.infohash))
+            url = get_uniformed_tracker_url(payload.tracker_info) if payload.tracker_info else None
+            if url:
+                if url not in trackers:
+                    trackers[url] = self.TrackerState.get(url=url) or self.TrackerState(url=url)
+                node.health.trackers.add(trackers[url])
+        return nodes
+
+    @db_session
+    def search_with_cache(self, namespace, params, search):
+        """
+        Get the results of a search from the search cache, or run the search and cache its results.
+        The cached results are valid until the entries change, or the cache TTL runs out.
+        :param namespace: the kind of the results, e.g. "rest", so the different users of the cache can keep
+            different results for the same parameters
+        :param params: dict of the search parameters. Searches with unhashable parameters are not cached
+        :param search: the function running the search. It must not return None
+        :return: the search results
+        """
+        # The changes made in this session can't be attributed to a generation
+        if self._db._get_cache().modified:
+            return search()
+        key = (namespace,) + tuple(
+            sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in params.items())
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return search()
+
+        generation = self.MetadataNode.get_generation()
+        results = self.search_cache.get(key, generation)
+        if results is None:
+            results = search()
+            self.search_cache.put(key, generation, results)
+        return results
+
+    @db_session
+    def get_entries_json(self, entity=None, **kwargs):
+        """
+        Get the JSON representations of the entries that get_entries would return, without creating the entity
+        objects. Only the columns needed for the JSON are selected, along with the TorrentState of the entries, by
+        a single SQL query.
+        :param entity: the class to query, e.g. ChannelMetadata. MetadataNode by default
+        :return: (results, next_cursor) tuple, where results is the list of the JSON-ready dicts and next_cursor
+            points at the last result. The cursor is None if there are no results, or if they are ordered by the
+            search rank.
+        """
+        entity = entity or self.MetadataNode
+        if kwargs.get("txt_filter") == "*":
+            return [], None
+        sql, params = entity.get_entries_sql(columns=sql_json_projection_columns, **kwargs)
+        rows = self._db.select(sql, globals(), params)
+        next_cursor = None
+        if rows and not entity.is_ranked_search(**kwargs):
+            next_cursor = entity.get_row_cursor(rows[-1], **kwargs)
+        return self._rows_to_json(rows), next_cursor
+
+    async def iter_entries_json(self, entity=None, chunk_size=ENTRIES_STREAM_CHUNK_SIZE, **kwargs):
+        """
+        Iterate over the JSON representations of the entries that get_entries_json would return, chunk by chunk.
+        Every chunk is fetched by a separate job on the reader pool, so the DB is not locked between the chunks, and
+        only a single chunk of the results is kept in memory at a time. The chunks follow each other by the keyset
+        cursors, so fetching the deep chunks does not slow down, except for the search results ordered by rank,
+        which are paged by OFFSET.
+        :param entity: the class to query, e.g. ChannelMetadata. MetadataNode by default
+        :param chunk_size: the maximum number of entries in a chunk
+        :return: async generator of the lists of the JSON-ready dicts
+        """
+        first = kwargs.pop("first", 1) or 1
+        last = kwargs.pop("last", None)
+        cursor = kwargs.pop("cursor", None)
+        remaining = None if last is None else max(last - first + 1, 0)
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            if cursor is None:
+                page = {"first": first, "last": first + size - 1}
+            else:
+                page = {"cursor": cursor, "first": 1, "last": size}
+            results, next_cursor = await self.run_read(
+                lambda page=page: self.get_entries_json(entity, **page, **kwargs)
+            )
+            if results:
+                yield results
+            if len(results) < size:
+                return
+            if remaining is not None:
+                remaining -= len(results)
+            if next_cursor is not None:
+                cursor = next_cursor
+            else:
+                first += len(results)
+
+    @db_session
+    def get_entries_json_by_rowids(self, rowids):
+        """
+        Get the JSON representations of the entries with the given rowids, without creating the entity objects.
+        :return: the list of the JSON-ready dicts, in the order of the rowids
+        """
+        rows = {}
+        for chunk in chunks(list(rowids), SQL_IN_CHUNK_SIZE):
+            # Only integers are put into the query text
+            for row in self._db.select(
+                "%s FROM ChannelNode cn LEFT JOIN TorrentState ts ON ts.rowid = cn.health WHERE cn.rowid IN (%s)"
+                % (sql_json_projection_columns, ", ".join(str(int(rowid)) for rowid in chunk))
+            ):
+                rows[row.rowid] = row
+        return self._rows_to_json([rows[rowid] for rowid in rowids if rowid in rows])
+
+    def _rows_to_json(self, rows):
+        """
+        Build the JSON representations of the entries from their rows, selected with sql_json_projection_columns.
+        The dirty flags of the personal collections are fetched for all the rows at once.
+        """
+        my_public_key = database_blob(self.my_key.pub().key_to_bin()[10:])
+        entities = {e._discriminator_: e for e in [self.MetadataNode] + list(self.MetadataNode._subclasses_)}
+        personal_collection_ids = [
+            row.id_
+            for row in rows
+            if row.public_key == my_public_key and issubclass(entities[row.metadata_type], self.CollectionNode)
+        ]
+        dirty_collection_ids = set()
+        for chunk in chunks(personal_collection_ids, SQL_IN_CHUNK_SIZE):
+            dirty_collection_ids.update(
+                self._db.select(
+                    "DISTINCT cn.origin_id FROM DirtyNodes d CROSS JOIN ChannelNode cn ON cn.rowid = d.rowid "
+                    "WHERE cn.public_key = $my_public_key AND cn.origin_id IN (%s)"
+                    % ", ".join(str(int(id_)) for id_ in chunk),
+                    globals(),
+                    {"my_public_key": my_public_key},
+                )
+            )
+
+        convert_date = self.TorrentMetadata.torrent_date.converters[0].sql2py
+        epoch = datetime.utcfromtimestamp(0)
+        results = []
+        for row in rows:
+            entity = entities[row.metadata_type]
+            personal = row.public_key == my_public_key
+            result = {
+                "type": row.metadata_type,
+                "id": row.id_,
+                "origin_id": row.origin_id,
+                "public_key": hexlify(row.public_key),
+                "name": row.title,
+                "category": row.tags,
+                "status": row.status,
+            }
+            if issubclass(entity, self.CollectionNode):
+                result.update(
+                    {
+                        "torrents": row.num_entries,
+                        "state": "Personal" if personal else "Preview",
+                        "dirty": personal and row.id_ in dirty_collection_ids,
+                    }
+                )
+            if issubclass(entity, self.TorrentMetadata):
+                result.update(
+                    {
+                        "infohash": hexlify(row.infohash),
+                        "size": row.size,
+                        "num_seeders": row.health_seeders,
+                        "num_leechers": row.health_leechers,
+                        "last_tracker_check": row.health_last_check,
+                        "updated": int((convert_date(row.torrent_date) - epoch).total_seconds()),
+                    }
+                )
+            if issubclass(entity, self.ChannelMetadata):
+                result.update(
+                    {
+                        "state": get_channel_state(
+                            personal, row.status, row.local_version, row.timestamp, row.subscribed
+                        ),
+                        "subscribed": bool(row.subscribed),
+                        "votes": row.votes / self.ChannelMetadata.votes_scaling,
+                    }
+                )
+            results.append(result)
+        return results
+
     @db_session
     def get_num_channels(self):
         return orm.count(self.ChannelMetadata.select(lambda g: g.metadata_type == CHANNEL_TORRENT))
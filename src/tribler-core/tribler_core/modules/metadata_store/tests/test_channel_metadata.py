@@ -2,23 +2,35 @@ from __future__ import absolute_import
 
 import os
 from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from itertools import combinations
 from time import sleep
+from unittest.mock import patch
 
 from ipv8.database import database_blob
 from ipv8.keyvault.crypto import default_eccrypto
 
-from pony.orm import ObjectNotFound, db_session
+from libtorrent import file_storage, set_piece_hashes
+
+from pony.orm import ObjectNotFound, db_session, flush
 
 from six.moves import xrange
 
 from tribler_core.exceptions import DuplicateTorrentFileError
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef
-from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import CHANNEL_DIR_NAME_LENGTH, entries_to_chunk
+from tribler_core.modules.metadata_store.orm_bindings import channel_metadata
+from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import (
+    CHANNEL_DIR_NAME_LENGTH,
+    PIECE_HASHES_CACHE_FILENAME,
+    create_piece_aligned_torrent,
+    create_torrent_from_dir,
+    entries_to_chunk,
+    serialized_entries_to_chunks,
+)
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import COMMITTED, NEW, TODELETE, UPDATED
 from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT, COLLECTION_NODE, REGULAR_TORRENT
-from tribler_core.modules.metadata_store.store import MetadataStore
+from tribler_core.modules.metadata_store.store import MetadataStore, get_channel_dir_blobs
 from tribler_core.tests.tools.base_test import TriblerCoreTest
 from tribler_core.tests.tools.common import TESTS_DATA_DIR, TORRENT_UBUNTU_FILE
 from tribler_core.utilities import path_util
@@ -341,6 +353,33 @@ class TestChannelMetadata(TriblerCoreTest):
         self.mds.process_channel_dir(my_dir, chan.public_key, chan.id_, skip_personal_metadata_payload=False)
         self.assertEqual(chan.num_entries, 363)
 
+    @db_session
+    def test_dirty_nodes_tracking(self):
+        """
+        Test that the DirtyNodes table follows the statuses of the entries
+        """
+
+        def dirty_rowids():
+            flush()
+            return set(self.mds._db.select("rowid FROM DirtyNodes"))
+
+        channel = self.mds.ChannelMetadata.create_channel('test', 'test')
+        torrent = self.mds.TorrentMetadata(infohash=random_infohash(), origin_id=channel.id_, status=NEW)
+        flush()
+        self.assertEqual({channel.rowid, torrent.rowid}, dirty_rowids())
+        self.assertEqual(
+            {(channel.rowid, channel.id_, 0), (torrent.rowid, torrent.id_, channel.id_)},
+            set(self.mds.CollectionNode.get_dirty_subtrees_rowids()),
+        )
+
+        self.mds.CollectionNode.commit_all_channels()
+        self.assertFalse(dirty_rowids())
+
+        torrent.soft_delete()
+        self.assertEqual({torrent.rowid}, dirty_rowids())
+        torrent.delete()
+        self.assertFalse(dirty_rowids())
+
     @db_session
     def test_consolidate_channel_torrent(self):
         """
@@ -364,7 +403,7 @@ class TestChannelMetadata(TriblerCoreTest):
         channel.commit_channel_torrent()
 
         self.assertEqual(1, len(channel.contents_list))
-        self.assertEqual(3, len(os.listdir(my_dir)))
+        self.assertEqual(3, len(get_channel_dir_blobs(my_dir)))
 
         torrent3 = self.mds.TorrentMetadata(
             public_key=channel.public_key, origin_id=channel.id_, status=NEW, infohash=random_infohash()
@@ -373,7 +412,7 @@ class TestChannelMetadata(TriblerCoreTest):
         torrent3.soft_delete()
 
         channel.consolidate_channel_torrent()
-        self.assertEqual(1, len(os.listdir(my_dir)))
+        self.assertEqual(1, len(get_channel_dir_blobs(my_dir)))
         self.mds.TorrentMetadata.select(lambda g: g.metadata_type == REGULAR_TORRENT).delete()
         channel.local_version = 0
         self.mds.process_channel_dir(my_dir, channel.public_key, channel.id_, skip_personal_metadata_payload=False)
@@ -386,6 +425,76 @@ class TestChannelMetadata(TriblerCoreTest):
             ]
         self.assertRaises(Exception, entries_to_chunk, md_list, chunk_size=1)
 
+    @db_session
+    def test_serialized_entries_to_chunks(self):
+        """
+        Test that the commit chunks are the same as the ones produced by entries_to_chunk, no matter if the entries
+        are serialized in place or on an executor
+        """
+        channel = self.mds.ChannelMetadata.create_channel('test', 'test')
+        md_list = [
+            self.mds.TorrentMetadata(origin_id=channel.id_, title='test' + str(x), infohash=random_infohash())
+            for x in range(0, 300)
+        ]
+        md_list[10].status = TODELETE
+        chunk_size = 10000
+
+        expected_chunks = []
+        index = 0
+        while index < len(md_list):
+            chunk, new_index = entries_to_chunk(md_list, chunk_size, start_index=index)
+            expected_chunks.append((chunk, new_index - index))
+            index = new_index
+        self.assertGreater(len(expected_chunks), 1)
+
+        serialized = self.mds.ChannelMetadata.serialize_commit_entries(md_list)
+        self.assertEqual(expected_chunks, list(serialized_entries_to_chunks(serialized, chunk_size)))
+
+        self.mds.ChannelMetadata._SERIALIZATION_BATCH_SIZE = 7
+        self.mds.ChannelMetadata._MAX_PENDING_SERIALIZATION_BATCHES = 3
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            serialized = self.mds.ChannelMetadata.serialize_commit_entries(md_list, executor=executor)
+            self.assertEqual(expected_chunks, list(serialized_entries_to_chunks(serialized, chunk_size)))
+
+        self.assertRaises(Exception, list, serialized_entries_to_chunks([md_list[0].serialized()], 1))
+
+    def test_create_torrent_from_dir_incremental(self):
+        """
+        Test that the channel torrent is built from the cached piece hashes, and only the new blobs are hashed
+        """
+        channel_dir = self.session_base_dir / 'channel'
+        channel_dir.mkdir()
+        torrent_path = self.session_base_dir / 'channel.torrent'
+
+        def add_blob(index, size):
+            with open(channel_dir / (str(index).zfill(12) + '.mdblob.lz4'), 'wb') as f:
+                f.write(os.urandom(size))
+
+        def hashed_torrent():
+            fs = file_storage()
+            for filename in sorted(os.listdir(channel_dir)):
+                if filename != PIECE_HASHES_CACHE_FILENAME:
+                    fs.add_file(os.path.join(channel_dir.name, filename), os.path.getsize(channel_dir / filename))
+            t = create_piece_aligned_torrent(fs)
+            t.set_priv(False)
+            set_piece_hashes(t, str(channel_dir.parent))
+            return t.generate()[b'info']
+
+        add_blob(1, 40000)
+        add_blob(2, 17)
+        torrent, _ = create_torrent_from_dir(channel_dir, torrent_path)
+        self.assertEqual(hashed_torrent(), torrent[b'info'])
+        self.assertTrue((channel_dir / PIECE_HASHES_CACHE_FILENAME).exists())
+
+        add_blob(3, 70000)
+        with patch.object(
+            channel_metadata, 'get_file_piece_hashes', wraps=channel_metadata.get_file_piece_hashes
+        ) as hash_mock:
+            torrent, _ = create_torrent_from_dir(channel_dir, torrent_path)
+        self.assertEqual(hashed_torrent(), torrent[b'info'])
+        self.assertEqual(1, hash_mock.call_count)
+        self.assertEqual(str(3).zfill(12) + '.mdblob.lz4', hash_mock.call_args[0][0].name)
+
     @db_session
     def test_get_channels(self):
         """
@@ -497,6 +606,34 @@ class TestChannelMetadata(TriblerCoreTest):
         self.assertEqual(7, self.mds.ChannelNode.select().count())
         self.assertRaises(ObjectNotFound, self.mds.ChannelNode.__getitem__, src_chan_rowid)
 
+    @db_session
+    def test_collapse_deleted_subtrees(self):
+        """
+        Test that the whole subtrees of deleted collections are removed, at any depth, leaving only the deleted
+        collections themselves
+        """
+        chan = self.mds.ChannelMetadata.create_channel('root', 'test')
+        kept = self.mds.CollectionNode(title='kept', origin_id=chan.id_, status=NEW)
+        kept_torrent = self.mds.TorrentMetadata(infohash=random_infohash(), origin_id=kept.id_, status=NEW)
+
+        deleted = self.mds.CollectionNode(title='deleted', origin_id=chan.id_, status=TODELETE)
+        parent, subtree = deleted, []
+        for level in range(5):
+            # A deleted collection deep inside a deleted subtree must go away as well
+            node = self.mds.CollectionNode(
+                title='level %i' % level, origin_id=parent.id_, status=TODELETE if level == 2 else COMMITTED
+            )
+            subtree.extend([node, self.mds.TorrentMetadata(infohash=random_infohash(), origin_id=node.id_)])
+            parent = node
+        flush()
+        subtree_rowids = [node.rowid for node in subtree]
+
+        self.mds.CollectionNode.collapse_deleted_subtrees()
+        self.assertFalse(self.mds.ChannelNode.exists(lambda g: g.rowid in subtree_rowids))
+        self.assertEqual(TODELETE, self.mds.CollectionNode[deleted.rowid].status)
+        self.assertEqual([kept_torrent.rowid], [node.rowid for node in kept.get_contents_recursive()])
+        self.assertEqual(3, len(chan.get_contents_recursive()))
+
     @db_session
     def test_get_parent_ids(self):
         """
@@ -1,4 +1,5 @@
 from asyncio import Future
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 from ipv8.database import database_blob
@@ -9,11 +10,12 @@ from pony.orm import db_session
 from tribler_common.simpledefs import DLSTATUS_SEEDING
 
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef
-from tribler_core.modules.metadata_store.gigachannel_manager import GigaChannelManager
+from tribler_core.modules.metadata_store.gigachannel_manager import GigaChannelManager, PROCESS_CHANNEL_DIR
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import NEW
+from tribler_core.modules.metadata_store.serialization import ChannelMetadataPayload
 from tribler_core.modules.metadata_store.store import MetadataStore
 from tribler_core.tests.tools.base_test import MockObject, TriblerCoreTest
-from tribler_core.tests.tools.common import TORRENT_UBUNTU_FILE
+from tribler_core.tests.tools.common import TESTS_DATA_DIR, TORRENT_UBUNTU_FILE
 from tribler_core.tests.tools.tools import timeout
 from tribler_core.utilities.random_utils import random_infohash
 from tribler_core.utilities.utilities import succeed
@@ -55,6 +57,7 @@ class TestGigaChannelManager(TriblerCoreTest):
             self.mock_session.dlmgr.start_download = mock_start_download
             self.mock_session.config = MockObject()
             self.mock_session.config.get_state_dir = lambda: None
+            self.mock_session.config.get_chant_processing_workers = lambda: 0
             #   self.mock_session.dlmgr.download_exists = lambda x: x == str(chan.infohash)
 
             # Check add personal channel on startup
@@ -296,3 +299,47 @@ class TestGigaChannelManager(TriblerCoreTest):
         self.mock_session.dlmgr.get_metainfo = mock_get_metainfo_good
         await self.chanman.download_channel(channel)
         self.assertTrue(self.initiated_download)
+
+    async def test_process_channel_dir_pipelined(self):
+        """
+        Test processing the blobs of a channel with the process pool and the DB writer thread
+        """
+        self.mock_session.mds.shutdown()
+        sample_dir = TESTS_DATA_DIR / 'sample_channel'
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        # The DB writer thread can't see the contents of an in-memory database
+        self.mock_session.mds = MetadataStore(self.session_base_dir / 'test.db', sample_dir, my_key)
+        self.chanman.blob_processing_pool = ProcessPoolExecutor(max_workers=1)
+        self.chanman.max_queued_blobs = 1
+
+        notified = []
+        self.mock_session.notifier.notify = lambda *args: notified.append(args)
+        payload = ChannelMetadataPayload.from_file(sample_dir / 'channel.mdblob')
+        with db_session:
+            channel = self.mock_session.mds.process_payload(payload)[0][0]
+
+        # The FtsIndex maintenance must be deferred while the blobs are processed
+        mds = self.mock_session.mds
+        deferred_triggers = []
+        process_payloads_batch = mds.process_payloads_batch
+
+        def mock_process_payloads_batch(*args, **kwargs):
+            deferred_triggers.extend(mds._db.select("name FROM sqlite_master WHERE name = 'fts_ai_deferred'"))
+            return process_payloads_batch(*args, **kwargs)
+
+        mds.process_payloads_batch = mock_process_payloads_batch
+
+        self.chanman.channels_processing_queue[channel.infohash] = (PROCESS_CHANNEL_DIR, channel)
+        await self.chanman.process_queued_channels()
+        await self.chanman.shutdown()
+
+        self.assertTrue(deferred_triggers)
+        with db_session:
+            channel = mds.ChannelMetadata.get()
+            self.assertEqual(len(channel.contents_list), 4)
+            self.assertEqual(channel.local_version, channel.timestamp)
+            # The entries are indexed once the processing is over
+            self.assertFalse(mds._db.select("name FROM sqlite_master WHERE name = 'fts_ai_deferred'"))
+            self.assertFalse(mds._db.select("SELECT count(*) FROM FtsPendingRows")[0])
+            self.assertEqual(mds.ChannelNode.select().count(), mds._db.select("SELECT count(*) FROM FtsIndex")[0])
+        self.assertEqual(1, len(notified))
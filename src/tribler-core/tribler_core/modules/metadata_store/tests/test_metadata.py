@@ -1,5 +1,6 @@
 from ipv8.database import database_blob
 from ipv8.keyvault.crypto import default_eccrypto
+from ipv8.messaging.serialization import PackError, default_serializer
 
 from pony import orm
 from pony.orm import db_session
@@ -8,12 +9,19 @@ from tribler_core.exceptions import InvalidChannelNodeException, InvalidSignatur
 from tribler_core.modules.metadata_store.serialization import (
     CHANNEL_NODE,
     ChannelNodePayload,
+    DeletedMetadataPayload,
     KeysMismatchException,
     NULL_KEY,
     NULL_SIG,
+    SIGNATURE_SIZE,
+    TorrentMetadataPayload,
+    check_payloads_signatures,
+    iter_signed_payloads,
+    read_payload_with_offset,
 )
 from tribler_core.modules.metadata_store.store import MetadataStore
 from tribler_core.tests.tools.base_test import TriblerCoreTest
+from tribler_core.utilities.random_utils import random_infohash
 from tribler_core.utilities.unicode import hexlify
 
 
@@ -65,6 +73,91 @@ class TestMetadata(TriblerCoreTest):
             # Test bypass signature check
             md_type._payload_class.from_signed_blob(serialized3, check_signature=False)
 
+    @db_session
+    def test_read_payload_from_memoryview(self):
+        """
+        Test reading payloads from a memoryview over a blob, checking signatures against the original bytes
+        """
+        md_list = [
+            self.mds.TorrentMetadata(title="test" + str(x), infohash=database_blob(random_infohash())) for x in range(3)
+        ]
+        blob = b''.join(md.serialized() for md in md_list)
+
+        offset = 0
+        for md in md_list:
+            payload, offset = read_payload_with_offset(memoryview(blob), offset)
+            self.assertEqual(payload.signed_data(), default_serializer.pack_multiple(payload.to_pack_list())[0])
+            self.assertEqual(payload.serialized(), md.serialized())
+        self.assertEqual(offset, len(blob))
+
+        # Truncated signatures should be detected even if the signature check is skipped
+        last_offset = len(blob) - len(md_list[-1].serialized())
+        self.assertRaises(
+            InvalidSignatureException,
+            read_payload_with_offset,
+            memoryview(blob)[:-5],
+            offset=last_offset,
+            check_signature=False,
+        )
+
+    @db_session
+    def test_iter_signed_payloads(self):
+        """
+        Test parsing a blob into payloads together with the exact bytes covered by their signatures
+        """
+        md_list = [
+            self.mds.TorrentMetadata(title="test" + str(x), infohash=database_blob(random_infohash())) for x in range(3)
+        ]
+        blob = b''.join(md.serialized() for md in md_list)
+
+        signed_payloads = list(iter_signed_payloads(blob))
+        self.assertEqual([payload.serialized() for payload, _ in signed_payloads], [md.serialized() for md in md_list])
+        self.assertEqual(
+            [bytes(data) for _, data in signed_payloads], [md.serialized()[:-SIGNATURE_SIZE] for md in md_list]
+        )
+        check_payloads_signatures(signed_payloads)
+
+    @db_session
+    def test_read_payload_detached_from_blob(self):
+        """
+        Test that payloads read from a blob do not hold on to it, and are serialized from their current fields
+        """
+        md = self.mds.TorrentMetadata(title="test", infohash=database_blob(random_infohash()))
+        blob = bytearray(md.serialized())
+        payload = read_payload_with_offset(blob)[0]
+
+        # The blob can be resized, as no views of it are left around
+        blob.extend(b"\x00" * 10)
+
+        payload.title = "changed"
+        self.assertEqual(payload.signed_data(), default_serializer.pack_multiple(payload.to_pack_list())[0])
+        self.assertNotEqual(payload.serialized(), md.serialized())
+
+    @db_session
+    def test_payload_codecs_wire_compatibility(self):
+        """
+        Test that the precompiled payload codecs produce the same bytes as the generic IPv8 serializer
+        """
+        channel = self.mds.ChannelMetadata(title="chan", infohash=database_blob(random_infohash()))
+        entries = [
+            self.mds.ChannelNode(),
+            self.mds.CollectionNode(title="coll", tags="\u0442\u044d\u0433", num_entries=3),
+            self.mds.TorrentMetadata(title="test", tags="video", infohash=database_blob(random_infohash())),
+            channel,
+        ]
+        payloads = [md._payload_class(**md.to_dict()) for md in entries]
+        payloads.append(DeletedMetadataPayload.from_signed_blob(channel.serialized_delete()))
+        for payload in payloads:
+            packed = default_serializer.pack_multiple(payload.to_pack_list())[0]
+            self.assertEqual(packed, payload.signed_data())
+            values, end_offset = payload._codec.unpack_from(packed)
+            self.assertEqual(default_serializer.unpack_multiple(payload.format_list, packed), (values, end_offset))
+            # Slotted payloads should not carry the per-object dict around
+            self.assertFalse(hasattr(payload, '__dict__'))
+
+        self.assertRaises(PackError, ChannelNodePayload._codec.unpack_from, packed[:10])
+        self.assertRaises(PackError, TorrentMetadataPayload._codec.unpack_from, payloads[2].signed_data()[:-3])
+
     @db_session
     def test_ffa_serialization(self):
         """
@@ -147,3 +240,39 @@ class TestMetadata(TriblerCoreTest):
         orm.flush()
         metadata_payload = ChannelNodePayload(**metadata_dict)
         self.assertTrue(self.mds.ChannelNode.from_payload(metadata_payload))
+
+    @db_session
+    def test_check_payloads_signatures(self):
+        """
+        Test checking the signatures of a bunch of payloads in bulk
+        """
+        key = default_eccrypto.generate_key(u"curve25519")
+        blobs = [self.mds.ChannelNode().serialized() for _ in range(5)]
+        blobs.extend(self.mds.ChannelNode(sign_with=key).serialized() for _ in range(5))
+        blobs.append(self.mds.ChannelNode.from_dict({"public_key": b"", "id_": 123}).serialized())
+        signed_payloads = [
+            (ChannelNodePayload.from_signed_blob(blob, check_signature=False), blob[:-SIGNATURE_SIZE]) for blob in blobs
+        ]
+
+        check_payloads_signatures(signed_payloads)
+
+        # A single wrong signature should fail the whole batch
+        wrong_blob = blobs[7][:-5] + b"\xee" * 5
+        wrong_payload = ChannelNodePayload.from_signed_blob(wrong_blob, check_signature=False)
+        self.assertRaises(
+            InvalidSignatureException,
+            check_payloads_signatures,
+            signed_payloads + [(wrong_payload, wrong_blob[:-SIGNATURE_SIZE])],
+        )
+
+        # The signatures are checked against the bytes the payloads were read from, not against the payloads
+        payload, signed_data = signed_payloads[7]
+        tampered_data = signed_data[:-1] + bytes([signed_data[-1] ^ 0xFF])
+        self.assertRaises(InvalidSignatureException, check_payloads_signatures, [(payload, tampered_data)])
+
+        # FFA payloads must go with the null signature
+        ffa_blob = blobs[-1][:-5] + b"\xee" * 5
+        ffa_payload = ChannelNodePayload.from_signed_blob(ffa_blob, check_signature=False)
+        self.assertRaises(
+            InvalidSignatureException, check_payloads_signatures, [(ffa_payload, ffa_blob[:-SIGNATURE_SIZE])]
+        )
@@ -1,13 +1,21 @@
 import os
 import random
 import string
+import threading
+from asyncio import ensure_future, get_event_loop, sleep, wrap_future
 from binascii import unhexlify
+from datetime import datetime, timedelta
+from unittest.mock import patch
 
 from ipv8.database import database_blob
 from ipv8.keyvault.crypto import default_eccrypto
 
+import lz4.frame
+
 from pony.orm import db_session, flush
+from pony.orm.dbapiprovider import OperationalError
 
+from tribler_core.exceptions import InvalidSignatureException
 from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import CHANNEL_DIR_NAME_LENGTH, entries_to_chunk
 from tribler_core.modules.metadata_store.orm_bindings.channel_node import NEW
 from tribler_core.modules.metadata_store.serialization import (
@@ -24,6 +32,9 @@ from tribler_core.modules.metadata_store.store import (
     UNKNOWN_CHANNEL,
     UNKNOWN_TORRENT,
     UPDATED_OUR_VERSION,
+    get_channel_dir_blobs,
+    iter_squashed_mdblob_payloads,
+    read_verified_mdblob_file,
 )
 from tribler_core.tests.tools.base_test import TriblerCoreTest
 from tribler_core.tests.tools.common import TESTS_DATA_DIR
@@ -148,6 +159,28 @@ class TestMetadataStore(TriblerCoreTest):
             ],
         )
 
+    @db_session
+    def test_squash_mdblobs_wrong_signature(self):
+        """
+        Test that a single wrong signature in a blob prevents processing all of its entries
+        """
+        md_list = [
+            self.mds.TorrentMetadata(title='test' + str(x), infohash=database_blob(random_infohash()))
+            for x in range(0, 10)
+        ]
+        serialized_list = [md.serialized() for md in md_list]
+        serialized_list[5] = serialized_list[5][:-5] + b"\xee" * 5
+        for md in md_list:
+            md.delete()
+
+        self.assertRaises(
+            InvalidSignatureException,
+            self.mds.process_squashed_mdblob,
+            b''.join(serialized_list),
+            skip_personal_metadata_payload=False,
+        )
+        self.assertFalse(self.mds.TorrentMetadata.select()[:])
+
     @db_session
     def test_multiple_squashed_commit_and_read(self):
         """
@@ -231,6 +264,284 @@ class TestMetadataStore(TriblerCoreTest):
         self.assertEqual(channel.timestamp, 1565621688015)
         self.assertEqual(channel.local_version, channel.timestamp)
 
+    async def test_process_channel_blob_threaded(self):
+        """
+        Test that the DB writer processes channel blobs batch by batch, each batch in a separate writer task
+        """
+        self.mds.shutdown()
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        self.mds = MetadataStore(self.session_base_dir / 'test.db', self.session_base_dir, my_key)
+        payload = ChannelMetadataPayload.from_file(CHANNEL_METADATA)
+        with db_session:
+            channel = self.mds.process_payload(payload)[0][0]
+            public_key, id_ = channel.public_key, channel.id_
+
+        batch_threads = []
+        process_next_payloads_batch = self.mds.process_next_payloads_batch
+
+        def mock_process_next_payloads_batch(*args, **kwargs):
+            batch_threads.append(threading.current_thread().name)
+            return process_next_payloads_batch(*args, **kwargs)
+
+        self.mds.process_next_payloads_batch = mock_process_next_payloads_batch
+        # Keep the batches at a single payload
+        self.mds.batch_size = 1
+        self.mds.reference_timedelta = timedelta(microseconds=1)
+        blobs = get_channel_dir_blobs(CHANNEL_DIR)
+        for blob_sequence_number, filepath in blobs:
+            # The blob is only read from the disk when its signatures are checked
+            blob_path = self.session_base_dir / filepath.name
+            blob_path.write_bytes(filepath.read_bytes())
+            chunk_data = read_verified_mdblob_file(blob_path)
+            blob_path.unlink()
+            self.assertTrue(
+                await self.mds.process_channel_blob_threaded(public_key, id_, blob_sequence_number, chunk_data)
+            )
+        # Blobs that are already processed are skipped
+        self.assertTrue(await self.mds.process_channel_blob_threaded(public_key, id_, blobs[0][0], b'not parsed'))
+
+        self.assertEqual({self.mds.writer.name}, set(batch_threads))
+        with db_session:
+            channel = self.mds.ChannelMetadata.get(public_key=public_key, id_=id_)
+            self.assertEqual(len(channel.contents_list), 4)
+            self.assertGreater(len(batch_threads), len(channel.contents_list))
+            self.assertEqual(channel.local_version, channel.timestamp)
+
+    def test_read_verified_mdblob_file(self):
+        """
+        Test reading and checking compressed and uncompressed mdblob files, and parsing the payloads of the result
+        """
+        for filepath in CHANNEL_DIR.iterdir():
+            chunk_data = filepath.read_bytes()
+            if filepath.suffix == '.lz4':
+                chunk_data = lz4.frame.decompress(chunk_data)
+            squashed_path = self.session_base_dir / 'squashed.mdblob'
+            squashed_path.write_bytes(chunk_data)
+            for path in [filepath, squashed_path]:
+                self.assertEqual(chunk_data, read_verified_mdblob_file(path))
+            payloads = list(iter_squashed_mdblob_payloads(chunk_data))
+            self.assertTrue(payloads)
+            self.assertEqual(chunk_data, b"".join(p.signed_data() + p.signature for p in payloads))
+
+        # Truncated blobs must not be silently accepted
+        squashed_path.write_bytes(chunk_data[:-1])
+        with self.assertRaises(InvalidSignatureException):
+            read_verified_mdblob_file(squashed_path)
+
+    def test_process_mdblob_file_stream(self):
+        """
+        Test that streaming an mdblob file gives the same results as loading it as a whole
+        """
+        mds2 = MetadataStore(":memory:", self.session_base_dir, default_eccrypto.generate_key(u"curve25519"))
+        payload = ChannelMetadataPayload.from_file(CHANNEL_METADATA)
+        self.mds.process_payload(payload)
+        mds2.process_payload(payload)
+        self.mds.batch_size = 1
+        for filepath in sorted(CHANNEL_DIR.iterdir()):
+            with db_session:
+                results = self.mds.process_mdblob_file(filepath, stream=True)
+                results2 = mds2.process_mdblob_file(filepath, stream=False)
+                self.assertTrue(results)
+                self.assertEqual(
+                    [(md and md.signature, action) for md, action in results2],
+                    [(md and md.signature, action) for md, action in results],
+                )
+        mds2.shutdown()
+
+    @db_session
+    def test_process_mdblob_file_stream_wrong_signature(self):
+        """
+        Test that a wrong signature at the end of a streamed mdblob file prevents processing all of its entries
+        """
+        md_list = [
+            self.mds.TorrentMetadata(title='test' + str(x), infohash=database_blob(random_infohash()))
+            for x in range(0, 10)
+        ]
+        serialized_list = [md.serialized() for md in md_list]
+        serialized_list[8] = serialized_list[8][:-5] + b"\xee" * 5
+        for md in md_list:
+            md.delete()
+        filepath = self.session_base_dir / 'wrong_signature.mdblob'
+        filepath.write_bytes(b''.join(serialized_list))
+
+        self.mds.batch_size = 2
+        with self.assertRaises(InvalidSignatureException):
+            self.mds.process_mdblob_file(filepath, stream=True, skip_personal_metadata_payload=False)
+        self.assertFalse(self.mds.TorrentMetadata.select()[:])
+
+    def test_deferred_fts_indexing(self):
+        """
+        Test that entries added while FtsIndex maintenance is deferred become searchable afterwards
+        """
+        with db_session:
+            self.mds.TorrentMetadata(title='before', infohash=database_blob(random_infohash()))
+
+        with self.mds.deferred_fts_indexing():
+            with self.mds.deferred_fts_indexing():
+                with db_session:
+                    self.mds.TorrentMetadata(title='during', infohash=database_blob(random_infohash()))
+            with db_session:
+                self.mds.TorrentMetadata.get(title='before').title = 'updated'
+                self.assertFalse(self.mds.TorrentMetadata.search_keyword('during')[:])
+                self.assertFalse(self.mds.TorrentMetadata.search_keyword('updated')[:])
+
+        with db_session:
+            self.assertEqual(1, self.mds.TorrentMetadata.search_keyword('during').count())
+            self.assertEqual(1, self.mds.TorrentMetadata.search_keyword('updated').count())
+            self.assertFalse(self.mds._db.select("SELECT * FROM FtsPendingRows"))
+            self.mds.TorrentMetadata(title='after', infohash=database_blob(random_infohash()))
+            self.assertEqual(1, self.mds.TorrentMetadata.search_keyword('after').count())
+
+    def test_deferred_fts_indexing_crash_recovery(self):
+        """
+        Test that the entries left unindexed by an interrupted bulk import are indexed on the next start
+        """
+        self.mds.shutdown()
+        db_path = self.session_base_dir / 'test.db'
+        self.mds = MetadataStore(db_path, self.session_base_dir, default_eccrypto.generate_key(u"curve25519"))
+        self.mds.fts_rebuild_threshold = 0
+
+        self.mds.deferred_fts_indexing().__enter__()
+        with db_session:
+            self.mds.TorrentMetadata(title='abc', infohash=database_blob(random_infohash()))
+        self.mds.shutdown()
+
+        self.mds = MetadataStore(db_path, self.session_base_dir, default_eccrypto.generate_key(u"curve25519"))
+        with db_session:
+            self.assertEqual(1, self.mds.TorrentMetadata.search_keyword('abc').count())
+            self.mds.TorrentMetadata(title='def', infohash=database_blob(random_infohash()))
+            self.assertEqual(1, self.mds.TorrentMetadata.search_keyword('def').count())
+
+    async def test_read_and_write_pools(self):
+        """
+        Test that the reads are not blocked by a running write, and that the reader pool can't write
+        """
+        self.mds.shutdown()
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        self.mds = MetadataStore(self.session_base_dir / 'test.db', self.session_base_dir, my_key)
+        with db_session:
+            self.mds.TorrentMetadata(title='abc', infohash=database_blob(random_infohash()))
+            self.assertEqual('wal', self.mds._db.execute("PRAGMA journal_mode").fetchone()[0])
+
+        write_started = threading.Event()
+        finish_write = threading.Event()
+
+        def write():
+            with db_session:
+                self.mds.TorrentMetadata(title='def', infohash=database_blob(random_infohash()))
+                flush()
+                write_started.set()
+                finish_write.wait(10)
+
+        def count():
+            with db_session:
+                return self.mds.TorrentMetadata.select().count()
+
+        write_job = ensure_future(self.mds.run_write(write))
+        await get_event_loop().run_in_executor(None, write_started.wait, 10)
+        # The read sees the last committed state of the DB, instead of waiting for the writer
+        self.assertEqual(1, await self.mds.run_read(count))
+        finish_write.set()
+        await write_job
+        self.assertEqual(2, await self.mds.run_read(count))
+
+        def illegal_write():
+            with db_session:
+                self.mds._db.execute("DELETE FROM ChannelNode")
+
+        with self.assertRaises(OperationalError):
+            await self.mds.run_read(illegal_write)
+
+    async def test_writer_coalescing(self):
+        """
+        Test that the DB writer executes the queued small writes in a single transaction, without losing the other
+        writes of the transaction to a failing one
+        """
+        self.mds.shutdown()
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        self.mds = MetadataStore(self.session_base_dir / 'test.db', self.session_base_dir, my_key)
+        self.mds.writer.coalesce_time = 0.5
+
+        def add_torrent(title):
+            self.mds.TorrentMetadata(title=title, infohash=database_blob(random_infohash()))
+            return title
+
+        def fail():
+            self.mds.TorrentMetadata(title='failed', infohash=database_blob(random_infohash()))
+            raise ValueError()
+
+        # Keep the writer busy, so the following writes get queued together
+        finish_write = threading.Event()
+        self.mds.writer.submit(finish_write.wait, 10)
+        futures = [self.mds.writer.submit(add_torrent, 'torrent %i' % i, coalesce=True) for i in range(5)]
+        futures.append(self.mds.writer.submit(fail, coalesce=True))
+        self.assertGreaterEqual(self.mds.writer.get_stats()["max_queue_depth"], 6)
+        finish_write.set()
+
+        self.assertListEqual(['torrent %i' % i for i in range(5)], [await wrap_future(f) for f in futures[:5]])
+        with self.assertRaises(ValueError):
+            await wrap_future(futures[5])
+        with db_session:
+            self.assertEqual(5, self.mds.TorrentMetadata.select().count())
+        stats = self.mds.writer.get_stats()
+        self.assertEqual(7, stats["tasks"])
+        self.assertEqual(6, stats["coalesced_tasks"])
+        self.assertEqual(2, stats["batches"])
+        self.assertEqual(0, stats["queue_depth"])
+
+    async def test_drain_writes(self):
+        """
+        Test that draining the DB writer waits for the queued writes, and does not fail after the shutdown
+        """
+        finish_write = threading.Event()
+        future = self.mds.writer.submit(finish_write.wait, 10)
+        drained = ensure_future(self.mds.drain_writes())
+        await sleep(0.1)
+        self.assertFalse(drained.done())
+        finish_write.set()
+        await drained
+        self.assertTrue(future.done())
+
+        self.mds.shutdown()
+        await self.mds.drain_writes()
+        with self.assertRaises(RuntimeError):
+            await self.mds.run_write(lambda: None)
+
+    async def test_process_compressed_mdblob_threaded_integrity_error(self):
+        """
+        Test that the integrity errors raised when the DB writer commits a coalesced blob are not passed to the caller
+        """
+        self.mds.shutdown()
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        self.mds = MetadataStore(self.session_base_dir / 'test.db', self.session_base_dir, my_key)
+        with db_session:
+            torrent = self.mds.TorrentMetadata(title='abc', infohash=database_blob(random_infohash()))
+            id_ = torrent.id_
+            blob = lz4.frame.compress(torrent.serialized())
+
+        def add_duplicate(*_, **__):
+            # Inserting an entry with the same (public_key, id_) only fails when the transaction is flushed
+            self.mds.TorrentMetadata(title='def', id_=id_, infohash=database_blob(random_infohash()))
+            return []
+
+        with patch.object(self.mds, 'process_payloads_stream', add_duplicate):
+            self.assertEqual([], await self.mds.process_compressed_mdblob_threaded(blob))
+        with db_session:
+            self.assertEqual(1, self.mds.TorrentMetadata.select().count())
+
+    async def test_process_compressed_mdblob_threaded_invalid_signature(self):
+        """
+        Test that a blob with a wrong signature is rejected before it gets to the DB writer
+        """
+        with db_session:
+            serialized = self.mds.TorrentMetadata(title='abc', infohash=database_blob(random_infohash())).serialized()
+        blob = lz4.frame.compress(serialized[:-1] + bytes([serialized[-1] ^ 1]))
+        tasks = self.mds.writer.get_stats()["tasks"]
+        with self.assertRaises(InvalidSignatureException):
+            await self.mds.process_compressed_mdblob_threaded(blob)
+        self.assertEqual([], await self.mds.process_compressed_mdblob_threaded(b'not lz4'))
+        self.assertEqual(tasks, self.mds.writer.get_stats()["tasks"])
+
     @db_session
     def test_process_payload(self):
         def get_payloads(entity_class):
@@ -389,6 +700,86 @@ class TestMetadataStore(TriblerCoreTest):
             GOT_NEWER_VERSION, self.mds.process_payload(payload_old, skip_personal_metadata_payload=False)[0][1]
         )
 
+    def test_process_payloads_batch(self):
+        self.mds.ChannelNode._my_key = default_eccrypto.generate_key(u"curve25519")
+
+        def make_payload(**kwargs):
+            torrent = self.mds.TorrentMetadata(infohash=database_blob(random_infohash()), **kwargs)
+            payload = torrent._payload_class.from_signed_blob(torrent.serialized())
+            torrent_dict = torrent.to_dict()
+            torrent.delete()
+            flush()
+            return payload, torrent_dict
+
+        with db_session:
+            tracker = "http://tracker.org/announce"
+            new_entries = [make_payload(title="torrent %i" % i, tracker_info=tracker) for i in range(5)]
+            known_payload, known_dict = make_payload(title="known")
+            older_payload, _ = make_payload(title="older", id_=known_dict["id_"], timestamp=known_dict["timestamp"] - 1)
+            forbidden_payload, _ = make_payload(title="9yo ponies")
+            self.mds.process_payload(known_payload)
+
+        payloads = [p for p, _ in new_entries[:2]] + [known_payload, older_payload, forbidden_payload]
+        payloads += [p for p, _ in new_entries[2:]] + [new_entries[0][0]]
+        with db_session, patch.object(self.mds, "process_payload", wraps=self.mds.process_payload) as process_payload:
+            results = self.mds.process_payloads_batch(payloads)
+            # Only the entries conflicting with the existing ones should take the slow path
+            self.assertEqual(3, process_payload.call_count)
+
+            self.assertEqual(
+                [UNKNOWN_TORRENT] * 2 + [NO_ACTION, GOT_NEWER_VERSION, NO_ACTION] + [UNKNOWN_TORRENT] * 3 + [NO_ACTION],
+                [action for _, action in results],
+            )
+            self.assertEqual(
+                [p.signature for p in payloads[:2]], [database_blob(node.signature) for node, _ in results[:2]]
+            )
+
+        with db_session:
+            # The bulk-inserted entries must be identical to the ones created through the ORM
+            for payload, torrent_dict in new_entries:
+                torrent = self.mds.TorrentMetadata.get(signature=payload.signature)
+                for key in ["title", "timestamp", "id_", "origin_id", "xxx", "status", "tracker_info"]:
+                    self.assertEqual(torrent_dict[key], torrent.to_dict()[key])
+                self.assertIsInstance(torrent.added_on, datetime)
+                self.assertEqual(payload.infohash, torrent.health.infohash)
+                health = torrent.health
+                self.assertEqual((0, 0, 0), (health.seeders, health.leechers, health.last_check))
+                self.assertEqual([tracker], [t.url for t in torrent.health.trackers])
+            self.assertEqual(5, self.mds.TorrentMetadata.search_keyword("torrent").count())
+
+    def test_process_payloads_batch_cached_collections(self):
+        """
+        Test that batch-processing entries that refer to cached health and tracker objects with their collections
+        loaded keeps these collections consistent
+        """
+        self.mds.ChannelNode._my_key = default_eccrypto.generate_key(u"curve25519")
+        tracker = "http://tracker.org/announce"
+        with db_session:
+            infohash = database_blob(random_infohash())
+            self.mds.TorrentMetadata(title="old", infohash=infohash, tracker_info=tracker)
+        self.mds.ChannelNode._my_key = default_eccrypto.generate_key(u"curve25519")
+        with db_session:
+            payloads = []
+            for title, torrent_infohash in [("same infohash", infohash), ("new", database_blob(random_infohash()))]:
+                torrent = self.mds.TorrentMetadata(title=title, infohash=torrent_infohash, tracker_info=tracker)
+                payloads.append(torrent._payload_class.from_signed_blob(torrent.serialized()))
+                torrent.delete()
+            # Only the health of the existing entry must remain
+            self.mds.TorrentState.get(infohash=torrent_infohash).delete()
+        self.mds.ChannelNode._my_key = default_eccrypto.generate_key(u"curve25519")
+
+        with db_session:
+            health = self.mds.TorrentState.get(infohash=infohash)
+            tracker_state = self.mds.TrackerState.get(url=tracker)
+            self.assertEqual(1, len(health.metadata))
+            self.assertEqual(1, len(tracker_state.torrents))
+
+            results = self.mds.process_payloads_batch(payloads)
+            self.assertEqual([UNKNOWN_TORRENT] * 2, [action for _, action in results])
+            self.assertEqual(2, len(health.metadata))
+            self.assertEqual(2, len(tracker_state.torrents))
+            self.assertEqual(3, self.mds.TorrentMetadata.select().count())
+
     @db_session
     def test_get_num_channels_nodes(self):
         self.mds.ChannelMetadata(title='testchan', id_=0, infohash=database_blob(random_infohash()))
@@ -417,3 +808,106 @@ class TestMetadataStore(TriblerCoreTest):
 
         self.assertEqual(4, self.mds.get_num_channels())
         self.assertEqual(3, self.mds.get_num_torrents())
+
+    @db_session
+    def test_get_entries_json(self):
+        """
+        Test that the JSON projection of the entries is the same as produced by their to_simple_dict methods
+        """
+        channel = self.mds.ChannelMetadata.create_channel('channel')
+        collection = self.mds.CollectionNode(origin_id=channel.id_, title='collection')
+        self.mds.TorrentMetadata(origin_id=collection.id_, title='new torrent', infohash=random_infohash(), status=NEW)
+        for ind in range(4):
+            torrent = self.mds.TorrentMetadata(origin_id=channel.id_, title='torrent%i' % ind, infohash=b'%20i' % ind)
+            torrent.health.seeders = ind
+        self.mds.ChannelMetadata(
+            title='other channel',
+            public_key=unhexlify('1' * 20),
+            signature=unhexlify('1' * 64),
+            skip_key_check=True,
+            infohash=database_blob(random_infohash()),
+            subscribed=True,
+            local_version=1,
+            timestamp=2,
+            votes=3.0,
+        )
+        flush()
+
+        for entity, args in [
+            (self.mds.ChannelMetadata, dict(origin_id=0)),
+            (self.mds.MetadataNode, dict(channel_pk=channel.public_key, origin_id=channel.id_, sort_by='HEALTH')),
+            (self.mds.MetadataNode, dict(txt_filter='torrent*', first=2, last=3)),
+            (self.mds.MetadataNode, dict(sort_by='title', sort_desc=False)),
+        ]:
+            entries = entity.get_entries(**args)
+            results, next_cursor = self.mds.get_entries_json(entity, **args)
+            self.assertListEqual([entry.to_simple_dict() for entry in entries], results, msg=str(args))
+            if entity.is_ranked_search(**args):
+                self.assertIsNone(next_cursor)
+            else:
+                self.assertEqual(entity.get_entry_cursor(entries[-1], **args), next_cursor)
+
+        entries = list(self.mds.MetadataNode.select()[:])[::-1]
+        results = self.mds.get_entries_json_by_rowids([entry.rowid for entry in entries])
+        self.assertListEqual([entry.to_simple_dict() for entry in entries], results)
+
+    async def test_iter_entries_json(self):
+        """
+        Test that iterating over the entries chunk by chunk yields the same entries as fetching them all at once
+        """
+        self.mds.shutdown()
+        my_key = default_eccrypto.generate_key(u"curve25519")
+        self.mds = MetadataStore(self.session_base_dir / 'test.db', self.session_base_dir, my_key)
+        with db_session:
+            for ind in range(10):
+                self.mds.TorrentMetadata(title='torrent%i' % ind, infohash=random_infohash())
+
+        with db_session:
+            _, cursor = self.mds.get_entries_json(sort_by='title', first=1, last=2)
+
+        for args in [
+            dict(sort_by='title', sort_desc=False),
+            dict(sort_by='title', first=2, last=8),
+            dict(sort_by='title', first=1, last=5, cursor=cursor),
+            dict(txt_filter='torrent*', first=3),
+        ]:
+            with db_session:
+                expected, _ = self.mds.get_entries_json(**args)
+            chunks = [chunk async for chunk in self.mds.iter_entries_json(chunk_size=3, **args)]
+            self.assertTrue(all(0 < len(chunk) <= 3 for chunk in chunks))
+            self.assertListEqual(expected, [entry for chunk in chunks for entry in chunk], msg=str(args))
+
+        chunks = [chunk async for chunk in self.mds.iter_entries_json(chunk_size=3, txt_filter='nothing')]
+        self.assertListEqual([], chunks)
+
+    def test_search_with_cache(self):
+        """
+        Test that the search results are cached until the entries change or the cache TTL runs out
+        """
+        with db_session:
+            self.mds.TorrentMetadata(title='torrent', infohash=random_infohash())
+
+        def search():
+            return [entry.title for entry in self.mds.MetadataNode.get_entries(txt_filter='torrent*')]
+
+        with db_session:
+            self.assertListEqual(['torrent'], self.mds.search_with_cache("test", {"txt_filter": "torrent*"}, search))
+            self.assertListEqual(['torrent'], self.mds.search_with_cache("test", {"txt_filter": "torrent*"}, search))
+            self.assertEqual(1, self.mds.search_cache.hits)
+
+            # Searches with other parameters or in other namespaces are cached separately
+            self.mds.search_with_cache("other", {"txt_filter": "torrent*"}, search)
+            self.assertEqual(2, self.mds.search_cache.misses)
+
+        # Adding an entry invalidates the cache
+        with db_session:
+            self.mds.TorrentMetadata(title='torrent 2', infohash=random_infohash())
+        with db_session:
+            results = self.mds.search_with_cache("test", {"txt_filter": "torrent*"}, search)
+        self.assertCountEqual(['torrent', 'torrent 2'], results)
+
+        # The results expire after the cache TTL
+        with patch('tribler_core.modules.metadata_store.query_cache.time.monotonic', lambda: float('inf')), db_session:
+            self.mds.search_with_cache("test", {"txt_filter": "torrent*"}, search)
+        self.assertEqual(1, self.mds.search_cache.hits)
+        self.assertEqual(4, self.mds.search_cache.misses)
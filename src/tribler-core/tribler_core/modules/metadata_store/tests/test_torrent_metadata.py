@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from unittest.mock import patch
 
 from ipv8.database import database_blob
 from ipv8.keyvault.crypto import default_eccrypto
@@ -9,9 +10,9 @@ from pony.orm import db_session
 
 from tribler_core.modules.libtorrent.torrentdef import TorrentDef
 from tribler_core.modules.metadata_store.discrete_clock import clock
-from tribler_core.modules.metadata_store.orm_bindings.channel_node import TODELETE
-from tribler_core.modules.metadata_store.orm_bindings.torrent_metadata import tdef_to_metadata_dict
-from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT, REGULAR_TORRENT
+from tribler_core.modules.metadata_store.orm_bindings.channel_node import COMMITTED, LEGACY_ENTRY, TODELETE
+from tribler_core.modules.metadata_store.orm_bindings.torrent_metadata import NULL_KEY_SUBST, tdef_to_metadata_dict
+from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT, COLLECTION_NODE, REGULAR_TORRENT
 from tribler_core.modules.metadata_store.store import MetadataStore
 from tribler_core.tests.tools.base_test import TriblerCoreTest
 from tribler_core.tests.tools.common import TORRENT_UBUNTU_FILE
@@ -119,6 +120,59 @@ class TestTorrentMetadata(TriblerCoreTest):
         results = self.mds.TorrentMetadata.search_keyword("foo")[:]
         self.assertEqual(len(results), 1)
 
+    @db_session
+    def test_search_ranked(self):
+        """
+        Test ranking the search results by the relevance, the health of the torrents and the votes of the channels
+        """
+        dead = self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="ubuntu iso"))
+        healthy = self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="ubuntu iso"))
+        healthy.health.seeders = 100
+        self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="debian iso"))
+        orm.flush()
+        results = self.mds.TorrentMetadata.get_entries(txt_filter="ubuntu")
+        self.assertEqual([healthy.rowid, dead.rowid], [r.rowid for r in results])
+        results = self.mds.TorrentMetadata.get_entries(txt_filter="ubuntu", first=2)
+        self.assertEqual([dead.rowid], [r.rowid for r in results])
+
+        # Entries from the channels with more votes go first
+        obscure = self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="arch iso"))
+        key2 = default_eccrypto.generate_key(u"curve25519")
+        popular_channel = self.mds.ChannelMetadata(title="popular", infohash=random_infohash(), sign_with=key2)
+        popular_channel.votes = self.mds.ChannelMetadata.votes_scaling
+        popular = self.mds.TorrentMetadata.from_dict(
+            dict(rnd_torrent(), title="arch iso", origin_id=popular_channel.id_, sign_with=key2)
+        )
+        orm.flush()
+        results = self.mds.TorrentMetadata.get_entries(txt_filter="arch")
+        self.assertEqual([popular.rowid, obscure.rowid], [r.rowid for r in results])
+
+        # Filters are applied before deduplicating the results by infohash
+        copy = self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="arch iso", infohash=popular.infohash))
+        orm.flush()
+        results = self.mds.TorrentMetadata.get_entries(txt_filter="arch", channel_pk=copy.public_key)
+        self.assertEqual([obscure.rowid, copy.rowid], [r.rowid for r in results])
+        self.assertEqual(2, self.mds.TorrentMetadata.get_total_count(txt_filter="arch"))
+
+    @db_session
+    def test_search_max_candidates(self):
+        """
+        Test that the searches only consider the best text matches, whatever the filters and the sort order
+        """
+        best = [self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="ubuntu")) for _ in range(3)]
+        for _ in range(5):
+            self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="ubuntu desktop iso amd64 release"))
+        orm.flush()
+        expected = sorted(md.rowid for md in best)
+
+        with patch("tribler_core.modules.metadata_store.orm_bindings.metadata_node.SEARCH_MAX_CANDIDATES", 3):
+            for args in [dict(), dict(sort_by="title"), dict(metadata_type=REGULAR_TORRENT, hide_xxx=True)]:
+                results = self.mds.TorrentMetadata.get_entries(txt_filter="ubuntu", **args)
+                self.assertEqual(expected, sorted(r.rowid for r in results), msg=str(args))
+                rows = self.mds.TorrentMetadata.get_entries_rows(txt_filter="ubuntu", **args)
+                self.assertEqual(expected, sorted(r.rowid for r in rows), msg=str(args))
+            self.assertEqual(3, self.mds.TorrentMetadata.search_keyword("ubuntu", lim=None).count())
+
     def test_search_empty_query(self):
         """
         Test whether an empty query returns nothing
@@ -192,6 +246,295 @@ class TestTorrentMetadata(TriblerCoreTest):
         # Check that we can chew the special character "."
         autocomplete_terms = self.mds.TorrentMetadata.get_auto_complete_terms(".", 2)
 
+    def test_get_autocomplete_terms_ranked(self):
+        """
+        Test that the autocompletion terms are ranked by popularity and follow the changes to the database
+        """
+        with db_session:
+            for title in ["pioneer movies", "pioneer one", "pioneer one episode", "piano"]:
+                self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title=title))
+
+        # The terms are stemmed for the lookup, but shown as they are written in the titles
+        self.assertListEqual(['pioneer', 'piano'], self.mds.TorrentMetadata.get_auto_complete_terms("pi", 5))
+        self.assertListEqual(['movies'], self.mds.TorrentMetadata.get_auto_complete_terms("movie", 5))
+        self.assertListEqual(['pioneer one'], self.mds.TorrentMetadata.get_auto_complete_terms("pioneer o", 5))
+
+        # The index is updated incrementally with the new entries
+        with db_session:
+            for _ in range(5):
+                self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="piano concerto"))
+        self.assertListEqual(['piano', 'pioneer'], self.mds.TorrentMetadata.get_auto_complete_terms("pi", 5))
+        self.assertListEqual(['piano concerto'], self.mds.TorrentMetadata.get_auto_complete_terms("piano c", 5))
+
+    def test_get_autocomplete_terms_changes(self):
+        """
+        Test that the autocompletion terms follow the deletions, the title changes and the bulk imports
+        """
+        with db_session:
+            pianos = [self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="piano")) for _ in range(3)]
+            self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="pioneer one"))
+            self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="pioneer two"))
+            orm.flush()
+            rowids = [t.rowid for t in pianos]
+        self.assertListEqual(['piano', 'pioneer'], self.mds.TorrentMetadata.get_auto_complete_terms("pi", 5))
+
+        # New entries do not require rebuilding the index
+        with patch.object(self.mds.completion_index, "_build") as build, db_session:
+            self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="pianola"))
+            orm.flush()
+            self.assertListEqual(
+                ['piano', 'pioneer', 'pianola'], self.mds.TorrentMetadata.get_auto_complete_terms("pi", 5)
+            )
+            build.assert_not_called()
+
+        # The counts go down with the deletions and the title changes
+        with db_session:
+            self.mds.TorrentMetadata.get(rowid=rowids[0]).delete()
+            self.mds.TorrentMetadata.get(rowid=rowids[1]).title = "violin"
+        self.assertListEqual(['pioneer', 'piano', 'pianola'], self.mds.TorrentMetadata.get_auto_complete_terms("pi", 5))
+        self.assertListEqual(['violin'], self.mds.TorrentMetadata.get_auto_complete_terms("vio", 5))
+        with db_session:
+            # The old titles are removed from the full text search index as well
+            self.assertEqual(1, len(self.mds.TorrentMetadata.get_entries(txt_filter="piano")))
+
+        # The entries of an ongoing bulk import are completed as well, before and after they get indexed
+        with self.mds.deferred_fts_indexing():
+            with db_session:
+                for _ in range(3):
+                    self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="cello"))
+            self.assertListEqual(['cello'], self.mds.TorrentMetadata.get_auto_complete_terms("cel", 5))
+            # The index is built from scratch in the middle of the import
+            self.mds.completion_index._last_rowid = None
+            with db_session:
+                self.mds.TorrentMetadata.from_dict(dict(rnd_torrent(), title="violin"))
+            self.assertListEqual(['cello'], self.mds.TorrentMetadata.get_auto_complete_terms("cel", 5))
+        self.assertListEqual(['cello'], self.mds.TorrentMetadata.get_auto_complete_terms("cel", 5))
+        self.assertEqual(3, self.mds.completion_index._counts["cello"])
+        self.assertEqual(2, self.mds.completion_index._counts["violin"])
+
+    @db_session
+    def test_get_entries_cursor(self):
+        """
+        Test that paging through the results with cursors yields the same results as fetching them all at once
+        """
+        channel = self.mds.ChannelMetadata.create_channel('channel')
+        for ind in range(17):
+            self.mds.TorrentMetadata(
+                origin_id=channel.id_,
+                title='torrent%d' % (ind % 5),
+                infohash=random_infohash(),
+                size=ind % 3,
+                torrent_date=datetime(2000 + ind % 4, 1, 1),
+            )
+        # Collections have no size, so the column is NULL for them
+        for ind in range(3):
+            self.mds.CollectionNode(origin_id=channel.id_, title='collection%d' % ind)
+        orm.flush()
+
+        for sort_by in [None, 'title', 'size', 'HEALTH', 'torrent_date', 'infohash']:
+            for sort_desc in [True, False]:
+                args = dict(sort_by=sort_by, sort_desc=sort_desc, origin_id=channel.id_)
+                expected = list(self.mds.MetadataNode.get_entries(**args))
+                results, cursor = [], None
+                while True:
+                    page = self.mds.MetadataNode.get_entries(first=1, last=4, cursor=cursor, **args)
+                    if not page:
+                        break
+                    results.extend(page)
+                    cursor = self.mds.MetadataNode.get_entry_cursor(page[-1], **args)
+                self.assertListEqual(expected, results, msg="sort_by=%s, sort_desc=%s" % (sort_by, sort_desc))
+
+        self.assertRaises(ValueError, self.mds.MetadataNode.get_entries, cursor="garbage")
+        cursor = self.mds.MetadataNode.get_entry_cursor(channel, sort_by='HEALTH')
+        self.assertRaises(ValueError, self.mds.MetadataNode.get_entries, cursor=cursor, sort_by='title')
+
+    @db_session
+    def test_get_entries_rows(self):
+        """
+        Test that the raw SQL version of get_entries returns the same entries as the Pony query
+        """
+        channel = self.mds.ChannelMetadata.create_channel('channel')
+        for ind in range(9):
+            torrent = self.mds.TorrentMetadata(
+                origin_id=channel.id_,
+                title='torrent%d' % (ind % 4),
+                infohash=random_infohash(),
+                size=ind % 3,
+                tags='video' if ind % 2 else 'audio',
+            )
+            torrent.health.seeders = ind % 5
+        self.mds.CollectionNode(origin_id=channel.id_, title='collection torrent')
+        orm.flush()
+
+        for args in [
+            dict(),
+            dict(origin_id=channel.id_, sort_by='title', sort_desc=False),
+            dict(channel_pk=channel.public_key, metadata_type=REGULAR_TORRENT, sort_by='HEALTH', first=2, last=5),
+            dict(category='video', exclude_deleted=True, hide_xxx=True, sort_by='size'),
+            dict(attribute_ranges=(("num_entries", None, 1),), sort_by="size", sort_desc=False),
+            dict(txt_filter='torrent1'),
+            dict(txt_filter='torrent*', first=3, last=6),
+            dict(txt_filter='torrent*', sort_by='HEALTH'),
+        ]:
+            expected = [entry.rowid for entry in self.mds.MetadataNode.get_entries(**args)]
+            rows = self.mds.MetadataNode.get_entries_rows(**args)
+            self.assertListEqual(expected, [row.rowid for row in rows], msg=str(args))
+
+        # The rows can be paged with cursors
+        args = dict(origin_id=channel.id_, sort_by='HEALTH')
+        page = self.mds.MetadataNode.get_entries(first=1, last=3, **args)
+        cursor = self.mds.MetadataNode.get_entry_cursor(page[-1], **args)
+        expected = [entry.rowid for entry in self.mds.MetadataNode.get_entries(first=1, last=3, cursor=cursor, **args)]
+        rows = self.mds.MetadataNode.get_entries_rows(first=1, last=3, cursor=cursor, **args)
+        self.assertListEqual(expected, [row.rowid for row in rows])
+
+    @db_session
+    def test_get_entries_rows_cursor(self):
+        """
+        Test that paging through the raw SQL results with cursors yields the same results as fetching them all at once,
+        and that the pages are read from the sort indexes
+        """
+        channel = self.mds.ChannelMetadata.create_channel('channel')
+        for ind in range(17):
+            self.mds.TorrentMetadata(
+                origin_id=channel.id_,
+                title='torrent%d' % (ind % 5),
+                infohash=random_infohash(),
+                size=ind % 3,
+                torrent_date=datetime(2000 + ind % 4, 1, 1),
+            )
+        # Collections have no size, so the column is NULL for them
+        for ind in range(3):
+            self.mds.CollectionNode(origin_id=channel.id_, title='collection%d' % ind)
+        orm.flush()
+
+        for metadata_type in [None, REGULAR_TORRENT]:
+            for sort_by in [None, 'title', 'size', 'HEALTH', 'torrent_date']:
+                for sort_desc in [True, False]:
+                    args = dict(
+                        sort_by=sort_by, sort_desc=sort_desc, origin_id=channel.id_, metadata_type=metadata_type
+                    )
+                    expected = [row.rowid for row in self.mds.MetadataNode.get_entries_rows(**args)]
+                    results, cursor = [], None
+                    while True:
+                        page = self.mds.MetadataNode.get_entries_rows(
+                            first=1, last=4, cursor=cursor, columns="cn.rowid", **args
+                        )
+                        if not page:
+                            break
+                        results.extend(row.rowid for row in page)
+                        cursor = self.mds.MetadataNode.get_row_cursor(page[-1], **args)
+                    self.assertListEqual(expected, results, msg=str(args))
+
+        page = self.mds.TorrentMetadata.get_entries(first=1, last=4, origin_id=channel.id_, sort_by='size')
+        cursor = self.mds.TorrentMetadata.get_entry_cursor(page[-1], sort_by='size')
+        sql, params = self.mds.TorrentMetadata.get_entries_sql(
+            first=1, last=4, cursor=cursor, origin_id=channel.id_, metadata_type=REGULAR_TORRENT, sort_by='size'
+        )
+        plan = " ".join(row[-1] for row in self.mds._db.execute("EXPLAIN QUERY PLAN " + sql, globals(), params))
+        self.assertIn("idx_channelnode__origin_id_num_entries_size", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    @db_session
+    def test_get_entries_tiebreak(self):
+        """
+        Test that the ties are broken in the direction of the sort in the listings, and oldest first in the searches
+        """
+        channel = self.mds.ChannelMetadata.create_channel('channel')
+        torrents = [
+            self.mds.TorrentMetadata(origin_id=channel.id_, title='torrent%d' % ind, infohash=random_infohash())
+            for ind in range(7)
+        ]
+        orm.flush()
+        rowids = [torrent.rowid for torrent in torrents]
+
+        args = dict(origin_id=channel.id_, metadata_type=REGULAR_TORRENT, sort_by='HEALTH')
+        self.assertListEqual(rowids[::-1], [entry.rowid for entry in self.mds.MetadataNode.get_entries(**args)])
+
+        args = dict(txt_filter='torrent*', sort_by='HEALTH')
+        self.assertListEqual(rowids, [entry.rowid for entry in self.mds.MetadataNode.get_entries(**args)])
+        self.assertListEqual(rowids, [row.rowid for row in self.mds.MetadataNode.get_entries_rows(**args)])
+
+        # The search results can still be paged with cursors
+        results, cursor = [], None
+        while True:
+            page = self.mds.MetadataNode.get_entries_rows(first=1, last=3, cursor=cursor, columns="cn.rowid", **args)
+            if not page:
+                break
+            results.extend(row.rowid for row in page)
+            cursor = self.mds.MetadataNode.get_row_cursor(page[-1], **args)
+        self.assertListEqual(rowids, results)
+
+        results, cursor = [], None
+        while True:
+            page = self.mds.MetadataNode.get_entries(first=1, last=3, cursor=cursor, **args)
+            if not page:
+                break
+            results.extend(entry.rowid for entry in page)
+            cursor = self.mds.MetadataNode.get_entry_cursor(page[-1], **args)
+        self.assertListEqual(rowids, results)
+
+    def test_get_total_count(self):
+        """
+        Test that the total counts from the counts table and the count cache match the actual query counts
+        """
+        with db_session:
+            channel = self.mds.ChannelMetadata.create_channel('channel')
+            self.mds.ChannelMetadata(
+                title='other',
+                infohash=random_infohash(),
+                subscribed=True,
+                sign_with=default_eccrypto.generate_key('curve25519'),
+            )
+            for ind in range(10):
+                self.mds.TorrentMetadata(
+                    origin_id=channel.id_,
+                    title='torrent%d' % ind,
+                    infohash=random_infohash(),
+                    xxx=ind % 3,
+                    status=[COMMITTED, TODELETE, LEGACY_ENTRY][ind % 3],
+                )
+            self.mds.CollectionNode(origin_id=channel.id_, title='collection')
+            self.mds.TorrentMetadata.add_ffa_from_dict(dict(title='ffa', infohash=random_infohash()))
+
+        queries = [
+            dict(),
+            dict(metadata_type=REGULAR_TORRENT),
+            dict(metadata_type=frozenset((REGULAR_TORRENT, COLLECTION_NODE))),
+            dict(channel_pk=channel.public_key, origin_id=channel.id_, exclude_deleted=True, hide_xxx=True),
+            dict(channel_pk=NULL_KEY_SUBST, exclude_legacy=True),
+            dict(origin_id=0, subscribed=True),
+            dict(txt_filter='torrent*', hide_xxx=True),
+            dict(id_=channel.id_),
+        ]
+
+        def check_counts():
+            with db_session:
+                for entity in [self.mds.MetadataNode, self.mds.TorrentMetadata, self.mds.ChannelMetadata]:
+                    for query in queries:
+                        self.assertEqual(
+                            entity.get_entries_query(**query).count(),
+                            entity.get_total_count(first=1, last=5, sort_by='title', **query),
+                            msg="%s %s" % (entity.__name__, query),
+                        )
+
+        check_counts()
+        with db_session:
+            # Most of the queries are answered from the counts table
+            self.assertIsNotNone(self.mds.MetadataNode.get_counts_table_count(**queries[3]))
+            self.assertIsNone(self.mds.MetadataNode.get_counts_table_count(**queries[6]))
+        hits = self.mds.count_cache.hits
+        check_counts()
+        self.assertEqual(hits + 3 * len(queries), self.mds.count_cache.hits)
+
+        # Any change to the entries invalidates the cached counts
+        with db_session:
+            self.mds.TorrentMetadata.select(lambda g: g.status == TODELETE).first().status = COMMITTED
+            self.mds.TorrentMetadata.select(lambda g: g.title == 'torrent0').first().delete()
+            self.mds.ChannelMetadata.get(title='other').subscribed = False
+            self.mds.TorrentMetadata(origin_id=channel.id_, title='torrent new', infohash=random_infohash())
+        check_counts()
+
     @db_session
     def test_get_entries(self):
         """
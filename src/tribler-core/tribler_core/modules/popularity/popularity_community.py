@@ -1,5 +1,4 @@
 import random
-from asyncio import get_event_loop
 from binascii import unhexlify
 
 from ipv8.community import Community
@@ -80,5 +79,4 @@ class PopularityCommunity(Community):
                         _ = self.metadata_store.TorrentState(infohash=infohash, seeders=seeders,
                                                              leechers=leechers, last_check=last_check)
 
-            self.metadata_store.disconnect_thread()
-        await get_event_loop().run_in_executor(None, _put_health_entries_in_db)
+        await self.metadata_store.run_write(_put_health_entries_in_db, coalesce=True)
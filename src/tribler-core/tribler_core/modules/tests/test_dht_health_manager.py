@@ -1,4 +1,3 @@
-from asyncio import Future
 from binascii import unhexlify
 
 from tribler_core.modules.dht_health_manager import DHTHealthManager
@@ -53,6 +52,21 @@ class TestDHTHealthManager(TriblerCoreTest):
         bf2 = bytearray(b'b' * 256)
         self.assertEqual(self.dht_health_manager.combine_bloomfilters(bf1, bf2), bf2)
 
+    def test_combine_many_bloom_filters(self):
+        """
+        Test combining any number of bloom filters at once
+        """
+        bfs = [bytearray(256) for _ in range(8)]
+        for ind, bf in enumerate(bfs):
+            bf[ind] = 1 << ind
+        combined = self.dht_health_manager.combine_bloomfilters(*bfs)
+        self.assertEqual(bytearray([1 << ind for ind in range(8)]) + bytearray(248), combined)
+        # Every item sets two bits of a BEP33 bloom filter
+        self.assertEqual(4, self.dht_health_manager.get_size_from_bloomfilter(combined))
+
+        # The combined filter is as long as the shortest one
+        self.assertEqual(bytearray(b'\x03'), self.dht_health_manager.combine_bloomfilters(b'\x01\x00', b'\x02'))
+
     @timeout(10)
     async def test_get_size_from_bloom_filter(self):
         """
@@ -78,16 +92,61 @@ class TestDHTHealthManager(TriblerCoreTest):
         """
         Test whether the right operations happen when receiving a bloom filter
         """
-        infohash = 'a' * 20
+        infohash = b'a' * 20
         self.dht_health_manager.received_bloomfilters(infohash)  # It should not do anything
         self.assertFalse(self.dht_health_manager.bf_seeders)
         self.assertFalse(self.dht_health_manager.bf_peers)
 
-        self.dht_health_manager.lookup_futures[infohash] = Future()
-        self.dht_health_manager.bf_seeders[infohash] = bytearray(256)
-        self.dht_health_manager.bf_peers[infohash] = bytearray(256)
+        self.dht_health_manager.get_health(infohash)
         self.dht_health_manager.received_bloomfilters(b'b' * 20,
                                                       bf_seeds=bytearray(b'\xee' * 256),
                                                       bf_peers=bytearray(b'\xff' * 256))
         self.assertEqual(self.dht_health_manager.bf_seeders[infohash], bytearray(b'\xee' * 256))
         self.assertEqual(self.dht_health_manager.bf_peers[infohash], bytearray(b'\xff' * 256))
+
+    @timeout(10)
+    async def test_receive_bloomfilters_transaction(self):
+        """
+        Test whether bloom filters are routed to the lookup of the get_peers query with the same transaction ID
+        """
+        self.dht_health_manager.get_health(b'a' * 20)
+        self.dht_health_manager.get_health(b'b' * 20)
+        self.dht_health_manager.sent_get_peers(b'aa', b'a' * 20)
+        self.dht_health_manager.sent_get_peers(b'cc', b'c' * 20)  # Not one of our lookups
+
+        # The node ID is closer to the other lookup, but the transaction ID tells us where the response belongs
+        self.dht_health_manager.received_bloomfilters(b'b' * 20, bf_seeds=bytearray(b'\xee' * 256),
+                                                      transaction_id=b'aa')
+        self.assertEqual(self.dht_health_manager.bf_seeders[b'a' * 20], bytearray(b'\xee' * 256))
+        self.assertEqual(self.dht_health_manager.bf_seeders[b'b' * 20], bytearray(256))
+
+        # Unknown transaction IDs fall back to the closest lookup
+        self.dht_health_manager.received_bloomfilters(b'b' * 20, bf_seeds=bytearray(b'\x11' * 256),
+                                                      transaction_id=b'cc')
+        self.assertEqual(self.dht_health_manager.bf_seeders[b'b' * 20], bytearray(b'\x11' * 256))
+
+        self.dht_health_manager.finalize_lookup(b'a' * 20)
+        self.assertFalse(self.dht_health_manager.lookup_transactions)
+        self.assertEqual([int.from_bytes(b'b' * 20, 'big')], self.dht_health_manager.lookup_index)
+
+    def test_get_closest_lookup(self):
+        """
+        Test finding the lookup with the infohash that is the closest to a node ID
+        """
+        self.assertIsNone(self.dht_health_manager.get_closest_lookup(b'a' * 20))
+
+        # The closest infohash is not necessarily next to the node ID in the sorted index
+        infohashes = [b'\x80' + b'\x00' * 19, b'\xe0' + b'\x00' * 19]
+        for infohash in infohashes:
+            self.dht_health_manager.get_health(infohash)
+        self.assertEqual(infohashes[1], self.dht_health_manager.get_closest_lookup(b'\x70' + b'\xff' * 19))
+        self.assertEqual(infohashes[0], self.dht_health_manager.get_closest_lookup(b'\x90' + b'\x00' * 19))
+
+        infohashes.append(b'\x01' + b'\x00' * 19)
+        self.dht_health_manager.get_health(infohashes[2])
+        self.assertEqual(infohashes[2], self.dht_health_manager.get_closest_lookup(b'\x70' + b'\xff' * 19))
+
+        node_ids = [bytes([i * 7 % 256, i]) + b'\x00' * 18 for i in range(64)]
+        for node_id in node_ids:
+            expected = min(infohashes, key=lambda ih: int.from_bytes(ih, 'big') ^ int.from_bytes(node_id, 'big'))
+            self.assertEqual(expected, self.dht_health_manager.get_closest_lookup(node_id))
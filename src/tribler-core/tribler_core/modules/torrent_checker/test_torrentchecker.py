@@ -1,12 +1,18 @@
 import os
 import socket
 import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from pony.orm import db_session
 
-from tribler_core.modules.torrent_checker.torrent_checker import TorrentChecker
-from tribler_core.modules.torrent_checker.torrentchecker_session import HttpTrackerSession, UdpSocketManager
+from tribler_common.simpledefs import NTFY
+
+from tribler_core.modules.torrent_checker.torrent_checker import MAX_SCRAPES_PER_TRACKER, TorrentChecker
+from tribler_core.modules.torrent_checker.torrentchecker_session import (
+    HttpTrackerSession,
+    MAX_INFOHASHES_IN_SCRAPE,
+    UdpSocketManager,
+)
 from tribler_core.modules.tracker_manager import TrackerManager
 from tribler_core.tests.tools.test_as_server import TestAsServer
 from tribler_core.tests.tools.tools import timeout
@@ -53,6 +59,13 @@ class TestTorrentChecker(TestAsServer):
         self.assertTrue(self.torrent_checker.is_pending_task_active("tracker_check"))
         self.assertTrue(self.torrent_checker.is_pending_task_active("torrent_check"))
 
+        # The HTTP client shared by the tracker sessions is closed on shutdown
+        http_client = self.torrent_checker.http_client
+        self.assertIs(http_client, self.torrent_checker._create_session_for_request("http://tracker.org/announce")
+                      ._client)
+        await self.torrent_checker.shutdown()
+        self.assertTrue(http_client.session.closed)
+
     async def test_create_socket_fail(self):
         """
         Test creation of the UDP socket of the torrent checker when it fails
@@ -97,10 +110,10 @@ class TestTorrentChecker(TestAsServer):
         self.assertEqual(result['db']['leechers'], 10)
 
     @timeout(10)
-    async def test_task_select_no_tracker(self):
-        await self.torrent_checker.check_random_tracker()
+    async def test_check_trackers_no_tracker(self):
+        await self.torrent_checker.check_trackers()
 
-    async def test_task_select_tracker(self):
+    async def test_check_trackers_select_tracker(self):
         with db_session:
             tracker = self.session.mds.TrackerState(url="http://localhost/tracker")
             self.session.mds.TorrentState(infohash=b'a' * 20, seeders=5, leechers=10, trackers={tracker})
@@ -109,12 +122,12 @@ class TestTorrentChecker(TestAsServer):
         controlled_session.connect_to_tracker = lambda: succeed(None)
 
         self.torrent_checker._create_session_for_request = lambda *args, **kwargs: controlled_session
-        await self.torrent_checker.check_random_tracker()
+        await self.torrent_checker.check_trackers()
 
         self.assertEqual(len(controlled_session.infohash_list), 1)
 
     @timeout(30)
-    async def test_tracker_test_error_resolve(self):
+    async def test_check_trackers_error_resolve(self):
         """
         Test whether we capture the error when a tracker check fails
         """
@@ -122,18 +135,131 @@ class TestTorrentChecker(TestAsServer):
             tracker = self.session.mds.TrackerState(url="http://localhost/tracker")
             self.session.mds.TorrentState(infohash=b'a' * 20, seeders=5, leechers=10, trackers={tracker},
                                              last_check=int(time.time()))
-        await self.torrent_checker.check_random_tracker()
+        await self.torrent_checker.check_trackers()
 
         # Verify whether we successfully cleaned up the session after an error
         self.assertEqual(len(self.torrent_checker._session_list), 1)
 
     @timeout(10)
-    async def test_tracker_no_infohashes(self):
+    async def test_check_trackers_no_infohashes(self):
         """
         Test the check of a tracker without associated torrents
         """
         self.session.tracker_manager.add_tracker('http://trackertest.com:80/announce')
-        await self.torrent_checker.check_random_tracker()
+        await self.torrent_checker.check_trackers()
+        with db_session:
+            self.assertLess(0, self.session.mds.TrackerState.get(url='http://trackertest.com/announce').last_check)
+
+    async def test_select_tracker_batches_stops_reading(self):
+        """
+        Test that the stale torrents stop being read once the trackers that have them got their fill
+        """
+        quota = MAX_SCRAPES_PER_TRACKER * MAX_INFOHASHES_IN_SCRAPE
+        with db_session:
+            tracker = self.session.mds.TrackerState(url="http://tracker1.org/announce")
+            self.session.mds.TrackerState(url="http://idle.org/announce")
+            for ind in range(3 * quota):
+                self.session.mds.TorrentState(infohash=os.urandom(20), last_check=ind, trackers={tracker})
+
+        mds_select = self.session.mds._db.select
+        rows_read = []
+
+        def select(sql, *args):
+            rows = mds_select(sql, *args)
+            rows_read.extend(rows)
+            return rows
+
+        with patch.object(self.session.mds._db, 'select', select):
+            batches, _, idle_trackers = await self.session.mds.run_read(
+                self.torrent_checker.select_tracker_batches, [], int(time.time()))
+
+        self.assertListEqual(["http://idle.org/announce"], idle_trackers)
+        self.assertEqual(quota, sum(len(infohashes) for _, infohashes in batches))
+        # A single page is read, as large as the quotas of both trackers
+        self.assertEqual(2 * quota, len(rows_read))
+
+    async def test_update_torrents_health_notify(self):
+        """
+        Test that the GUI is only notified about the visible torrents that had their health updated, with their
+        stored health
+        """
+        now = int(time.time())
+        with db_session:
+            self.session.mds.TorrentState(infohash=b'a' * 20)
+            self.session.mds.TorrentState(infohash=b'b' * 20, seeders=10, last_check=now)
+            self.session.mds.TorrentState(infohash=b'c' * 20)
+        self.torrent_checker.add_visible_infohashes([b'a' * 20, b'b' * 20])
+        self.session.notifier.notify = Mock()
+
+        health_list = [{'infohash': hexlify(infohash), 'seeders': 3, 'leechers': 4}
+                       for infohash in (b'a' * 20, b'b' * 20, b'c' * 20)]
+        updated = await self.torrent_checker._update_torrents_health(health_list, now)
+
+        self.assertListEqual([b'a' * 20, b'c' * 20], [update['infohash'] for update in updated])
+        self.session.notifier.notify.assert_called_once_with(NTFY.CHANNEL_ENTITY_UPDATED, {
+            "infohash": hexlify(b'a' * 20), "num_seeders": 3, "num_leechers": 4, "last_tracker_check": now,
+            "health": "updated"})
+
+    async def test_check_trackers(self):
+        """
+        Test that the bulk check scrapes the stale torrents in tracker batches, the most visible torrents first
+        """
+        with db_session:
+            tracker1 = self.session.mds.TrackerState(url="http://tracker1.org/announce")
+            tracker2 = self.session.mds.TrackerState(url="udp://tracker2.org:6969")
+            self.session.mds.TrackerState(url="http://idle.org/announce")
+            # The first tracker has more stale torrents than it gets to scrape, so the others go to the second one
+            stale = [self.session.mds.TorrentState(infohash=os.urandom(20), last_check=ind, trackers={tracker1})
+                     for ind in range(MAX_SCRAPES_PER_TRACKER * MAX_INFOHASHES_IN_SCRAPE)]
+            both = [
+                self.session.mds.TorrentState(infohash=os.urandom(20), last_check=500, trackers={tracker1, tracker2})
+                for _ in range(10)
+            ]
+            self.session.mds.TorrentState(infohash=os.urandom(20), last_check=int(time.time()), trackers={tracker1})
+            channel = self.session.mds.ChannelMetadata.create_channel('channel')
+            subscribed = self.session.mds.TorrentMetadata(origin_id=channel.id_, infohash=os.urandom(20))
+            subscribed.health.last_check = 1000
+            subscribed.health.trackers.add(tracker1)
+            subscribed_infohash = bytes(subscribed.infohash)
+            tracker_urls = (tracker1.url, tracker2.url)
+
+        visible_infohash = bytes(stale[-1].infohash)
+        self.torrent_checker.add_visible_infohashes([visible_infohash])
+        batches, invalid_trackers, idle_trackers = await self.session.mds.run_read(
+            self.torrent_checker.select_tracker_batches, [visible_infohash], int(time.time()))
+
+        self.assertListEqual([], invalid_trackers)
+        self.assertListEqual(["http://idle.org/announce"], idle_trackers)
+        self.assertListEqual([tracker_urls[0], tracker_urls[1]] + [tracker_urls[0]] * (MAX_SCRAPES_PER_TRACKER - 1),
+                             [url for url, _ in batches])
+        self.assertListEqual([visible_infohash, subscribed_infohash], batches[0][1][:2])
+        scheduled = [infohash for _, infohashes in batches for infohash in infohashes]
+        self.assertEqual(len(scheduled), len(set(scheduled)))
+        self.assertEqual(len(stale) + len(both), len(scheduled))
+        self.assertSetEqual({bytes(torrent.infohash) for torrent in both}, set(batches[1][1]))
+        self.assertTrue(all(len(infohashes) <= MAX_INFOHASHES_IN_SCRAPE for _, infohashes in batches))
+
+        async def connect_to_tracker(session):
+            return {session.tracker_url: [{'infohash': hexlify(infohash), 'seeders': 3, 'leechers': 4}
+                                          for infohash in session.infohash_list]}
+
+        sessions = []
+
+        def create_session(tracker_url, **_):
+            sessions.append(HttpTrackerSession(tracker_url, None, None, None))
+            return sessions[-1]
+
+        self.torrent_checker.connect_to_tracker = connect_to_tracker
+        self.torrent_checker._create_session_for_request = create_session
+        await self.torrent_checker.check_trackers()
+        self.session.mds.writer.submit(lambda: None).result()
+        for session in sessions:
+            await session.cleanup()
+
+        self.assertEqual(len(batches), len(sessions))
+        with db_session:
+            self.assertEqual(len(scheduled), self.session.mds.TorrentState.select(lambda g: g.seeders == 3).count())
+            self.assertLess(0, self.session.mds.TrackerState.get(url="http://idle.org/announce").last_check)
 
     def test_get_valid_next_tracker_for_auto_check(self):
         """ Test if only valid tracker url is used for auto check """
@@ -187,9 +313,12 @@ class TestTorrentChecker(TestAsServer):
         self.assertFalse(self.torrent_checker.on_torrent_health_check_completed(infohash_bin, None))
 
         with db_session:
-            ts = self.session.mds.TorrentState(infohash=infohash_bin)
-            previous_check = ts.last_check
-            self.torrent_checker.on_torrent_health_check_completed(infohash_bin, result)
+            previous_check = self.session.mds.TorrentState(infohash=infohash_bin).last_check
+        self.torrent_checker.on_torrent_health_check_completed(infohash_bin, result)
+        # The DB writer executes the tasks in order, so this waits for the health update to be written
+        self.session.mds.writer.submit(lambda: None).result()
+        with db_session:
+            ts = self.session.mds.TorrentState.get(infohash=infohash_bin)
             self.assertEqual(result[2]['DHT'][0]['leechers'], ts.leechers)
             self.assertEqual(result[2]['DHT'][0]['seeders'], ts.seeders)
             self.assertLess(previous_check, ts.last_check)
@@ -1,16 +1,22 @@
 import socket
 import struct
-from asyncio import CancelledError, DatagramProtocol, Future, ensure_future, get_event_loop, start_server
+import time
+from asyncio import CancelledError, DatagramProtocol, Future, ensure_future, get_event_loop, sleep, start_server
+from urllib.parse import parse_qs
 
+from aiohttp import web
 from aiohttp.web_exceptions import HTTPBadRequest
 
 from libtorrent import bencode
 
 from tribler_core.config.tribler_config import TriblerConfig
 from tribler_core.modules.torrent_checker.torrentchecker_session import (
+    TRACKER_ACTION_SCRAPE,
     FakeBep33DHTSession,
     FakeDHTSession,
+    HttpTrackerClient,
     HttpTrackerSession,
+    UdpSocketManager,
     UdpTrackerSession,
 )
 from tribler_core.session import Session
@@ -21,12 +27,12 @@ from tribler_core.utilities.unicode import hexlify
 from tribler_core.utilities.utilities import succeed
 
 
-class FakeUdpSocketManager(object):
-    transport = 1
+class FakeUdpSocketManager(UdpSocketManager):
 
     def __init__(self):
+        super(FakeUdpSocketManager, self).__init__()
+        self.transport = 1
         self.response = None
-        self.tracker_sessions = {}
 
     def send_request(self, *args):
         return succeed(self.response)
@@ -238,6 +244,133 @@ class TestTorrentCheckerSession(TestAsServer):
         await session.scrape()
         self.assertTrue(session.is_finished)
 
+    async def test_udpsession_cached_connection_id(self):
+        """
+        Test that a UDP session skips the connection handshake if the tracker gave us a connection ID recently
+        """
+        session = UdpTrackerSession("localhost", ("127.0.0.1", 4782), "/announce", 5, self.socket_mgr)
+        session.infohash_list.append(b'a' * 20)
+        self.socket_mgr.set_connection_id(("127.0.0.1", 4782), 126)
+        # The response to the connection request would not be valid
+        self.socket_mgr.send_request = lambda *_: succeed(
+            struct.pack("!iiiii", TRACKER_ACTION_SCRAPE, session.transaction_id, 0, 1, 2))
+        result = await session.connect_to_tracker()
+        self.assertEqual(126, session._connection_id)
+        self.assertEqual(0, result["localhost"][0]["seeders"])
+
+        # A failing scrape invalidates the connection ID
+        session = UdpTrackerSession("localhost", ("127.0.0.1", 4782), "/announce", 5, self.socket_mgr)
+        session.infohash_list.append(b'a' * 20)
+        self.socket_mgr.send_request = lambda *_: succeed(b"too short")
+        with self.assertRaises(ValueError):
+            await session.connect_to_tracker()
+        self.assertIsNone(self.socket_mgr.get_connection_id(("127.0.0.1", 4782)))
+
+    async def test_udp_socket_manager_dns_cache(self):
+        """
+        Test that the UDP socket manager caches the addresses of the trackers
+        """
+        self.socket_mgr.dns_cache["tracker.test"] = ("1.2.3.4", time.time() + 10)
+        self.assertEqual("1.2.3.4", await self.socket_mgr.resolve("tracker.test"))
+        self.socket_mgr.dns_cache["localhost"] = ("1.2.3.4", time.time() - 1)
+        self.assertEqual("127.0.0.1", await self.socket_mgr.resolve("localhost"))
+        self.assertEqual("127.0.0.1", self.socket_mgr.dns_cache["localhost"][0])
+
+    @timeout(5)
+    async def test_udp_socket_manager_merge_scrapes(self):
+        """
+        Test that the UDP socket manager merges the concurrent scrape requests to a tracker into a single packet
+        """
+        socket_mgr = UdpSocketManager()
+        sent = []
+        socket_mgr.transport = MockObject()
+        socket_mgr.transport.sendto = lambda data, address: sent.append((data, address))
+
+        sessions = [UdpTrackerSession("localhost", ("127.0.0.1", 4782), "/announce", 5, socket_mgr)
+                    for _ in range(2)]
+        futures = []
+        for ind, session in enumerate(sessions):
+            session.ip_address = "127.0.0.1"
+            message = struct.pack("!qii", 126, TRACKER_ACTION_SCRAPE, session.transaction_id) + b'%i' % ind * 20
+            futures.append(socket_mgr.send_request(message, session))
+        await sleep(0.2)
+
+        self.assertEqual(1, len(sent))
+        data, address = sent[0]
+        self.assertEqual(("127.0.0.1", 4782), address)
+        connection_id, action, transaction_id = struct.unpack_from("!qii", data)
+        self.assertEqual((126, TRACKER_ACTION_SCRAPE), (connection_id, action))
+        self.assertEqual(b'0' * 20 + b'1' * 20, data[16:])
+
+        socket_mgr.datagram_received(struct.pack("!iiiiiiii", TRACKER_ACTION_SCRAPE, transaction_id, 1, 2, 3, 4, 5, 6),
+                                     address)
+        for session, future, expected in zip(sessions, futures, [(1, 2, 3), (4, 5, 6)]):
+            self.assertEqual(struct.pack("!iiiii", TRACKER_ACTION_SCRAPE, session.transaction_id, *expected),
+                             await future)
+        self.assertFalse(socket_mgr.tracker_sessions)
+        for session in sessions:
+            await session.cleanup()
+
+    @timeout(10)
+    async def test_httpsession_shared_client(self):
+        """
+        Test that the HTTP tracker sessions reuse the connections of a shared client, and fall back to scraping
+        the infohashes one by one if the tracker only answers for one of them
+        """
+        peers = []
+        single_infohash = []
+        unknown = []
+
+        async def scrape(request):
+            peers.append(request.transport.get_extra_info('peername'))
+            infohashes = parse_qs(request.rel_url.raw_query_string, encoding='latin-1')['info_hash']
+            infohashes = [infohash for infohash in infohashes if infohash.encode('latin-1') not in unknown]
+            if single_infohash:
+                infohashes = infohashes[:1]
+            return web.Response(body=bencode({b"files": {infohash.encode('latin-1'): {b"complete": 1, b"incomplete": 2}
+                                                         for infohash in infohashes}}))
+
+        app = web.Application()
+        app.add_routes([web.get('/scrape', scrape)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, 'localhost', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        client = HttpTrackerClient()
+        for infohashes in ([b'a' * 20, b'b' * 20], [b'c' * 20]):
+            session = HttpTrackerSession("tracker", ("localhost", port), "/announce", 5, client)
+            for infohash in infohashes:
+                session.add_infohash(infohash)
+            result = await session.connect_to_tracker()
+            self.assertEqual(len(infohashes), len([r for r in result["tracker"] if r["seeders"] == 1]))
+            await session.cleanup()
+        self.assertEqual(2, len(peers))
+        self.assertEqual(peers[0], peers[1])
+        self.assertFalse(client.session.closed)
+
+        # A tracker that only knows the first infohash is not mistaken for a single infohash tracker
+        session = HttpTrackerSession("tracker", ("localhost", port), "/announce", 5, client)
+        for infohash in [b'a' * 20, b'u' * 20]:
+            session.add_infohash(infohash)
+        unknown.append(b'u' * 20)
+        result = await session.connect_to_tracker()
+        self.assertEqual(1, len([r for r in result["tracker"] if r["seeders"] == 1]))
+        self.assertNotIn("tracker", client.single_infohash_trackers)
+        await session.cleanup()
+
+        single_infohash.append(True)
+        session = HttpTrackerSession("tracker", ("localhost", port), "/announce", 5, client)
+        for infohash in [b'a' * 20, b'b' * 20, b'c' * 20]:
+            session.add_infohash(infohash)
+        result = await session.connect_to_tracker()
+        self.assertEqual(3, len([r for r in result["tracker"] if r["seeders"] == 1]))
+        self.assertIn("tracker", client.single_infohash_trackers)
+
+        await client.close()
+        await runner.cleanup()
+
     async def test_http_unprocessed_infohashes(self):
         session = HttpTrackerSession("localhost", ("localhost", 8475), "/announce", 5)
         session.infohash_list.append(b"test")
@@ -3,31 +3,66 @@ import logging
 import random
 import socket
 import time
-from asyncio import CancelledError, gather
+from asyncio import CancelledError, Semaphore, ensure_future, gather, sleep, wrap_future
+from binascii import unhexlify
+from collections import OrderedDict
 
 from ipv8.database import database_blob
 from ipv8.taskmanager import TaskManager, task
 
-from pony.orm import db_session, select
+from pony.orm import db_session
 
 from tribler_common.simpledefs import NTFY
 
+from tribler_core.modules.metadata_store.orm_bindings.channel_metadata import chunks
+from tribler_core.modules.metadata_store.serialization import CHANNEL_TORRENT
+from tribler_core.modules.metadata_store.store import SQL_IN_CHUNK_SIZE
 from tribler_core.modules.torrent_checker.torrentchecker_session import (
     FakeBep33DHTSession,
     FakeDHTSession,
+    HttpTrackerClient,
+    MAX_INFOHASHES_IN_SCRAPE,
     UdpSocketManager,
     create_tracker_session,
 )
-from tribler_core.modules.tracker_manager import MAX_TRACKER_FAILURES
 from tribler_core.utilities.tracker_utils import MalformedTrackerURLException
 from tribler_core.utilities.unicode import hexlify
 from tribler_core.utilities.utilities import has_bep33_support, is_valid_url
 
-TRACKER_SELECTION_INTERVAL = 20    # The interval for querying a random tracker
+TRACKER_SELECTION_INTERVAL = 20    # The interval between the rounds of the bulk tracker check
 TORRENT_SELECTION_INTERVAL = 120   # The interval for checking the health of a random torrent
 MIN_TORRENT_CHECK_INTERVAL = 900   # How much time we should wait before checking a torrent again
-TORRENT_CHECK_RETRY_INTERVAL = 30  # Interval when the torrent was successfully checked for the last time
-MAX_TORRENTS_CHECKED_PER_SESSION = 50
+MAX_TRACKERS_PER_ROUND = 20        # The maximum number of trackers scraped in a round of the bulk check
+MAX_SCRAPES_PER_TRACKER = 5        # The maximum number of scrape requests sent to a single tracker in a round
+MAX_CONCURRENT_SCRAPES = 10        # The maximum number of scrape requests in flight at once
+MAX_SCRAPES_PER_SECOND = 5         # The maximum rate at which the scrape requests are sent
+MAX_VISIBLE_INFOHASHES = 1000      # The number of torrents recently shown to the user that are checked first
+
+# Stale torrents of the given trackers, optionally restricted to the torrents in the subscribed channels, the least
+# recently checked first. The torrents are read page by page in the order of the last_check index, so the caller can
+# leave out the trackers that got enough of them, and stop when none are left. The torrents in the subscribed channels
+# are collected once per query instead of being probed for every torrent. Only integers are put into the query text
+sql_select_stale_torrents = (
+    "SELECT ts.infohash, tt.trackerstate, ts.last_check, ts.rowid FROM TorrentState ts "
+    "CROSS JOIN TorrentState_TrackerState tt ON tt.torrentstate = ts.rowid "
+    "WHERE ts.last_check < $stale_before AND ts.last_check >= $last_check "
+    "AND (ts.last_check, ts.rowid, tt.trackerstate) > ($last_check, $last_rowid, $last_tracker) "
+    "AND tt.trackerstate IN (%s) %s "
+    "ORDER BY ts.last_check, ts.rowid, tt.trackerstate LIMIT $limit"
+)
+
+sql_subscribed_condition = (
+    "AND ts.rowid IN (SELECT cn.health FROM ChannelNode cn WHERE cn.public_key IN "
+    "(SELECT public_key FROM ChannelNode WHERE metadata_type = $channel_type AND subscribed = 1))"
+)
+
+# Trackers of the given stale torrents. Only hex literals are put into the query text
+sql_select_stale_torrent_trackers = (
+    "SELECT ts.infohash, tt.trackerstate FROM TorrentState ts "
+    "CROSS JOIN TorrentState_TrackerState tt ON tt.torrentstate = ts.rowid "
+    "WHERE ts.last_check < $stale_before AND ts.infohash IN (%s)"
+)
+
 
 class TorrentChecker(TaskManager):
 
@@ -40,15 +75,20 @@ class TorrentChecker(TaskManager):
         self._session_list = {'DHT': []}
 
         self.socket_mgr = self.udp_transport = None
+        self.http_client = None
 
         # We keep track of the results of popular torrents checked by you.
         # The popularity community gossips this information around.
         self.torrents_checked = set()
 
+        # The torrents recently shown to the user (e.g. search results), in the order they were shown
+        self.visible_infohashes = OrderedDict()
+
     async def initialize(self):
-        self.register_task("tracker_check", self.check_random_tracker, interval=TRACKER_SELECTION_INTERVAL)
+        self.register_task("tracker_check", self.check_trackers, interval=TRACKER_SELECTION_INTERVAL)
         self.register_task("torrent_check", self.check_random_torrent, interval=TORRENT_SELECTION_INTERVAL)
         self.socket_mgr = UdpSocketManager()
+        self.http_client = HttpTrackerClient()
         await self.create_socket_or_schedule()
 
     async def listen_on_udp(self):
@@ -82,56 +122,149 @@ class TorrentChecker(TaskManager):
 
         await self.shutdown_task_manager()
 
-    async def check_random_tracker(self):
+        if self.http_client:
+            await self.http_client.close()
+            self.http_client = None
+
+    def add_visible_infohashes(self, infohashes):
         """
-        Calling this method will fetch a random tracker from the database, select some torrents that have this
-        tracker, and perform a request to these trackers.
+        Prioritize the health checks of the given torrents, e.g. because they are shown to the user in the search
+        results. The health of the most recently shown torrents is checked first.
         """
-        tracker_url = self.get_valid_next_tracker_for_auto_check()
-        if tracker_url is None:
-            self._logger.warning(u"No tracker to select from, skip")
-            return
+        for infohash in infohashes:
+            self.visible_infohashes.pop(infohash, None)
+            self.visible_infohashes[infohash] = None
+        while len(self.visible_infohashes) > MAX_VISIBLE_INFOHASHES:
+            self.visible_infohashes.popitem(last=False)
 
-        self._logger.debug(u"Start selecting torrents on tracker %s.", tracker_url)
+    def select_tracker_batches(self, visible_infohashes, now):
+        """
+        Select the stale torrents to check in a round of the bulk check, grouped by tracker into batches that fit
+        into single scrape requests. Every torrent is only checked on one of its trackers in a round.
+        Within the quota of a tracker, the torrents are prioritized by their visibility to the user: first the torrents
+        recently shown to the user, then the torrents in the subscribed channels, and then all the others. Within each
+        group, the least recently checked torrents go first.
+        :param visible_infohashes: the infohashes recently shown to the user, the most important first
+        :param now: the current time
+        :return: (batches, invalid_trackers, idle_trackers) tuple. The batches are (tracker_url, infohashes) tuples.
+            They are interleaved, so the first batches of all the trackers come before their second batches, etc.
+        """
+        mds = self.tribler_session.mds
+        stale_before = now - MIN_TORRENT_CHECK_INTERVAL
+        quota = MAX_SCRAPES_PER_TRACKER * MAX_INFOHASHES_IN_SCRAPE
 
-        # get the torrents that should be checked
         with db_session:
-            tracker = self.tribler_session.mds.TrackerState.get(url=tracker_url)
-            if not tracker:
-                return
-            dynamic_interval = TORRENT_CHECK_RETRY_INTERVAL * (2 ** tracker.failures)
-            # FIXME: this is a really dumb fix for update_tracker_info not being called in some cases
-            if tracker.failures >= MAX_TRACKER_FAILURES:
-                tracker.alive = False
-                return
-            torrents = select(ts for ts in tracker.torrents if ts.last_check + dynamic_interval < int(time.time()))
-            infohashes = [t.infohash for t in torrents[:MAX_TORRENTS_CHECKED_PER_SESSION]]
+            trackers = OrderedDict()
+            invalid_trackers = []
+            for tracker_url in self.tribler_session.tracker_manager.get_next_trackers_for_auto_check(
+                    MAX_TRACKERS_PER_ROUND):
+                if is_valid_url(tracker_url):
+                    trackers[mds.TrackerState.get(url=tracker_url).rowid] = tracker_url
+                else:
+                    invalid_trackers.append(tracker_url)
+
+            selected = OrderedDict((tracker_id, []) for tracker_id in trackers)
+            assigned = set()
+
+            def assign(infohash, tracker_id):
+                if infohash not in assigned and len(selected[tracker_id]) < quota:
+                    assigned.add(infohash)
+                    selected[tracker_id].append(infohash)
+
+            for chunk in chunks(visible_infohashes, SQL_IN_CHUNK_SIZE):
+                torrent_trackers = {}
+                for infohash, tracker_id in mds._db.select(
+                        sql_select_stale_torrent_trackers % ", ".join("X'%s'" % hexlify(ih) for ih in chunk),
+                        globals(), {"stale_before": stale_before}):
+                    if tracker_id in selected:
+                        torrent_trackers.setdefault(bytes(infohash), tracker_id)
+                for infohash in chunk:
+                    if infohash in torrent_trackers:
+                        assign(infohash, torrent_trackers[infohash])
+
+            # The torrents are assigned to the first of their trackers that still has quota left. The trackers
+            # that have no quota left are dropped from the query, so only the rows that can still be used are read.
+            for condition in (sql_subscribed_condition, ""):
+                params = {"stale_before": stale_before, "channel_type": CHANNEL_TORRENT,
+                          "last_check": -2 ** 63, "last_rowid": 0, "last_tracker": 0}
+                open_trackers = [tracker_id for tracker_id, infohashes in selected.items() if len(infohashes) < quota]
+                while open_trackers:
+                    params["limit"] = sum(quota - len(selected[tracker_id]) for tracker_id in open_trackers)
+                    tracker_ids = ", ".join(str(int(tracker_id)) for tracker_id in open_trackers)
+                    rows = mds._db.select(sql_select_stale_torrents % (tracker_ids, condition), globals(), params)
+                    for infohash, tracker_id, _, _ in rows:
+                        assign(bytes(infohash), tracker_id)
+                    if len(rows) < params["limit"]:
+                        break
+                    _, params["last_tracker"], params["last_check"], params["last_rowid"] = rows[-1]
+                    open_trackers = [tracker_id for tracker_id in open_trackers if len(selected[tracker_id]) < quota]
+
+        tracker_batches = [(trackers[tracker_id], list(chunks(infohashes, MAX_INFOHASHES_IN_SCRAPE)))
+                           for tracker_id, infohashes in selected.items() if infohashes]
+        batches = [(tracker_url, batch[index])
+                   for index in range(MAX_SCRAPES_PER_TRACKER)
+                   for tracker_url, batch in tracker_batches if index < len(batch)]
+        idle_trackers = [trackers[tracker_id] for tracker_id, infohashes in selected.items() if not infohashes]
+        return batches, invalid_trackers, idle_trackers
+
+    async def check_trackers(self):
+        """
+        Check the health of the stale torrents in bulk, by scraping many trackers at once.
+        The torrents are grouped by tracker, so every scrape request asks for as many torrents as fit into it.
+        The number of the scrape requests in flight and their rate are limited, so the checks do not flood
+        the network.
+        """
+        visible_infohashes = list(reversed(self.visible_infohashes))
+        try:
+            batches, invalid_trackers, idle_trackers = await self.tribler_session.mds.run_read(
+                self.select_tracker_batches, visible_infohashes, int(time.time()))
+        except Exception as e:
+            self._logger.error("Error while selecting the torrents to check: %s", e)
+            return
 
-        if len(infohashes) == 0:
+        for tracker_url in invalid_trackers:
+            self.remove_tracker(tracker_url)
+        for tracker_url in idle_trackers:
             # We have no torrent to recheck for this tracker. Still update the last_check for this tracker.
-            self._logger.info("No torrent to check for tracker %s", tracker_url)
             self.update_tracker_info(tracker_url, True)
-            return
 
+        self._logger.info("Selected %d scrape requests to %d trackers",
+                          len(batches), len({tracker_url for tracker_url, _ in batches}))
+        semaphore = Semaphore(MAX_CONCURRENT_SCRAPES)
+        scrapes = []
+        for tracker_url, infohashes in batches:
+            await semaphore.acquire()
+            if self._should_stop:
+                break
+            scrapes.append(self.register_anonymous_task(
+                "scrape", ensure_future(self.scrape_batch(tracker_url, infohashes, semaphore)), ignore=(Exception,)))
+            await sleep(1 / MAX_SCRAPES_PER_SECOND)
+        await gather(*scrapes, return_exceptions=True)
+
+    async def scrape_batch(self, tracker_url, infohashes, semaphore):
+        """
+        Scrape the given torrents from a tracker, and store their health in the database.
+        """
         try:
-            session = self._create_session_for_request(tracker_url, timeout=30)
-        except MalformedTrackerURLException as e:
-            # Remove the tracker from the database
-            self.remove_tracker(tracker_url)
-            self._logger.error(e)
-            return
-
-        # We shuffle the list so that different infohashes are checked on subsequent scrape requests if the total
-        # number of infohashes exceeds the maximum number of infohashes we check.
-        random.shuffle(infohashes)
-        for infohash in infohashes:
-            session.add_infohash(infohash)
+            try:
+                session = self._create_session_for_request(tracker_url, timeout=30)
+            except MalformedTrackerURLException as e:
+                self.remove_tracker(tracker_url)
+                self._logger.error(e)
+                return
+            for infohash in infohashes:
+                session.add_infohash(infohash)
+            try:
+                result = await self.connect_to_tracker(session)
+            except Exception:
+                return
+        finally:
+            semaphore.release()
 
-        self._logger.info(u"Selected %d new torrents to check on tracker: %s", len(infohashes), tracker_url)
-        try:
-            await self.connect_to_tracker(session)
-        except:
-            pass
+        if result:
+            # The tracker goes to the back of the queue of the bulk check, so the other trackers get their turn
+            self.update_tracker_info(tracker_url, True)
+            await self._update_torrents_health(result[tracker_url], int(time.time()))
 
     async def connect_to_tracker(self, session):
         try:
@@ -242,14 +375,17 @@ class TorrentChecker(TaskManager):
         self._update_torrent_result(torrent_update_dict)
         self.update_torrents_checked(torrent_update_dict)
 
+        self.notify_torrent_health_updated(torrent_update_dict)
+        return final_response
+
+    def notify_torrent_health_updated(self, torrent_update_dict):
         # TODO: DRY! Stop doing lots of formats, just make REST endpoint automatically encode binary data to hex!
         self.tribler_session.notifier.notify(NTFY.CHANNEL_ENTITY_UPDATED,
-                                             {"infohash": hexlify(infohash),
+                                             {"infohash": hexlify(torrent_update_dict["infohash"]),
                                               "num_seeders": torrent_update_dict["seeders"],
                                               "num_leechers": torrent_update_dict["leechers"],
                                               "last_tracker_check": torrent_update_dict["last_check"],
                                               "health": "updated"})
-        return final_response
 
     @task
     async def check_torrent_health(self, infohash, timeout=20, scrape_now=False):
@@ -303,7 +439,7 @@ class TorrentChecker(TaskManager):
         return self.on_torrent_health_check_completed(infohash, res)
 
     def _create_session_for_request(self, tracker_url, timeout=20):
-        session = create_tracker_session(tracker_url, timeout, self.socket_mgr)
+        session = create_tracker_session(tracker_url, timeout, self.socket_mgr, self.http_client)
 
         if tracker_url not in self._session_list:
             self._session_list[tracker_url] = []
@@ -337,8 +473,7 @@ class TorrentChecker(TaskManager):
 
         self._logger.debug(u"Update result %s/%s for %s", seeders, leechers, hexlify(infohash))
 
-        with db_session:
-            # Update torrent state
+        def update_torrent_state():
             torrent = self.tribler_session.mds.TorrentState.get(infohash=database_blob(infohash))
             if not torrent:
                 self._logger.warning(
@@ -347,3 +482,39 @@ class TorrentChecker(TaskManager):
             torrent.seeders = seeders
             torrent.leechers = leechers
             torrent.last_check = last_check
+
+        # The health updates are small and frequent, so they are coalesced by the DB writer
+        return self.tribler_session.mds.writer.submit(update_torrent_state, coalesce=True)
+
+    async def _update_torrents_health(self, health_list, last_check):
+        """
+        Store the health of the torrents reported by a tracker in the database.
+        :param health_list: list of {'infohash', 'seeders', 'leechers'} dicts with hex-encoded infohashes
+        :return: list of the torrent_update_dicts of the torrents that had their health updated
+        """
+
+        def update_torrent_states():
+            updated = []
+            for health in health_list:
+                infohash = unhexlify(health['infohash'])
+                torrent = self.tribler_session.mds.TorrentState.get(infohash=database_blob(infohash))
+                if not torrent:
+                    continue
+                # Other trackers of the swarm may have reported on it recently, so keep the best of the recent results
+                if torrent.last_check + MIN_TORRENT_CHECK_INTERVAL > last_check and \
+                        (torrent.seeders, torrent.leechers) >= (health['seeders'], health['leechers']):
+                    continue
+                torrent.seeders = health['seeders']
+                torrent.leechers = health['leechers']
+                torrent.last_check = last_check
+                updated.append({'infohash': infohash, 'seeders': torrent.seeders, 'leechers': torrent.leechers,
+                                'last_check': torrent.last_check})
+            return updated
+
+        # The GUI is only notified once the updates are committed
+        updated = await wrap_future(self.tribler_session.mds.writer.submit(update_torrent_states, coalesce=True))
+        # Only the updates of the torrents shown to the user are worth notifying the GUI about
+        for torrent_update_dict in updated:
+            if torrent_update_dict['infohash'] in self.visible_infohashes:
+                self.notify_torrent_health_updated(torrent_update_dict)
+        return updated
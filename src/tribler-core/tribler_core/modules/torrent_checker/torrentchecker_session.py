@@ -5,9 +5,9 @@ import struct
 import sys
 import time
 from abc import ABCMeta, abstractmethod
-from asyncio import DatagramProtocol, Future, TimeoutError, ensure_future, get_event_loop
+from asyncio import DatagramProtocol, Future, TimeoutError, ensure_future, gather, get_event_loop, shield
 
-from aiohttp import ClientResponseError, ClientSession, ClientTimeout
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout, TCPConnector
 
 from async_timeout import timeout
 
@@ -24,25 +24,43 @@ TRACKER_ACTION_CONNECT = 0
 TRACKER_ACTION_ANNOUNCE = 1
 TRACKER_ACTION_SCRAPE = 2
 
-MAX_INT32 = 2 ** 16 - 1
+MAX_INT32 = 2 ** 31 - 1
 
 UDP_TRACKER_INIT_CONNECTION_ID = 0x41727101980
 
 MAX_INFOHASHES_IN_SCRAPE = 60
 
+# BEP15: "Up to about 74 torrents can be scraped at once"
+MAX_INFOHASHES_IN_UDP_SCRAPE = 74
 
-def create_tracker_session(tracker_url, timeout, socket_manager):
+# BEP15: a connection ID can be used for a minute after it is received. We keep a margin for the round trip
+UDP_CONNECTION_ID_LIFETIME = 50
+
+# The resolved addresses of the tracker hostnames are reused for this many seconds
+DNS_CACHE_TTL = 300
+
+# The time the scrape requests to a tracker are held back, to be merged with other requests to the same tracker
+UDP_SCRAPE_MERGE_DELAY = 0.05
+
+HTTP_TRACKER_CONNECTIONS = 50            # The maximum number of connections to the HTTP trackers
+HTTP_TRACKER_CONNECTIONS_PER_HOST = 4    # The maximum number of connections to a single HTTP tracker
+HTTP_TRACKER_KEEPALIVE_TIMEOUT = 60      # How long an idle connection to an HTTP tracker is kept open
+
+
+def create_tracker_session(tracker_url, timeout, socket_manager, http_client=None):
     """
     Creates a tracker session with the given tracker URL.
     :param tracker_url: The given tracker URL.
     :param timeout: The timeout for the session.
+    :param socket_manager: The UdpSocketManager shared by the UDP tracker sessions.
+    :param http_client: The HttpTrackerClient shared by the HTTP tracker sessions, if any.
     :return: The tracker session.
     """
     tracker_type, tracker_address, announce_page = parse_tracker_url(tracker_url)
 
     if tracker_type == u'udp':
         return UdpTrackerSession(tracker_url, tracker_address, announce_page, timeout, socket_manager)
-    return HttpTrackerSession(tracker_url, tracker_address, announce_page, timeout)
+    return HttpTrackerSession(tracker_url, tracker_address, announce_page, timeout, http_client)
 
 
 class TrackerSession(TaskManager):
@@ -109,32 +127,70 @@ class TrackerSession(TaskManager):
         """Does some work when a connection has been established."""
 
 
+class HttpTrackerClient(object):
+    """
+    The HTTP client shared by the HTTP tracker sessions.
+
+    The connections to the trackers are pooled and kept alive between the scrapes, so checking the health of many
+    torrents on a popular tracker does not pay for the TCP (and TLS) setup again and again. The number of
+    connections is bounded, both in total and per tracker.
+    """
+
+    def __init__(self, limit=HTTP_TRACKER_CONNECTIONS, limit_per_host=HTTP_TRACKER_CONNECTIONS_PER_HOST,
+                 keepalive_timeout=HTTP_TRACKER_KEEPALIVE_TIMEOUT):
+        connector = TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout)
+        self.session = ClientSession(connector=connector, raise_for_status=True)
+        # The trackers that only answer the scrape requests for a single infohash
+        self.single_infohash_trackers = set()
+
+    async def close(self):
+        await self.session.close()
+
+
 class HttpTrackerSession(TrackerSession):
-    def __init__(self, tracker_url, tracker_address, announce_page, timeout):
+    def __init__(self, tracker_url, tracker_address, announce_page, timeout, http_client=None):
+        """
+        :param http_client: the HttpTrackerClient to send the requests with. By default, the session uses a client
+            of its own, which is closed on cleanup.
+        """
         super(HttpTrackerSession, self).__init__(u'http', tracker_url, tracker_address, announce_page, timeout)
-        self._session = ClientSession(raise_for_status=True, timeout=ClientTimeout(total=self.timeout))
+        self._owns_client = http_client is None
+        self._client = http_client or HttpTrackerClient()
+        self._session = self._client.session
 
     async def connect_to_tracker(self):
-        # create the HTTP GET message
-        # Note: some trackers have strange URLs, e.g.,
-        #       http://moviezone.ws/announce.php?passkey=8ae51c4b47d3e7d0774a720fa511cc2a
-        #       which has some sort of 'key' as parameter, so we need to use the add_url_params
-        #       utility function to handle such cases.
-
-        url = add_url_params("http://%s:%s%s" %
-                             (self.tracker_address[0], self.tracker_address[1],
-                              self.announce_page.replace(u'announce', u'scrape')),
-                             {"info_hash": self.infohash_list})
-
         # no more requests can be appended to this session
         self.is_initiated = True
         self.last_contact = int(time.time())
 
+        # Multiple infohashes are scraped in a single request, unless the tracker is known not to support that
+        if len(self.infohash_list) > 1 and self.tracker_url in self._client.single_infohash_trackers:
+            bodies = await self._scrape([[infohash] for infohash in self.infohash_list])
+        else:
+            bodies = await self._scrape([self.infohash_list])
+
+        files = {}
+        for body in bodies:
+            files.update(self._get_scraped_files(body))
+        if len(bodies) == 1 and len(self.infohash_list) > 1 and list(files) == self.infohash_list[:1]:
+            # The tracker only answered for the first infohash. Either it ignores the others, or it does not know
+            # them. Ask for them one by one, and only remember the tracker as a single infohash one if it knows them
+            other_files = {}
+            for body in await self._scrape([[infohash] for infohash in self.infohash_list[1:]]):
+                other_files.update(self._get_scraped_files(body))
+            if other_files:
+                self._logger.info(u"%s Tracker does not support scraping multiple infohashes at once", self)
+                self._client.single_infohash_trackers.add(self.tracker_url)
+            files.update(other_files)
+        return self._process_scraped_files(files)
+
+    async def _scrape(self, infohash_groups):
+        """
+        Send a scrape request for every group of infohashes.
+        :return: the list of the response bodies
+        """
         try:
-            self._logger.debug(u"%s HTTP SCRAPE message sent: %s", self, url)
-            async with self._session:
-                async with self._session.get(url.encode('ascii').decode('utf-8')) as response:
-                    body = await response.read()
+            return await gather(*[self._get_scrape_response(infohashes) for infohashes in infohash_groups])
         except UnicodeEncodeError as e:
             raise e
         except ClientResponseError as e:
@@ -143,14 +199,34 @@ class HttpTrackerSession(TrackerSession):
         except Exception as e:
             self.failed(msg=str(e))
 
-        return self._process_scrape_response(body)
+    async def _get_scrape_response(self, infohashes):
+        # create the HTTP GET message
+        # Note: some trackers have strange URLs, e.g.,
+        #       http://moviezone.ws/announce.php?passkey=8ae51c4b47d3e7d0774a720fa511cc2a
+        #       which has some sort of 'key' as parameter, so we need to use the add_url_params
+        #       utility function to handle such cases.
+        url = add_url_params("http://%s:%s%s" %
+                             (self.tracker_address[0], self.tracker_address[1],
+                              self.announce_page.replace(u'announce', u'scrape')),
+                             {"info_hash": infohashes})
+
+        self._logger.debug(u"%s HTTP SCRAPE message sent: %s", self, url)
+        async with self._session.get(url.encode('ascii').decode('utf-8'),
+                                     timeout=ClientTimeout(total=self.timeout)) as response:
+            return await response.read()
 
     def _process_scrape_response(self, body):
         """
         This function handles the response body of a HTTP tracker,
         parsing the results.
         """
-        # parse the retrieved results
+        return self._process_scraped_files(self._get_scraped_files(body))
+
+    def _get_scraped_files(self, body):
+        """
+        Parse the response body of a HTTP tracker.
+        :return: the dictionary with the scrape results per infohash
+        """
         if body is None:
             self.failed(msg="no response body")
 
@@ -158,32 +234,35 @@ class HttpTrackerSession(TrackerSession):
         if not response_dict:
             self.failed(msg="no valid response")
 
-        response_list = []
-
-        unprocessed_infohash_list = self.infohash_list[:]
         if b'files' in response_dict and isinstance(response_dict[b'files'], dict):
-            for infohash in response_dict[b'files']:
-                complete = 0
-                incomplete = 0
-                if isinstance(response_dict[b'files'][infohash], dict):
-                    complete = response_dict[b'files'][infohash].get(b'complete', 0)
-                    incomplete = response_dict[b'files'][infohash].get(b'incomplete', 0)
-
-                # Sow complete as seeders. "complete: number of peers with the entire file, i.e. seeders (integer)"
-                #  - https://wiki.theory.org/BitTorrentSpecification#Tracker_.27scrape.27_Convention
-                seeders = complete
-                leechers = incomplete
-
-                # Store the information in the dictionary
-                response_list.append({'infohash': hexlify(infohash), 'seeders': seeders, 'leechers': leechers})
-
-                # remove this infohash in the infohash list of this session
-                if infohash in unprocessed_infohash_list:
-                    unprocessed_infohash_list.remove(infohash)
-
-        elif b'failure reason' in response_dict:
+            return response_dict[b'files']
+        if b'failure reason' in response_dict:
             self._logger.info(u"%s Failure as reported by tracker [%s]", self, repr(response_dict[b'failure reason']))
             self.failed(msg=repr(response_dict[b'failure reason']))
+        return {}
+
+    def _process_scraped_files(self, files):
+        response_list = []
+
+        unprocessed_infohash_list = self.infohash_list[:]
+        for infohash in files:
+            complete = 0
+            incomplete = 0
+            if isinstance(files[infohash], dict):
+                complete = files[infohash].get(b'complete', 0)
+                incomplete = files[infohash].get(b'incomplete', 0)
+
+            # Sow complete as seeders. "complete: number of peers with the entire file, i.e. seeders (integer)"
+            #  - https://wiki.theory.org/BitTorrentSpecification#Tracker_.27scrape.27_Convention
+            seeders = complete
+            leechers = incomplete
+
+            # Store the information in the dictionary
+            response_list.append({'infohash': hexlify(infohash), 'seeders': seeders, 'leechers': leechers})
+
+            # remove this infohash in the infohash list of this session
+            if infohash in unprocessed_infohash_list:
+                unprocessed_infohash_list.remove(infohash)
 
         # handle the infohashes with no result (seeders/leechers = 0/0)
         for infohash in unprocessed_infohash_list:
@@ -197,13 +276,32 @@ class HttpTrackerSession(TrackerSession):
         Cleans the session by cancelling all deferreds and closing sockets.
         :return: A deferred that fires once the cleanup is done.
         """
-        await self._session.close()
+        if self._owns_client:
+            await self._client.close()
         await super(HttpTrackerSession, self).cleanup()
 
 
+class MergedScrape(object):
+    """
+    Scrape requests to a single tracker that are sent out as one packet.
+    """
+
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.num_infohashes = 0
+        # (transaction_id, infohashes, future) of every merged request
+        self.requests = []
+
+
 class UdpSocketManager(DatagramProtocol):
     """
     The UdpSocketManager ensures that the network packets are forwarded to the right UdpTrackerSession.
+
+    The manager is shared by all the UDP tracker sessions, so it also keeps what the sessions can reuse: the
+    connection IDs of the trackers (see BEP15) and the addresses of their hostnames. Besides, the scrape requests
+    that are sent to the same tracker at about the same time are merged into a single packet. The response to
+    a merged packet is split back into the responses to the original requests, so the sessions do not notice.
+    The responses are matched to the requests by their transaction IDs.
     """
 
     def __init__(self):
@@ -211,25 +309,166 @@ class UdpSocketManager(DatagramProtocol):
         self.tracker_sessions = {}
         self.transport = None
 
+        # (ip, port) -> (connection ID, expiry time)
+        self.connection_ids = {}
+        # hostname -> (ip, expiry time)
+        self.dns_cache = {}
+        self._resolving = {}
+        # (ip, port) -> MergedScrape waiting to be sent
+        self._pending_scrapes = {}
+
     def connection_made(self, transport):
         self.transport = transport
 
+    def get_connection_id(self, address):
+        """
+        Get the connection ID for the tracker at the given address, if we have a valid one.
+        """
+        connection_id, expiry = self.connection_ids.get(address, (None, 0))
+        return connection_id if expiry > time.time() else None
+
+    def set_connection_id(self, address, connection_id):
+        self.connection_ids[address] = (connection_id, time.time() + UDP_CONNECTION_ID_LIFETIME)
+
+    def remove_connection_id(self, address):
+        self.connection_ids.pop(address, None)
+
+    async def resolve(self, hostname):
+        """
+        Resolve the hostname of a tracker to an IPv4 address. The addresses are cached for DNS_CACHE_TTL seconds,
+        and concurrent lookups of the same hostname are served by a single query.
+        """
+        ip_address, expiry = self.dns_cache.get(hostname, (None, 0))
+        if expiry > time.time():
+            return ip_address
+
+        lookup = self._resolving.get(hostname)
+        if lookup is None:
+            lookup = self._resolving[hostname] = ensure_future(
+                get_event_loop().getaddrinfo(hostname, 0, family=socket.AF_INET))
+            lookup.add_done_callback(lambda _: self._resolving.pop(hostname, None))
+        # The lookup is shared, so it must not be cancelled together with one of the sessions waiting for it
+        infos = await shield(lookup)
+        ip_address = infos[0][-1][0]
+        self.dns_cache[hostname] = (ip_address, time.time() + DNS_CACHE_TTL)
+        return ip_address
+
+    def new_transaction_id(self):
+        while True:
+            transaction_id = random.randint(0, MAX_INT32)
+            if transaction_id not in self.tracker_sessions:
+                return transaction_id
+
     def send_request(self, data, tracker_session):
+        address = (tracker_session.ip_address, tracker_session.port)
+        if len(data) > 16 and struct.unpack_from('!i', data, 8)[0] == TRACKER_ACTION_SCRAPE:
+            return self._add_scrape(data, address)
+        return self._send(data, address, tracker_session.transaction_id, Future())
+
+    def _send(self, data, address, transaction_id, future):
         try:
-            self.transport.sendto(data, (tracker_session.ip_address, tracker_session.port))
-            f = self.tracker_sessions[tracker_session.transaction_id] = Future()
-            return f
+            self.transport.sendto(data, address)
+            self.tracker_sessions[transaction_id] = future
+            return future
         except socket.error as e:
-            self._logger.warning("Unable to write data to %s:%d - %s",
-                                 tracker_session.ip_address, tracker_session.port, e)
+            self._logger.warning("Unable to write data to %s:%d - %s", address[0], address[1], e)
             return RuntimeError("Unable to write to socket - " + str(e))
 
+    def _add_scrape(self, data, address):
+        """
+        Queue a scrape request, to be sent after UDP_SCRAPE_MERGE_DELAY together with the other scrape requests
+        to the same tracker.
+        :return: Future with the response to the request
+        """
+        connection_id, _, transaction_id = struct.unpack_from('!qii', data, 0)
+        infohashes = [data[offset:offset + 20] for offset in range(16, len(data), 20)]
+
+        pending = self._pending_scrapes.get(address)
+        if pending and (pending.connection_id != connection_id or
+                        pending.num_infohashes + len(infohashes) > MAX_INFOHASHES_IN_UDP_SCRAPE):
+            self._send_scrape(address)
+            pending = None
+        if pending is None:
+            pending = self._pending_scrapes[address] = MergedScrape(connection_id)
+            get_event_loop().call_later(UDP_SCRAPE_MERGE_DELAY, self._send_scrape, address, pending)
+
+        future = Future()
+        pending.num_infohashes += len(infohashes)
+        pending.requests.append((transaction_id, infohashes, future))
+        return future
+
+    def _send_scrape(self, address, pending=None):
+        """
+        Send the queued scrape requests to the tracker at the given address in a single packet.
+        :param pending: the MergedScrape to send, unless it was sent already. By default, the queued one.
+        """
+        if pending is None:
+            pending = self._pending_scrapes.get(address)
+        if pending is None or self._pending_scrapes.get(address) is not pending:
+            return
+        del self._pending_scrapes[address]
+
+        # The requests of the sessions that timed out in the meantime are dropped
+        requests = [request for request in pending.requests if not request[2].done()]
+        if not requests:
+            return
+        if len(requests) == 1:
+            # Nothing to merge, so the request is sent as it is
+            transaction_id, infohashes, future = requests[0]
+        else:
+            transaction_id = self.new_transaction_id()
+            infohashes = [infohash for _, request_infohashes, _ in requests for infohash in request_infohashes]
+            future = Future()
+            future.add_done_callback(lambda f: self._split_scrape_response(f, requests))
+            for _, _, request_future in requests:
+                request_future.add_done_callback(lambda _: self._forget_scrape(transaction_id, future, requests))
+
+        message = struct.pack('!qii', pending.connection_id, TRACKER_ACTION_SCRAPE, transaction_id)
+        sent = self._send(message + b''.join(infohashes), address, transaction_id, future)
+        if isinstance(sent, Exception):
+            for _, _, request_future in requests:
+                if not request_future.done():
+                    request_future.set_exception(sent)
+
+    @staticmethod
+    def _split_scrape_response(future, requests):
+        """
+        Split the response to a merged scrape packet into the responses to the merged requests.
+        """
+        if future.cancelled():
+            return
+        response = future.result()
+        num_infohashes = sum(len(infohashes) for _, infohashes, _ in requests)
+        offset = 8
+        for transaction_id, infohashes, request_future in requests:
+            size = 12 * len(infohashes)
+            if not request_future.done():
+                if len(response) < 8:
+                    request_future.set_result(response)
+                elif len(response) == 8 + 12 * num_infohashes:
+                    request_future.set_result(response[:4] + struct.pack('!i', transaction_id) +
+                                              response[offset:offset + size])
+                else:
+                    # Errors and malformed responses are passed on to all the requests, so every session handles them
+                    request_future.set_result(response[:4] + struct.pack('!i', transaction_id) + response[8:])
+            offset += size
+
+    def _forget_scrape(self, transaction_id, future, requests):
+        """
+        Stop waiting for the response to a merged scrape packet once all the merged requests are given up on.
+        """
+        if not future.done() and all(request_future.done() for _, _, request_future in requests):
+            self.tracker_sessions.pop(transaction_id, None)
+            future.cancel()
+
     def datagram_received(self, data, _):
         # If the incoming data is valid, find the tracker session and give it the data
-        if data and len(data) >= 4:
+        if data and len(data) >= 8:
             transaction_id = struct.unpack_from('!i', data, 4)[0]
             if transaction_id in self.tracker_sessions:
-                self.tracker_sessions.pop(transaction_id).set_result(data)
+                future = self.tracker_sessions.pop(transaction_id)
+                if not future.done():
+                    future.set_result(data)
 
 
 class UdpTrackerSession(TrackerSession):
@@ -264,7 +503,8 @@ class UdpTrackerSession(TrackerSession):
         while True:
             # make sure there is no duplicated transaction IDs
             transaction_id = random.randint(0, MAX_INT32)
-            if transaction_id not in UdpTrackerSession._active_session_dict.items():
+            if transaction_id not in UdpTrackerSession._active_session_dict.values() and \
+                    (not self.socket_mgr or transaction_id not in self.socket_mgr.tracker_sessions):
                 UdpTrackerSession._active_session_dict[self] = transaction_id
                 self.transaction_id = transaction_id
                 break
@@ -301,20 +541,25 @@ class UdpTrackerSession(TrackerSession):
 
         # Clean old tasks if present
         await self.cancel_pending_task("result")
-        await self.cancel_pending_task("resolve")
 
         try:
             async with timeout(self.timeout):
                 # Resolve the hostname to an IP address if not done already
-                coro = get_event_loop().getaddrinfo(self.tracker_address[0], 0, family=socket.AF_INET)
-                if isinstance(coro, Future):
-                    infos = await coro  # In Python <=3.6 getaddrinfo returns a Future
+                self.ip_address = await self.socket_mgr.resolve(self.tracker_address[0])
+                # Skip the connection handshake if we still have a valid connection ID for the tracker
+                connection_id = self.socket_mgr.get_connection_id((self.ip_address, self.port))
+                if connection_id is None:
+                    await self.connect()
                 else:
-                    infos = await self.register_anonymous_task("resolve", ensure_future(coro),
-                                                               ignore=(socket.gaierror,))
-                self.ip_address = infos[0][-1][0]
-                await self.connect()
-                return await self.scrape()
+                    self._connection_id = connection_id
+                    self.action = TRACKER_ACTION_SCRAPE
+                    self.generate_transaction_id()
+                try:
+                    return await self.scrape()
+                except ValueError:
+                    # The tracker might have rejected the connection ID, so we will connect again next time
+                    self.socket_mgr.remove_connection_id((self.ip_address, self.port))
+                    raise
         except TimeoutError:
             self.failed(msg='request timed out')
         except socket.gaierror as e:
@@ -349,6 +594,7 @@ class UdpTrackerSession(TrackerSession):
 
         # update action and IDs
         self._connection_id = struct.unpack_from('!q', response, 8)[0]
+        self.socket_mgr.set_connection_id((self.ip_address, self.port), self._connection_id)
         self.action = TRACKER_ACTION_SCRAPE
         self.generate_transaction_id()
         self.last_contact = int(time.time())
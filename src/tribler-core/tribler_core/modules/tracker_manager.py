@@ -120,18 +120,24 @@ class TrackerManager(object):
         tracker.failures = failures
         tracker.alive = is_alive
 
-    @db_session
     def get_next_tracker_for_auto_check(self):
         """
         Gets the next tracker for automatic tracker-checking.
         :return: The next tracker for automatic tracker-checking.
         """
-        tracker = self.tracker_store.select(lambda g: str(g.url)
-                                            and g.alive
-                                            and g.last_check + TRACKER_RETRY_INTERVAL <= int(time.time())
-                                            and str(g.url) not in self.blacklist)\
-            .order_by(self.tracker_store.last_check).limit(1)
+        trackers = self.get_next_trackers_for_auto_check(1)
+        return trackers[0] if trackers else None
 
-        if not tracker:
-            return None
-        return tracker[0].url
+    @db_session
+    def get_next_trackers_for_auto_check(self, limit):
+        """
+        Gets the trackers that are due for automatic tracker-checking, the least recently checked first.
+        :param limit: The maximum number of trackers to return.
+        :return: The list of the tracker URLs.
+        """
+        trackers = self.tracker_store.select(lambda g: str(g.url)
+                                             and g.alive
+                                             and g.last_check + TRACKER_RETRY_INTERVAL <= int(time.time())
+                                             and str(g.url) not in self.blacklist)\
+            .order_by(self.tracker_store.last_check).limit(limit)
+        return [tracker.url for tracker in trackers]
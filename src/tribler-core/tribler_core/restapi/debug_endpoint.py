@@ -24,6 +24,15 @@ except ImportError:
     HAS_MELIAE = False
 
 
+CacheStatsSchema = schema(CacheStats={
+    'size': Integer,
+    'max_size': Integer,
+    'ttl': Float,
+    'hits': Integer,
+    'misses': Integer
+})
+
+
 class MemoryDumpBuffer(StringIO):
     """
     Meliae expects its file handle to support write(), flush() and __call__().
@@ -46,6 +55,8 @@ class DebugEndpoint(RESTEndpoint):
                              web.get('/threads', self.get_threads),
                              web.get('/cpu/history', self.get_cpu_history),
                              web.get('/memory/history', self.get_memory_history),
+                             web.get('/caches', self.get_caches),
+                             web.get('/db_writer', self.get_db_writer_stats),
                              web.get('/log', self.get_log),
                              web.get('/profiler', self.get_profiler_state),
                              web.put('/profiler', self.start_profiler),
@@ -179,6 +190,46 @@ class DebugEndpoint(RESTEndpoint):
         history = self.session.resource_monitor.get_memory_history_dict() if self.session.resource_monitor else {}
         return RESTResponse({"memory_history": history})
 
+    @docs(
+        tags=['Debug'],
+        summary="Return the statistics of the database query caches.",
+        responses={
+            200: {
+                'schema': schema(CachesResponse={'caches': schema(Caches={
+                    'search': CacheStatsSchema,
+                    'count': CacheStatsSchema
+                })})
+            }
+        }
+    )
+    async def get_caches(self, request):
+        mds = self.session.mds
+        caches = {"search": mds.search_cache.get_stats(), "count": mds.count_cache.get_stats()} if mds else {}
+        return RESTResponse({"caches": caches})
+
+    @docs(
+        tags=['Debug'],
+        summary="Return the statistics of the database writer thread.",
+        responses={
+            200: {
+                'schema': schema(DBWriterResponse={'db_writer': schema(DBWriterStats={
+                    'queue_depth': Integer,
+                    'max_queue_depth': Integer,
+                    'tasks': Integer,
+                    'coalesced_tasks': Integer,
+                    'batches': Integer,
+                    'last_commit_latency': Float,
+                    'max_commit_latency': Float,
+                    'avg_commit_latency': Float,
+                    'avg_task_latency': Float
+                })})
+            }
+        }
+    )
+    async def get_db_writer_stats(self, request):
+        stats = self.session.mds.writer.get_stats() if self.session.mds else {}
+        return RESTResponse({"db_writer": stats})
+
     @docs(
         tags=['Debug'],
         summary="Return a Meliae-compatible dump of the memory contents.",
@@ -2,6 +2,8 @@ import os
 import sys
 from unittest import skipIf
 
+from tribler_core.modules.metadata_store.db_pool import DBWriter
+from tribler_core.modules.metadata_store.query_cache import QueryCache
 from tribler_core.restapi.base_api_test import AbstractApiTest
 from tribler_core.tests.tools.base_test import MockObject
 from tribler_core.tests.tools.tools import timeout
@@ -66,6 +68,39 @@ class TestCircuitDebugEndpoint(AbstractApiTest):
         response_json = await self.do_request('debug/memory/history', expected_code=200)
         self.assertGreaterEqual(len(response_json['memory_history']), 1)
 
+    @timeout(10)
+    async def test_get_caches(self):
+        """
+        Test whether the API returns the statistics of the database caches
+        """
+        response_json = await self.do_request('debug/caches', expected_code=200)
+        self.assertEqual(response_json['caches'], {})
+
+        self.session.mds = MockObject()
+        self.session.mds.search_cache = QueryCache(max_size=10, ttl=60)
+        self.session.mds.count_cache = QueryCache(max_size=20)
+        self.session.mds.search_cache.get("query", 1)
+        response_json = await self.do_request('debug/caches', expected_code=200)
+        self.assertEqual(response_json['caches']['search']['misses'], 1)
+        self.assertEqual(response_json['caches']['search']['ttl'], 60)
+        self.assertEqual(response_json['caches']['count']['max_size'], 20)
+        self.session.mds = None
+
+    @timeout(10)
+    async def test_get_db_writer_stats(self):
+        """
+        Test whether the API returns the statistics of the database writer
+        """
+        response_json = await self.do_request('debug/db_writer', expected_code=200)
+        self.assertEqual(response_json['db_writer'], {})
+
+        self.session.mds = MockObject()
+        self.session.mds.writer = DBWriter(None)
+        response_json = await self.do_request('debug/db_writer', expected_code=200)
+        self.assertEqual(response_json['db_writer']['queue_depth'], 0)
+        self.assertEqual(response_json['db_writer']['batches'], 0)
+        self.session.mds = None
+
     @skipIf(sys.version_info.major > 2, "meliae is not Python 3 compatible")
     @timeout(60)
     async def test_dump_memory(self):
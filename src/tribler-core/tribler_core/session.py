@@ -414,7 +414,14 @@ class Session(TaskManager):
             channels_dir = self.config.get_chant_channels_dir()
             metadata_db_name = 'metadata.db' if not self.config.get_testnet() else 'metadata_testnet.db'
             database_path = self.config.get_state_dir() / 'sqlite' / metadata_db_name
-            self.mds = MetadataStore(database_path, channels_dir, self.trustchain_keypair)
+            self.mds = MetadataStore(
+                database_path,
+                channels_dir,
+                self.trustchain_keypair,
+                reader_threads=self.config.get_chant_db_reader_threads(),
+            )
+            self.mds.search_cache.max_size = self.config.get_chant_search_cache_size()
+            self.mds.search_cache.ttl = self.config.get_chant_search_cache_ttl()
 
         # IPv8
         if self.config.get_ipv8_enabled():
@@ -15,6 +15,7 @@ from tribler_core.tests.tools.tools import timeout
 from tribler_core.upgrade.upgrade import TriblerUpgrader, cleanup_noncompliant_channel_torrents
 from tribler_core.utilities.configparser import CallbackConfigParser
 from tribler_core.utilities.path_util import str_path
+from tribler_core.utilities.random_utils import random_infohash
 
 
 class TestUpgrader(TestAsServer):
@@ -86,10 +87,37 @@ class TestUpgrader(TestAsServer):
             self.assertTrue(list(mds._db.execute('PRAGMA index_info("idx_channelnode__metadata_type")')))
         mds.shutdown()
 
+    def test_upgrade_pony_db_8to9(self):
+        """
+        Test that the trigger-maintained tables are created and filled from the existing entries.
+        Also, check that the DB version is upgraded.
+        """
+        OLD_DB_SAMPLE = TESTS_DATA_DIR / 'upgrade_databases' / 'pony_v6.db'
+        old_database_path = self.session.config.get_state_dir() / 'sqlite' / 'metadata.db'
+        shutil.copyfile(OLD_DB_SAMPLE, old_database_path)
+
+        self.upgrader.upgrade_pony_db_6to7()
+        self.upgrader.upgrade_pony_db_7to8()
+        self.upgrader.upgrade_pony_db_8to9()
+        channels_dir = self.session.config.get_chant_channels_dir()
+        mds = MetadataStore(old_database_path, channels_dir, self.session.trustchain_keypair)
+        with db_session:
+            self.assertEqual(int(mds.MiscData.get(name="db_version").value), 9)
+            total_entries = mds.ChannelNode.select().count()
+            self.assertTrue(total_entries)
+            self.assertEqual(mds._db.select("SUM(count) FROM ChannelNodeCounts")[0], total_entries)
+            self.assertTrue(list(mds._db.execute('PRAGMA index_info("idx_torrentstate__last_check")')))
+
+            # The triggers keep the counts up to date from now on
+            mds.TorrentMetadata(title="new torrent", infohash=random_infohash())
+            mds.ChannelNode.select().first().delete()
+            self.assertEqual(mds._db.select("SUM(count) FROM ChannelNodeCounts")[0], total_entries)
+        mds.shutdown()
+
     @timeout(10)
     async def test_upgrade_pony_db_complete(self):
         """
-        Test complete update sequence for Pony DB (e.g. 6->7->8)
+        Test complete update sequence for Pony DB (e.g. 6->7->8->9)
         """
         OLD_DB_SAMPLE = TESTS_DATA_DIR / 'upgrade_databases' / 'pony_v6.db'
         old_database_path = self.session.config.get_state_dir() / 'sqlite' / 'metadata.db'
@@ -101,7 +129,7 @@ class TestUpgrader(TestAsServer):
         with db_session:
             self.assertEqual(mds.TorrentMetadata.select().count(), 23)
             self.assertEqual(mds.ChannelMetadata.select().count(), 2)
-            self.assertEqual(int(mds.MiscData.get(name="db_version").value), 8)
+            self.assertEqual(int(mds.MiscData.get(name="db_version").value), 9)
             self.assertTrue(list(mds._db.execute('PRAGMA index_info("idx_channelnode__metadata_type")')))
         mds.shutdown()
 
@@ -83,9 +83,34 @@ class TriblerUpgrader(object):
         await self.upgrade_72_to_pony()
         self.upgrade_pony_db_6to7()
         self.upgrade_pony_db_7to8()
+        self.upgrade_pony_db_8to9()
         convert_config_to_tribler74(self.session.config.get_state_dir())
         convert_config_to_tribler75(self.session.config.get_state_dir())
 
+    def upgrade_pony_db_8to9(self):
+        """
+        Upgrade GigaChannel DB from version 8 (7.5.x) to version 9.
+        The new trigger-maintained tables are filled from the existing entries and the new indexes are built.
+        This scans the whole DB, but it is done only once, so we do it in the foreground.
+        """
+        # We have to create the Metadata Store object because Session-managed Store has not been started yet
+        database_path = self.session.config.get_state_dir() / 'sqlite' / 'metadata.db'
+        channels_dir = self.session.config.get_chant_channels_dir()
+        if not database_path.exists():
+            return
+        mds = MetadataStore(database_path, channels_dir, self.session.trustchain_keypair, disable_sync=True)
+        self.do_upgrade_pony_db_8to9(mds)
+        mds.shutdown()
+
+    def do_upgrade_pony_db_8to9(self, mds):
+        with db_session:
+            db_version = mds.MiscData.get(name="db_version")
+            if int(db_version.value) != 8:
+                return
+            mds.create_trigger_maintained_tables()
+            db_version.value = str(9)
+        return
+
     def upgrade_pony_db_7to8(self):
         """
         Upgrade GigaChannel DB from version 7 (7.4.x) to version 8 (7.5.x).
@@ -39,6 +39,8 @@ class RemoteTableModel(QAbstractTableModel):
 
         self.data_items = []
         self.item_load_batch = 50
+        # Opaque position of the last locally loaded item, used to fetch the next page without OFFSET
+        self.next_cursor = None
         self.sort_by = self.columns[self.default_sort_column] if self.default_sort_column >= 0 else None
         self.sort_desc = True
         self.saved_header_state = None
@@ -56,6 +58,7 @@ class RemoteTableModel(QAbstractTableModel):
         self.beginResetModel()
         self.data_items = []
         self.item_uid_map = {}
+        self.next_cursor = None
         self.endResetModel()
         self.perform_query()
 
@@ -170,6 +173,9 @@ class RemoteTableModel(QAbstractTableModel):
         """
         if 'first' not in kwargs or 'last' not in kwargs:
             kwargs["first"], kwargs['last'] = self.rowCount() + 1, self.rowCount() + self.item_load_batch
+            # When scrolling down, continue right after the last loaded item
+            if self.next_cursor:
+                kwargs["cursor"] = self.next_cursor
 
         if self.sort_by is not None:
             kwargs.update({"sort_by": self.sort_by, "sort_desc": self.sort_desc})
@@ -197,6 +203,8 @@ class RemoteTableModel(QAbstractTableModel):
 
         if not remote or (uuid.UUID(response.get('uuid')) in self.remote_queries):
             self.add_items(response['results'], on_top=remote or on_top)
+            if not remote and not on_top and response['results']:
+                self.next_cursor = response.get('next_cursor')
             if "total" in response:
                 self.channel_info["total"] = response["total"]
                 self.info_changed.emit(response['results'])